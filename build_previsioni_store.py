@@ -0,0 +1,27 @@
+"""
+Script per (ri)costruire lo store colonnare del modulo previsioni
+Esegui con: python build_previsioni_store.py
+
+Legge gli Excel/JSON sorgente, prepara df_affid e anagrafica e li salva in
+previsioni_store/ (o PREVISIONI_STORE_PATH). Da lanciare dopo ogni nuovo
+export dei file sorgente e prima dell'avvio dei worker, così nessuna
+richiesta deve rileggere gli Excel.
+"""
+
+import os
+import sys
+
+# Aggiungi la directory corrente al path
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+
+def main():
+    from routes.previsioni import build_previsioni_store, STORE_PATH
+
+    print("🔄 Costruzione store colonnare previsioni...")
+    build_previsioni_store()
+    print(f"✓ Store salvato in: {STORE_PATH}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,25 +1,47 @@
 import numpy as np
-import matplotlib.pyplot as plt
-try:
-    from lifelines import KaplanMeierFitter
-    LIFELINES_AVAILABLE = True
-except ImportError:
-    LIFELINES_AVAILABLE = False
-    print("[WARNING] lifelines non installato - funzionalità previsioni disabilitate")
+import pandas as pd
+from matplotlib.figure import Figure
 from scipy.optimize import minimize
-from scipy.interpolate import interp1d
-import numpy as np
-import os, uuid
-
-def weibull_logpost(params, data, cens, k_prior, lambda_prior, k_var, lambda_var):
+from scipy import sparse
+from scipy.stats import norm
+import zlib, hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+# Versione della logica di fit: incrementare quando cambia il calcolo delle
+# previsioni, così i fingerprint cambiano e le cache per gruppo vengono invalidate
+PREDICTIONS_CODE_VERSION = "4"
+
+def _pesi(weights, n):
+    """Pesi delle osservazioni: default 1 per riga (dati non aggregati)."""
+    if weights is None:
+        return np.ones(n)
+    return np.asarray(weights, dtype=float)
+
+def weighted_percentile(values, weights, q):
+    """
+    Percentile pesato equivalente a np.percentile (interpolazione lineare)
+    sui dati espansi, cioè con ogni valore ripetuto 'peso' volte.
+    """
+    values = np.asarray(values, dtype=float)
+    weights = _pesi(weights, len(values))
+    order = np.argsort(values, kind="stable")
+    values, cum_w = values[order], np.cumsum(weights[order])
+    pos = q / 100 * (cum_w[-1] - 1)
+    lo, hi = np.floor(pos), np.ceil(pos)
+    v_lo = values[min(np.searchsorted(cum_w, lo, side="right"), len(values) - 1)]
+    v_hi = values[min(np.searchsorted(cum_w, hi, side="right"), len(values) - 1)]
+    return v_lo + (pos - lo) * (v_hi - v_lo)
+
+def weibull_logpost(params, data, cens, k_prior, lambda_prior, k_var, lambda_var, weights=None):
     k, lam = params
     if k <= 0 or lam <= 0:
         return np.inf
+    w = _pesi(weights, len(data))
     events = (cens == 0)
     censored = (cens == 1)
     loglike = (
-        np.sum(np.log(k/lam) + (k-1)*np.log(data[events]/lam) - (data[events]/lam)**k) +
-        np.sum(- (data[censored]/lam)**k)
+        np.sum(w[events] * (np.log(k/lam) + (k-1)*np.log(data[events]/lam) - (data[events]/lam)**k)) +
+        np.sum(- w[censored] * (data[censored]/lam)**k)
     )
     logprior = -((np.log(k) - np.log(k_prior))**2 / (2*k_var) + (np.log(lam) - np.log(lambda_prior))**2 / (2*lambda_var))
     return -(loglike + logprior)
@@ -32,43 +54,564 @@ def fit_weibull_and_score(T, E, km_grid, surv_km, k_prior, lambda_prior, k_var,
     error = np.mean((weibull_surv - surv_km)**2)
     return error, k_map, lam_map
 
-def best_prior_weibull(T, E, km_grid, surv_km, k_prior_grid, lambda_prior_grid, k_var=0.05, lambda_var=0.15):
-    best_score = np.inf
-    best_params = None
-    best_kmap = None
-    best_lammap = None
-    for k_p in k_prior_grid:
-        for l_p in lambda_prior_grid:
-            error, k_map, lam_map = fit_weibull_and_score(T, E, km_grid, surv_km, k_p, l_p, k_var, lambda_var)
-            if error < best_score:
-                best_score = error
-                best_params = (k_p, l_p)
-                best_kmap = k_map
-                best_lammap = lam_map
-    return best_params, best_kmap, best_lammap
-
-def compute_riskset(T, mesi_grid):
-    return np.array([(T >= m*30.42).sum() for m in mesi_grid])
-
-def weibull_confidence_bands(T, E, k_map, lam_map, giorni_grid, n_boot=200, k_var=0.05, lambda_var=0.15):
-    k_samples = np.random.normal(k_map, np.sqrt(k_var), n_boot)
-    lam_samples = np.random.normal(lam_map, np.sqrt(lambda_var)*lam_map/lam_map, n_boot)
+def weibull_sufficient_stats(T, E, min_time=0.5, weights=None):
+    """
+    Riduce (T, E) alle statistiche sufficienti per la log-posterior Weibull:
+    numero di eventi, somma dei log-tempi degli eventi e tempi distinti con
+    relativo conteggio (servono per sum(t**k), che dipende da k).
+    Con weights ogni riga conta come 'peso' osservazioni identiche.
+    I tempi nulli sono portati a min_time per evitare log(0).
+    """
+    T = np.maximum(np.asarray(T, dtype=float), min_time)
+    E = np.asarray(E)
+    w = _pesi(weights, len(T))
+    events = (E == 0)
+    n_events = float(w[events].sum())
+    sum_log_events = float((w[events] * np.log(T[events])).sum())
+    t_unique, inverse = np.unique(T, return_inverse=True)
+    counts = np.bincount(inverse.ravel(), weights=w, minlength=len(t_unique))
+    return n_events, sum_log_events, np.log(t_unique), counts
+
+def fit_weibull_map_batch(T, E, k_priors, lambda_priors, k_var=0.05, lambda_var=0.15,
+                          k_bounds=(0.1, 10), lambda_bounds=(10, 10000), max_iter=100, tol=1e-9,
+                          weights=None):
+    """
+    Stima MAP Weibull per molte coppie di prior contemporaneamente.
+
+    Equivalente a chiamare fit_weibull_and_score per ogni (k_prior, lambda_prior),
+    ma ottimizza tutte le coppie insieme con un Newton smorzato vettorizzato in
+    spazio logaritmico (a=log k, b=log lambda) sulle statistiche sufficienti.
+
+    Ritorna due array (k_map, lam_map) di lunghezza len(k_priors).
+    """
+    n_events, s_log, log_t, w = weibull_sufficient_stats(T, E, weights=weights)
+    a0 = np.log(np.asarray(k_priors, dtype=float))
+    b0 = np.log(np.asarray(lambda_priors, dtype=float))
+    a_lo, a_hi = np.log(k_bounds[0]), np.log(k_bounds[1])
+    b_lo, b_hi = np.log(lambda_bounds[0]), np.log(lambda_bounds[1])
+
+    def neg_logpost(a, b):
+        # a, b con shape (n_priors, n_candidati)
+        k = np.exp(a)
+        g = (np.exp(k[..., None] * (log_t - b[..., None])) * w).sum(axis=-1)
+        loglike = n_events * a - n_events * k * b + (k - 1) * s_log - g
+        logprior = -((a - a0[:, None])**2 / (2*k_var) + (b - b0[:, None])**2 / (2*lambda_var))
+        return -(loglike + logprior)
+
+    a = np.clip(a0.copy(), a_lo, a_hi)
+    b = np.clip(b0.copy(), b_lo, b_hi)
+    f = neg_logpost(a[:, None], b[:, None])[:, 0]
+    steps = 0.5 ** np.arange(12)
+    active = np.ones_like(a, dtype=bool)
+
+    for _ in range(max_iter):
+        k = np.exp(a)
+        z = k[:, None] * (log_t - b[:, None])
+        e = np.exp(z) * w
+        g = e.sum(axis=1)
+        gz = (e * z).sum(axis=1)
+        gzz = (e * z * z).sum(axis=1)
+
+        # Gradiente e Hessiana della log-posterior negativa
+        grad_a = -(n_events - n_events * k * b + k * s_log - gz - (a - a0) / k_var)
+        grad_b = -(-n_events * k + k * g - (b - b0) / lambda_var)
+        h_aa = -(-n_events * k * b + k * s_log - (gzz + gz) - 1 / k_var)
+        h_bb = k * k * g + 1 / lambda_var
+        h_ab = n_events * k - k * (g + gz)
+
+        # Levenberg: rende l'Hessiana definita positiva prima di risolvere il 2x2
+        tr, det = h_aa + h_bb, h_aa * h_bb - h_ab**2
+        min_eig = tr / 2 - np.sqrt(np.maximum(tr**2 / 4 - det, 0))
+        mu = np.where(min_eig > 1e-8, 0.0, 1e-6 - min_eig)
+        h_aa, h_bb = h_aa + mu, h_bb + mu
+        det = h_aa * h_bb - h_ab**2
+        da = -(h_bb * grad_a - h_ab * grad_b) / det
+        db = -(h_aa * grad_b - h_ab * grad_a) / det
+
+        # Sui bound attivi si blocca la coordinata e si fa Newton sull'altra
+        fix_a = ((a <= a_lo) & (grad_a > 0)) | ((a >= a_hi) & (grad_a < 0))
+        fix_b = ((b <= b_lo) & (grad_b > 0)) | ((b >= b_hi) & (grad_b < 0))
+        da = np.where(fix_a, 0.0, np.where(fix_b, -grad_a / h_aa, da))
+        db = np.where(fix_b, 0.0, np.where(fix_a, -grad_b / h_bb, db))
+        # Trust region in spazio log: passo massimo unitario per coordinata
+        scale = np.maximum(1.0, np.maximum(np.abs(da), np.abs(db)))
+        da, db = da / scale, db / scale
+
+        # Backtracking vettorizzato: primo passo che migliora, con proiezione sui bound
+        a_c = np.clip(a[:, None] + steps * da[:, None], a_lo, a_hi)
+        b_c = np.clip(b[:, None] + steps * db[:, None], b_lo, b_hi)
+        f_c = neg_logpost(a_c, b_c)
+        better = f_c < f[:, None]
+        first = np.argmax(better, axis=1)
+        improved = better[np.arange(len(a)), first] & active
+        rows = np.where(improved)[0]
+        delta = np.zeros_like(f)
+        delta[rows] = f[rows] - f_c[rows, first[rows]]
+        a[rows] = a_c[rows, first[rows]]
+        b[rows] = b_c[rows, first[rows]]
+        f[rows] = f_c[rows, first[rows]]
+
+        active = improved & (delta > tol * np.maximum(1.0, np.abs(f)))
+        if not active.any():
+            break
+
+    return np.exp(a), np.exp(b)
+
+def best_prior_weibull(T, E, km_grid, surv_km, k_prior_grid, lambda_prior_grid, k_var=0.05, lambda_var=0.15,
+                       weights=None):
+    k_priors, lambda_priors = np.meshgrid(k_prior_grid, lambda_prior_grid, indexing="ij")
+    k_priors, lambda_priors = k_priors.ravel(), lambda_priors.ravel()
+    k_map, lam_map = fit_weibull_map_batch(T, E, k_priors, lambda_priors, k_var, lambda_var, weights=weights)
+    weibull_surv = np.exp(- (np.asarray(km_grid)[None, :] / lam_map[:, None])**k_map[:, None])
+    errors = np.mean((weibull_surv - surv_km)**2, axis=1)
+    # argmin restituisce la prima coppia a parità di errore, come il vecchio loop
+    best = int(np.argmin(errors))
+    return (k_priors[best], lambda_priors[best]), k_map[best], lam_map[best]
+
+def compute_riskset(T, mesi_grid, weights=None):
+    w = _pesi(weights, len(T))
+    return np.array([w[T >= m*30.42].sum() for m in mesi_grid])
+
+def kaplan_meier_grid(T, event, grid, weights=None, offsets=None, alpha=0.05):
+    """
+    Kaplan-Meier pesato con intervallo di confidenza di Greenwood esponenziale
+    (log(-log), come lifelines), valutato direttamente sui punti di grid.
+
+    Più gruppi in una sola chiamata: T/event/weights sono ordinati per gruppo e
+    offsets (lunghezza n_gruppi+1) delimita le righe di ciascun gruppo; senza
+    offsets i dati sono un unico gruppo. Come nel vecchio codice basato su
+    lifelines + interp1d, la curva è interpolata linearmente tra i tempi
+    osservati (0 incluso), vale 1 prima del primo e l'ultimo valore dopo.
+
+    Ritorna tre array (surv, lower, upper) con shape (n_gruppi, len(grid)).
+    """
+    T = np.asarray(T, dtype=float)
+    event = np.asarray(event).astype(bool)
+    w = _pesi(weights, len(T))
+    grid = np.asarray(grid, dtype=float)
+    offsets = np.array([0, len(T)]) if offsets is None else np.asarray(offsets)
+    n_groups = len(offsets) - 1
+    gid = np.repeat(np.arange(n_groups), np.diff(offsets))
+
+    # Un punto a tempo 0 per gruppo (peso nullo): la timeline parte sempre da 0
+    gid = np.concatenate([gid, np.arange(n_groups)])
+    T = np.concatenate([T, np.zeros(n_groups)])
+    d = np.concatenate([w * event, np.zeros(n_groups)])
+    w = np.concatenate([w, np.zeros(n_groups)])
+    order = np.lexsort((T, gid))
+    gid, T, d, w = gid[order], T[order], d[order], w[order]
+
+    # Tempi distinti per gruppo: decessi e uscite aggregati per (gruppo, tempo)
+    nuovo = np.ones(len(T), dtype=bool)
+    nuovo[1:] = (gid[1:] != gid[:-1]) | (T[1:] != T[:-1])
+    starts = np.flatnonzero(nuovo)
+    u_gid, u_t = gid[starts], T[starts]
+    deaths = np.add.reduceat(d, starts)
+    removed = np.add.reduceat(w, starts)
+
+    # Somme cumulate segmentate per gruppo
+    u_start = np.searchsorted(u_gid, np.arange(n_groups))
+    u_end = np.append(u_start[1:], len(u_gid))
+    def cumsum_gruppo(x):
+        cs = np.cumsum(x)
+        base = np.concatenate([[0.0], cs])[u_start]
+        return cs - base[u_gid]
+
+    totale = np.bincount(u_gid, weights=removed, minlength=n_groups)
+    at_risk = totale[u_gid] - (cumsum_gruppo(removed) - removed)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # Se tutti i rimasti a rischio si rompono S diventa 0: lo si traccia a
+        # parte perché un -inf nella somma cumulata sporcherebbe i gruppi successivi
+        estinto = (at_risk == deaths) & (deaths > 0)
+        log_terms = np.where(estinto, 0.0, np.log(at_risk - deaths) - np.log(at_risk))
+        log_s = np.where(cumsum_gruppo(estinto) > 0, -np.inf, cumsum_gruppo(log_terms))
+        var_terms = deaths / (at_risk * (at_risk - deaths))
+        var_terms[~np.isfinite(var_terms)] = 0
+        var = cumsum_gruppo(var_terms)
+
+        # Greenwood esponenziale; dove S=1 la banda non è definita e vale 1
+        z = norm.ppf(1 - alpha / 2)
+        surv = np.exp(log_s)
+        lower = np.exp(-np.exp(np.log(-log_s) - z * np.sqrt(var) / log_s))
+        upper = np.exp(-np.exp(np.log(-log_s) + z * np.sqrt(var) / log_s))
+    lower = np.where(np.isnan(lower), 1.0, lower)
+    upper = np.where(np.isnan(upper), 1.0, upper)
+
+    # Per ogni punto di grid: ultimo tempo <= x nello stesso gruppo (merge ordinato)
+    g_gid = np.repeat(np.arange(n_groups), len(grid))
+    g_t = np.tile(grid, n_groups)
+    all_gid = np.concatenate([u_gid, g_gid])
+    all_t = np.concatenate([u_t, g_t])
+    is_grid = np.concatenate([np.zeros(len(u_t), dtype=bool), np.ones(len(g_t), dtype=bool)])
+    merged = np.lexsort((is_grid, all_t, all_gid))
+    j = np.empty(len(g_t), dtype=np.int64)
+    j[merged[is_grid[merged]] - len(u_t)] = (np.cumsum(~is_grid[merged]) - 1)[is_grid[merged]]
+
+    prima = j < u_start[g_gid]
+    j = np.maximum(j, 0)
+    nxt = np.minimum(j + 1, len(u_t) - 1)
+    interno = ~prima & (j + 1 < u_end[g_gid])
+
+    def valuta(y):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            slope = (y[nxt] - y[j]) / (u_t[nxt] - u_t[j])
+            val = np.where(interno, slope * (g_t - u_t[j]) + y[j], y[j])
+        return np.where(prima, 1.0, val).reshape(n_groups, len(grid))
+
+    return valuta(surv), valuta(lower), valuta(upper)
+
+BAND_METHODS = ("bootstrap", "delta")
+
+def weibull_confidence_bands(T, E, k_map, lam_map, giorni_grid, n_boot=200, k_var=0.05, lambda_var=0.15, rng=None,
+                             method="bootstrap", alpha=0.05):
+    """
+    Banda di confidenza della sopravvivenza Weibull sulla griglia dei giorni.
+
+    method="bootstrap": campiona (k, lambda) e prende i percentili delle curve,
+    calcolate tutte insieme come matrice (n_boot x n_grid).
+    rng: np.random.Generator per bande riproducibili (default: stato globale np.random).
+
+    method="delta": banda analitica senza campionamento, con il metodo delta
+    su log(-log S) = k*(log t - log lambda) e la stessa incertezza sui
+    parametri usata dal bootstrap (deviazioni standard sqrt(k_var), sqrt(lambda_var)).
+    """
+    giorni_grid = np.asarray(giorni_grid, dtype=float)
+    sd_k, sd_lam = np.sqrt(k_var), np.sqrt(lambda_var)*lam_map/lam_map
+
+    if method == "delta":
+        z = norm.ppf(1 - alpha / 2)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            log_ratio = np.log(giorni_grid) - np.log(lam_map)
+            g = k_map * log_ratio
+            sd_g = np.sqrt(log_ratio**2 * sd_k**2 + (k_map / lam_map)**2 * sd_lam**2)
+            weibull_lower = np.exp(-np.exp(g + z * sd_g))
+            weibull_upper = np.exp(-np.exp(g - z * sd_g))
+        # A t=0 la sopravvivenza è 1 senza incertezza
+        weibull_lower = np.where(giorni_grid > 0, weibull_lower, 1.0)
+        weibull_upper = np.where(giorni_grid > 0, weibull_upper, 1.0)
+        return weibull_lower, weibull_upper
+    if method != "bootstrap":
+        raise ValueError(f"Metodo banda non supportato: {method}")
+
+    rng = rng if rng is not None else np.random
+    k_samples = rng.normal(k_map, sd_k, n_boot)
+    lam_samples = rng.normal(lam_map, sd_lam, n_boot)
     k_samples = k_samples[k_samples > 0]
     lam_samples = lam_samples[lam_samples > 0]
-    weibull_array = []
-    for k, lam in zip(np.random.choice(k_samples, n_boot), np.random.choice(lam_samples, n_boot)):
-        weibull_array.append(np.exp(- (giorni_grid / lam)**k))
-    weibull_array = np.array(weibull_array)
-    weibull_lower = np.percentile(weibull_array, 2.5, axis=0)
-    weibull_upper = np.percentile(weibull_array, 97.5, axis=0)
+    k_boot = rng.choice(k_samples, n_boot)
+    lam_boot = rng.choice(lam_samples, n_boot)
+    weibull_array = np.exp(- (giorni_grid[None, :] / lam_boot[:, None])**k_boot[:, None])
+    weibull_lower = np.percentile(weibull_array, 100 * alpha / 2, axis=0)
+    weibull_upper = np.percentile(weibull_array, 100 * (1 - alpha / 2), axis=0)
     return weibull_lower, weibull_upper
 
-def save_chart(fig, img_dir):
-    img_id = str(uuid.uuid4()) + ".png"
-    img_path = os.path.join(img_dir, img_id)
-    fig.savefig(img_path, bbox_inches="tight")
-    plt.close(fig)
-    return "/" + img_path.replace("\\", "/")
+def chart_figure(curve, titolo, last_reliable_month):
+    """
+    Grafico KM/Weibull di un gruppo a partire dalle curve salvate da predict_group.
+    Usa l'API a oggetti di matplotlib (niente pyplot): sicura nei thread del web server.
+    """
+    mesi_grid = curve["mesi"]
+    fig = Figure(figsize=(9,5))
+    ax = fig.subplots()
+    ax.step(mesi_grid, curve["km_surv"], label='Kaplan-Meier', where='post', color='C0')
+    ax.fill_between(mesi_grid, curve["km_lower"], curve["km_upper"], color='C0', alpha=0.20, step='post', label='KM 95% CI')
+    ax.plot(mesi_grid, curve["weibull_surv"], 'r--', label='Weibull tuned')
+    ax.fill_between(mesi_grid, curve["weibull_lower"], curve["weibull_upper"], color='r', alpha=0.15, label='Weibull 95% CI')
+    ax.axvline(last_reliable_month, color='orange', linestyle='-.', label=f'Stima affidabile fino a {last_reliable_month} mesi')
+    ax.set_xlabel("Mesi")
+    ax.set_ylabel("Probabilità di sopravvivenza")
+    ax.set_title(f"{titolo}\nTuning curve")
+    ax.legend()
+    ax.set_ylim(0.85, 1.01)
+    ax.set_xlim(0,36)
+    fig.tight_layout()
+    return fig
+
+def tronca_osservazioni(T_raw, censura, max_giorni=1095):
+    """Tronca i tempi a max_giorni: oltre la soglia l'osservazione diventa censurata."""
+    T_raw = np.asarray(T_raw)
+    T = np.minimum(T_raw, max_giorni)
+    E = np.where(T_raw > max_giorni, 1, censura).astype(int)
+    return T, E
+
+def group_seed(seed, modello, code):
+    """Seed deterministico per gruppo: non dipende dall'ordine né dal numero di worker."""
+    return [int(seed), zlib.crc32(f"{modello}|{code}".encode("utf-8"))]
+
+def predict_group(
+    T_raw,
+    censura,
+    titolo,
+    mesi_grid=np.arange(0,37),
+    giorni_grid=None,
+    riskset_threshold=1000,
+    include_km=True,
+    seed=None,
+    weights=None,
+    km_curves=None,
+    band_method="bootstrap"
+):
+    """
+    Calcola curve KM/Weibull e previsioni per un singolo gruppo (componente
+    o STAT). Usata sia in seriale sia dai worker del process pool.
+    Il grafico non viene disegnato qui: le curve sulla griglia dei mesi sono
+    restituite in predizioni["curve"] e chart_figure le disegna su richiesta.
+    weights: numero di unità rappresentate da ogni riga (default 1).
+    km_curves: (surv, lower, upper) su giorni_grid già calcolate in batch con
+    kaplan_meier_grid; se None il KM viene calcolato qui.
+    band_method: "bootstrap" o "delta" (vedi weibull_confidence_bands).
+    """
+    if giorni_grid is None:
+        giorni_grid = mesi_grid * 30.42
+
+    T, E = tronca_osservazioni(T_raw, censura)
+    w = _pesi(weights, len(T))
+    risk_set = compute_riskset(T, mesi_grid, weights=w)
+    reliable_months = np.where(risk_set >= riskset_threshold)[0]
+    last_reliable_month = int(reliable_months[-1]) if len(reliable_months)>0 else 0
+
+    # Kaplan-Meier direttamente sulla griglia dei giorni
+    if km_curves is None:
+        km_curves = [curve[0] for curve in kaplan_meier_grid(T, E == 0, giorni_grid, weights=w)]
+    km_surv, km_ci_lower, km_ci_upper = km_curves
+    ultima_rottura = T[(E == 0)].max() if (E == 0).sum() > 0 else 0
+    km_grid = giorni_grid[giorni_grid <= ultima_rottura]
+    surv_km = km_surv[giorni_grid <= ultima_rottura]
+
+    # Grid search per Weibull
+    k_prior_grid = np.linspace(1.0, 1.2, 6)
+    lambda_prior_grid = np.linspace(weighted_percentile(T, w, 60), weighted_percentile(T, w, 90), 8)
+    (best_kprior, best_lambdaprior), k_map, lam_map = best_prior_weibull(
+        T, E, km_grid, surv_km, k_prior_grid, lambda_prior_grid, weights=w
+    )
+    weibull_surv = np.exp(- (giorni_grid / lam_map)**k_map)
+    rng = np.random.default_rng(seed) if seed is not None else None
+    weibull_lower, weibull_upper = weibull_confidence_bands(
+        T, E, k_map, lam_map, giorni_grid, n_boot=200, rng=rng, method=band_method
+    )
+
+    # Previsione solo in termini di probabilità di rottura (1-sopravvivenza)
+    predizioni = {}
+    for mesi in [12, 24, 36, last_reliable_month]:
+        idx = int(np.searchsorted(mesi_grid, mesi))
+        if idx >= len(weibull_surv):
+            if include_km:
+                predizioni[f"prev{mesi}"] = None
+                predizioni[f"prev{mesi}_lower"] = None
+                predizioni[f"prev{mesi}_upper"] = None
+                predizioni[f"prev{mesi}_km"] = None
+                predizioni[f"prev{mesi}_km_lower"] = None
+                predizioni[f"prev{mesi}_km_upper"] = None
+        else:
+            # Weibull
+            prob_rott = 1 - weibull_surv[idx]
+            prob_rott_low = 1 - weibull_upper[idx]    # ATTENZIONE: upper/lower sono sugli intervalli di SOPRAVVIVENZA!
+            prob_rott_up  = 1 - weibull_lower[idx]
+            predizioni[f"prev{mesi}"] = float(prob_rott)
+            predizioni[f"prev{mesi}_lower"] = float(prob_rott_low)
+            predizioni[f"prev{mesi}_upper"] = float(prob_rott_up)
+            if include_km:
+                # Kaplan-Meier
+                prob_rott_km = 1 - km_surv[idx]
+                prob_rott_km_low = 1 - km_ci_upper[idx]
+                prob_rott_km_up  = 1 - km_ci_lower[idx]
+                predizioni[f"prev{mesi}_km"] = float(prob_rott_km)
+                predizioni[f"prev{mesi}_km_lower"] = float(prob_rott_km_low)
+                predizioni[f"prev{mesi}_km_upper"] = float(prob_rott_km_up)
+    predizioni["ultimo_mese_affidabile"] = int(last_reliable_month)
+
+    # Curve per il grafico (disegnato su richiesta da chart_figure)
+    predizioni["titolo"] = titolo
+    predizioni["curve"] = {
+        "mesi": [int(m) for m in mesi_grid],
+        "km_surv": km_surv.tolist(),
+        "km_lower": km_ci_lower.tolist(),
+        "km_upper": km_ci_upper.tolist(),
+        "weibull_surv": weibull_surv.tolist(),
+        "weibull_lower": weibull_lower.tolist(),
+        "weibull_upper": weibull_upper.tolist(),
+    }
+
+    return predizioni
+
+def _predict_group_task(task):
+    """Entry point picklable per ProcessPoolExecutor: task = (args, kwargs)."""
+    args, kwargs = task
+    return predict_group(*args, **kwargs)
+
+def run_group_tasks(tasks, n_workers=1, chunksize=None, label="Gruppo"):
+    """
+    Esegue i task di predict_group in seriale (n_workers<=1) o su un
+    ProcessPoolExecutor, restituendo i risultati nello stesso ordine dei task.
+    """
+    total = len(tasks)
+    if n_workers is None or n_workers <= 1 or total <= 1:
+        results = []
+        for i, task in enumerate(tasks, start=1):
+            print(f"{label} {i}/{total}: {task[0][2]}")
+            results.append(_predict_group_task(task))
+        return results
+
+    n_workers = min(n_workers, total)
+    if chunksize is None:
+        # ~4 chunk per worker: bilancia overhead di dispatch e gruppi di dimensione diversa
+        chunksize = max(1, total // (n_workers * 4))
+    print(f"{label}: {total} task su {n_workers} processi (chunksize={chunksize})")
+    results = []
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        for i, res in enumerate(executor.map(_predict_group_task, tasks, chunksize=chunksize), start=1):
+            results.append(res)
+            if i % chunksize == 0 or i == total:
+                print(f"{label} {i}/{total} completati")
+    return results
+
+def group_fingerprint(modello, code, T_raw, censura, params, weights=None):
+    """
+    Impronta di un gruppo: chiave, dati di sopravvivenza (indipendenti
+    dall'ordine delle righe), parametri di fit e versione del codice.
+    """
+    T_raw = np.asarray(T_raw, dtype=np.float64)
+    censura = np.asarray(censura, dtype=np.int8)
+    weights = _pesi(weights, len(T_raw))
+    order = np.lexsort((weights, censura, T_raw))
+    h = hashlib.sha256()
+    h.update(f"{PREDICTIONS_CODE_VERSION}|{modello}|{code}|{sorted(params.items())}".encode("utf-8"))
+    h.update(np.ascontiguousarray(T_raw[order]).tobytes())
+    h.update(np.ascontiguousarray(censura[order]).tobytes())
+    h.update(np.ascontiguousarray(weights[order]).tobytes())
+    return h.hexdigest()
+
+def _index_previous(previous):
+    """Indicizza un JSON di previsioni precedente per fingerprint."""
+    index = {}
+    for gruppi in (previous or {}).values():
+        for entry in gruppi.values():
+            if isinstance(entry, dict) and entry.get("fingerprint"):
+                index[entry["fingerprint"]] = entry
+    return index
+
+def _precompute_groups(groups, key_field, include_km, mesi_grid, giorni_grid, riskset_threshold,
+                       n_workers, chunksize, seed, previous, label, band_method="bootstrap"):
+    """
+    Calcola (o riusa da previous) le previsioni per una lista di gruppi
+    (modello, code, T_raw, censura, pesi, titolo). Ritorna {modello: {code: entry}}.
+    """
+    params = {
+        "mesi_grid": [int(m) for m in mesi_grid],
+        "giorni_grid": None if giorni_grid is None else [float(g) for g in giorni_grid],
+        "riskset_threshold": riskset_threshold,
+        "include_km": include_km,
+        "seed": seed,
+        "band_method": band_method,
+    }
+    previous_index = _index_previous(previous)
+
+    entries = {}
+    to_compute = []
+    tasks = []
+    for modello, code, T_raw, censura, pesi, titolo in groups:
+        fp = group_fingerprint(modello, code, T_raw, censura, params, weights=pesi)
+        cached = previous_index.get(fp)
+        if cached is not None:
+            entries[(modello, code)] = cached
+            continue
+        to_compute.append((modello, code, fp))
+        tasks.append((
+            (T_raw, censura, titolo),
+            dict(mesi_grid=mesi_grid, giorni_grid=giorni_grid, riskset_threshold=riskset_threshold,
+                 include_km=include_km, seed=group_seed(seed, modello, code),
+                 weights=pesi, band_method=band_method)
+        ))
+
+    # Kaplan-Meier di tutti i gruppi da calcolare in una sola chiamata
+    if tasks:
+        km_grid = mesi_grid * 30.42 if giorni_grid is None else giorni_grid
+        troncati = [tronca_osservazioni(args[0], args[1]) for args, _ in tasks]
+        offsets = np.concatenate([[0], np.cumsum([len(T) for T, _ in troncati])])
+        surv, lower, upper = kaplan_meier_grid(
+            np.concatenate([T for T, _ in troncati]),
+            np.concatenate([E == 0 for _, E in troncati]),
+            km_grid,
+            weights=np.concatenate([_pesi(kwargs["weights"], len(T)) for (T, _), (_, kwargs) in zip(troncati, tasks)]),
+            offsets=offsets
+        )
+        for i, (_, kwargs) in enumerate(tasks):
+            kwargs["km_curves"] = (surv[i], lower[i], upper[i])
+
+    print(f"{label}: {len(entries)} gruppi invariati (riusati), {len(tasks)} da calcolare")
+    results = run_group_tasks(tasks, n_workers=n_workers, chunksize=chunksize, label=label)
+    for (modello, code, fp), predizioni in zip(to_compute, results):
+        entries[(modello, code)] = {
+            key_field: code,
+            **predizioni,
+            "fingerprint": fp
+        }
+
+    # Ordine stabile: quello dei gruppi in input
+    predizioni_json = {}
+    for modello, code, *_ in groups:
+        predizioni_json.setdefault(modello, {})[code] = entries[(modello, code)]
+    return predizioni_json
+
+def pesi_affid(df):
+    """Colonna Peso di df_affid (1 per riga se assente, es. dati non aggregati)."""
+    if "Peso" in df.columns:
+        return df["Peso"].to_numpy(dtype=float)
+    return np.ones(len(df))
+
+def prepara_gruppi(df_affid, modelli, key_col):
+    """
+    Prepara in un solo passaggio le osservazioni di tutti i gruppi (modello, key_col).
+
+    Le righe dei modelli richiesti vengono ordinate una volta per gruppo in
+    buffer contigui; ogni gruppo è la fetta offsets[i]:offsets[i+1] (una vista,
+    nessuna copia). L'ordine dei gruppi è quello di modelli e, dentro ogni
+    modello, quello di prima apparizione del codice (come Series.unique()).
+    Le righe con key_col mancante sono escluse.
+
+    Ritorna un dict con:
+      - chiavi: lista di (modello, codice) per gruppo
+      - T, censura, pesi: array ordinati per gruppo
+      - offsets: array di lunghezza len(chiavi)+1
+    """
+    modelli = list(dict.fromkeys(modelli))
+    df = df_affid[df_affid["Modello"].isin(modelli) & df_affid[key_col].notna()]
+    gid = df.groupby(["Modello", key_col], sort=False, observed=True).ngroup().to_numpy()
+    n_gruppi = int(gid.max()) + 1 if len(gid) else 0
+
+    # Modello di ogni gruppo (posizione in modelli) dalla sua prima riga
+    pos_modello = pd.Categorical(df["Modello"], categories=modelli).codes
+    prima_riga = np.full(n_gruppi, len(gid))
+    np.minimum.at(prima_riga, gid, np.arange(len(gid)))
+    ordine_gruppi = np.lexsort((np.arange(n_gruppi), pos_modello[prima_riga]))
+    rango = np.empty(n_gruppi, dtype=np.int64)
+    rango[ordine_gruppi] = np.arange(n_gruppi)
+
+    # Unico ordinamento delle righe: per rango del gruppo, stabile sull'ordine originale
+    righe = np.argsort(rango[gid], kind="stable")
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(rango[gid], minlength=n_gruppi))])
+    modelli_col = df["Modello"].to_numpy()[righe]
+    codici_col = df[key_col].to_numpy()[righe]
+    return {
+        "chiavi": list(zip(modelli_col[offsets[:-1]], codici_col[offsets[:-1]])),
+        "T": df["Tempo di Vita"].to_numpy()[righe],
+        "censura": df["Censura"].to_numpy()[righe],
+        "pesi": pesi_affid(df)[righe],
+        "offsets": offsets,
+    }
+
+def _gruppi_da_prep(prep, titolo, min_peso=0):
+    """Lista (modello, codice, T, censura, pesi, titolo) dalle fette di prepara_gruppi."""
+    groups = []
+    off = prep["offsets"]
+    for i, (modello, code) in enumerate(prep["chiavi"]):
+        fetta = slice(off[i], off[i + 1])
+        pesi = prep["pesi"][fetta]
+        if pesi.sum() < min_peso:
+            continue
+        groups.append((modello, code, prep["T"][fetta], prep["censura"][fetta], pesi,
+                       titolo.format(modello=modello, code=code)))
+    return groups
 
 def precompute_all_predictions(
     df_affid,
@@ -76,7 +619,11 @@ def precompute_all_predictions(
     mesi_grid=np.arange(0,37),
     giorni_grid=None,
     riskset_threshold=1000,
-    img_dir="static/pred_charts"
+    n_workers=1,
+    chunksize=None,
+    seed=0,
+    previous=None,
+    band_method="bootstrap"
 ):
     """
     Precalcola le curve di affidabilità per ogni componente di ogni modello.
@@ -84,117 +631,24 @@ def precompute_all_predictions(
       - curve di sopravvivenza Kaplan-Meier e Weibull per ogni mese (0...36)
       - intervalli di confidenza
       - ultimo mese affidabile
-      - grafico salvato per ogni componente
+      - curve sulla griglia dei mesi per il grafico (disegnato su richiesta)
+    Con n_workers > 1 i componenti vengono elaborati in parallelo su più processi;
+    il risultato è identico (seed per gruppo) e nello stesso ordine del seriale.
+    Se previous (JSON di un calcolo precedente) è fornito, i componenti con
+    fingerprint invariato vengono riusati senza rifare il fit.
+    band_method sceglie la banda Weibull: "bootstrap" (campionamento) o "delta" (analitica).
     """
-    import matplotlib.pyplot as plt
-    from lifelines import KaplanMeierFitter
-    from scipy.optimize import minimize
-    from scipy.interpolate import interp1d
-    import os, uuid
-
-    # ... (tieni le funzioni interne come sono ora: weibull_logpost, fit_weibull_and_score, best_prior_weibull, compute_riskset, weibull_confidence_bands, save_chart) ...
-
-    if giorni_grid is None:
-        giorni_grid = mesi_grid * 30.42
-
-    predizioni_json = {}
-    total_comps = sum(df_affid[df_affid["Modello"] == m]["Codice Componente"].nunique() for m in modelli_topN)
-    comp_counter = 0
+    prep = prepara_gruppi(df_affid, modelli_topN, "Codice Componente")
+    groups = _gruppi_da_prep(prep, "Modello: {modello} - Componente: {code}")
 
+    predizioni_json = _precompute_groups(
+        groups, "componente", True, mesi_grid, giorni_grid, riskset_threshold,
+        n_workers, chunksize, seed, previous, label="Componente", band_method=band_method
+    )
     for modello in modelli_topN:
-        print(f'INIZIO MODELLO {modello}')
-        predizioni_json[modello] = {}
-        df_mod = df_affid[df_affid["Modello"] == modello]
-        componenti = df_mod["Codice Componente"].unique()
-        for componente in componenti:
-            comp_counter += 1
-            print(f"Componente {comp_counter}/{total_comps}: {modello} - {componente}")
-            dati = df_mod[df_mod['Codice Componente'] == componente]
-            if len(dati) == 0:
-                continue
-
-            T = dati['Tempo di Vita'].clip(upper=1095).values
-            E = np.where(dati['Tempo di Vita'] > 1095, 1, dati['Censura']).astype(int)
-            risk_set = compute_riskset(T, mesi_grid)
-            reliable_months = np.where(risk_set >= riskset_threshold)[0]
-            last_reliable_month = int(reliable_months[-1]) if len(reliable_months)>0 else 0
-
-            # Kaplan-Meier
-            kmf = KaplanMeierFitter()
-            kmf.fit(T, event_observed=1-E)
-            surv_func = kmf.survival_function_
-            ci = kmf.confidence_interval_
-            ultima_rottura = T[(E == 0)].max() if (E == 0).sum() > 0 else 0
-            km_grid = giorni_grid[giorni_grid <= ultima_rottura]
-            f_surv = interp1d(surv_func.index, surv_func.values.flatten(), bounds_error=False, fill_value=(1,surv_func.values[-1]))
-            surv_km = f_surv(km_grid)
-            f_surv_all = interp1d(surv_func.index, surv_func.values.flatten(), bounds_error=False, fill_value=(1, surv_func.values[-1]))
-            km_surv = f_surv_all(giorni_grid)
-            f_lower = interp1d(ci.index, ci.iloc[:,0].values, bounds_error=False, fill_value=(1,ci.iloc[-1,0]))
-            f_upper = interp1d(ci.index, ci.iloc[:,1].values, bounds_error=False, fill_value=(1,ci.iloc[-1,1]))
-            km_ci_lower = f_lower(giorni_grid)
-            km_ci_upper = f_upper(giorni_grid)
-
-            # Grid search per Weibull
-            k_prior_grid = np.linspace(1.0, 1.2, 6)
-            lambda_prior_grid = np.linspace(np.percentile(T,60), np.percentile(T,90), 8)
-            (best_kprior, best_lambdaprior), k_map, lam_map = best_prior_weibull(
-                T, E, km_grid, surv_km, k_prior_grid, lambda_prior_grid
-            )
-            weibull_surv = np.exp(- (giorni_grid / lam_map)**k_map)
-            weibull_lower, weibull_upper = weibull_confidence_bands(T, E, k_map, lam_map, giorni_grid, n_boot=200)
-
-            # Previsione solo in termini di probabilità di rottura (1-sopravvivenza)
-            predizioni = {}
-            for mesi in [12, 24, 36, last_reliable_month]:
-                idx = int(np.searchsorted(mesi_grid, mesi))
-                if idx >= len(weibull_surv):
-                    predizioni[f"prev{mesi}"] = None
-                    predizioni[f"prev{mesi}_lower"] = None
-                    predizioni[f"prev{mesi}_upper"] = None
-                    predizioni[f"prev{mesi}_km"] = None
-                    predizioni[f"prev{mesi}_km_lower"] = None
-                    predizioni[f"prev{mesi}_km_upper"] = None
-                else:
-                    # Weibull
-                    prob_rott = 1 - weibull_surv[idx]
-                    prob_rott_low = 1 - weibull_upper[idx]    # ATTENZIONE: upper/lower sono sugli intervalli di SOPRAVVIVENZA!
-                    prob_rott_up  = 1 - weibull_lower[idx]
-                    # Kaplan-Meier
-                    prob_rott_km = 1 - km_surv[idx]
-                    prob_rott_km_low = 1 - km_ci_upper[idx]
-                    prob_rott_km_up  = 1 - km_ci_lower[idx]
-                    predizioni[f"prev{mesi}"] = float(prob_rott)
-                    predizioni[f"prev{mesi}_lower"] = float(prob_rott_low)
-                    predizioni[f"prev{mesi}_upper"] = float(prob_rott_up)
-                    predizioni[f"prev{mesi}_km"] = float(prob_rott_km)
-                    predizioni[f"prev{mesi}_km_lower"] = float(prob_rott_km_low)
-                    predizioni[f"prev{mesi}_km_upper"] = float(prob_rott_km_up)
-            predizioni["ultimo_mese_affidabile"] = int(last_reliable_month)
-
-            # Plot e salva grafico
-            fig = plt.figure(figsize=(9,5))
-            plt.step(mesi_grid, km_surv, label='Kaplan-Meier', where='post', color='C0')
-            plt.fill_between(mesi_grid, km_ci_lower, km_ci_upper, color='C0', alpha=0.20, step='post', label='KM 95% CI')
-            plt.plot(mesi_grid, weibull_surv, 'r--', label='Weibull tuned')
-            plt.fill_between(mesi_grid, weibull_lower, weibull_upper, color='r', alpha=0.15, label='Weibull 95% CI')
-            plt.axvline(last_reliable_month, color='orange', linestyle='-.', label=f'Stima affidabile fino a {last_reliable_month} mesi')
-            plt.xlabel("Mesi")
-            plt.ylabel("Probabilità di sopravvivenza")
-            plt.title(f"Modello: {modello} - Componente: {componente}\nTuning curve")
-            plt.legend()
-            plt.ylim(0.85, 1.01)
-            plt.xlim(0,36)
-            plt.tight_layout()
-            img_path = save_chart(fig, img_dir)
-
-            predizioni_json[modello][componente] = {
-                "componente": componente,
-                "img_path": img_path,
-                **predizioni
-            }
-
-    print(f"COMPLETATE TUTTE LE PREVISIONI: {comp_counter} componenti elaborate.")
+        predizioni_json.setdefault(modello, {})
+
+    print(f"COMPLETATE TUTTE LE PREVISIONI: {len(groups)} componenti elaborate.")
     return predizioni_json
 
 def precompute_all_predictions_by_stat(
@@ -203,118 +657,65 @@ def precompute_all_predictions_by_stat(
     mesi_grid=np.arange(0,37),
     giorni_grid=None,
     riskset_threshold=1000,
-    img_dir="static/pred_charts_stat" # Salva i grafici in una cartella separata
+    n_workers=1,
+    chunksize=None,
+    seed=0,
+    previous=None,
+    band_method="bootstrap"
 ):
     """
     Precalcola le curve di affidabilità per ogni GRUPPO STAT di ogni modello.
+    Supporta esecuzione parallela e riuso incrementale come precompute_all_predictions.
     """
-    import matplotlib.pyplot as plt
-    from lifelines import KaplanMeierFitter
-    from scipy.optimize import minimize
-    from scipy.interpolate import interp1d
-    import os, uuid
-
-    # Crea la directory per i grafici se non esiste
-    if not os.path.exists(img_dir):
-        os.makedirs(img_dir)
-
-    # Assicurati che le funzioni helper siano definite o importate qui
-    # (weibull_logpost, fit_weibull_and_score, ecc.)
-
-    if giorni_grid is None:
-        giorni_grid = mesi_grid * 30.42
-
-    predizioni_json = {}
-    
-    # Calcola il numero totale di gruppi STAT da elaborare
-    df_filtered = df_affid_with_stat[df_affid_with_stat["Modello"].isin(modelli_topN)].dropna(subset=['stat'])
-    total_stats = df_filtered.groupby("Modello")['stat'].nunique().sum()
-    stat_counter = 0
-
+    prep = prepara_gruppi(df_affid_with_stat, modelli_topN, "stat")
+    # Salta i gruppi con pochissimi dati (meno di 10 unità)
+    groups = _gruppi_da_prep(prep, "Modello: {modello} - Gruppo STAT: {code}", min_peso=10)
+
+    # Salva i risultati indicizzati per codice STAT
+    predizioni_json = _precompute_groups(
+        groups, "stat_code", False, mesi_grid, giorni_grid, riskset_threshold,
+        n_workers, chunksize, seed, previous, label="Gruppo STAT", band_method=band_method
+    )
     for modello in modelli_topN:
-        print(f'\nINIZIO MODELLO {modello} (per STAT)')
-        predizioni_json[modello] = {}
-        df_mod = df_filtered[df_filtered["Modello"] == modello]
-        
-        stat_codes = df_mod["stat"].unique()
-
-        for stat_code in stat_codes:
-            stat_counter += 1
-            print(f"Gruppo STAT {stat_counter}/{total_stats}: {modello} - {stat_code}")
-            
-            dati = df_mod[df_mod['stat'] == stat_code]
-            if len(dati) < 10: # Salta se ci sono pochissimi dati
-                continue
-
-            T = dati['Tempo di Vita'].clip(upper=1095).values
-            E = np.where(dati['Tempo di Vita'] > 1095, 1, dati['Censura']).astype(int)
-            risk_set = compute_riskset(T, mesi_grid)
-            reliable_months = np.where(risk_set >= riskset_threshold)[0]
-            last_reliable_month = int(reliable_months[-1]) if len(reliable_months)>0 else 0
-
-            # Kaplan-Meier (codice identico a prima)
-            kmf = KaplanMeierFitter()
-            kmf.fit(T, event_observed=1-E)
-            surv_func = kmf.survival_function_
-            ci = kmf.confidence_interval_
-            ultima_rottura = T[(E == 0)].max() if (E == 0).sum() > 0 else 0
-            km_grid = giorni_grid[giorni_grid <= ultima_rottura]
-            f_surv = interp1d(surv_func.index, surv_func.values.flatten(), bounds_error=False, fill_value=(1,surv_func.values[-1]))
-            surv_km = f_surv(km_grid)
-            f_surv_all = interp1d(surv_func.index, surv_func.values.flatten(), bounds_error=False, fill_value=(1, surv_func.values[-1]))
-            km_surv = f_surv_all(giorni_grid)
-            f_lower = interp1d(ci.index, ci.iloc[:,0].values, bounds_error=False, fill_value=(1,ci.iloc[-1,0]))
-            f_upper = interp1d(ci.index, ci.iloc[:,1].values, bounds_error=False, fill_value=(1,ci.iloc[-1,1]))
-            km_ci_lower = f_lower(giorni_grid)
-            km_ci_upper = f_upper(giorni_grid)
-
-            # Grid search per Weibull (codice identico a prima)
-            k_prior_grid = np.linspace(1.0, 1.2, 6)
-            lambda_prior_grid = np.linspace(np.percentile(T,60), np.percentile(T,90), 8)
-            (best_kprior, best_lambdaprior), k_map, lam_map = best_prior_weibull(
-                T, E, km_grid, surv_km, k_prior_grid, lambda_prior_grid
-            )
-            weibull_surv = np.exp(- (giorni_grid / lam_map)**k_map)
-            weibull_lower, weibull_upper = weibull_confidence_bands(T, E, k_map, lam_map, giorni_grid, n_boot=200)
-
-            # Previsioni (codice identico a prima)
-            predizioni = {}
-            for mesi in [12, 24, 36, last_reliable_month]:
-                # ... (stesso codice di calcolo previsioni)
-                idx = int(np.searchsorted(mesi_grid, mesi))
-                if idx < len(weibull_surv):
-                    prob_rott = 1 - weibull_surv[idx]
-                    prob_rott_low = 1 - weibull_upper[idx]
-                    prob_rott_up  = 1 - weibull_lower[idx]
-                    predizioni[f"prev{mesi}"] = float(prob_rott)
-                    predizioni[f"prev{mesi}_lower"] = float(prob_rott_low)
-                    predizioni[f"prev{mesi}_upper"] = float(prob_rott_up)
-            predizioni["ultimo_mese_affidabile"] = int(last_reliable_month)
-
-            # Plot e salva grafico
-            fig = plt.figure(figsize=(9,5))
-            plt.step(mesi_grid, km_surv, label='Kaplan-Meier', where='post', color='C0')
-            plt.fill_between(mesi_grid, km_ci_lower, km_ci_upper, color='C0', alpha=0.20, step='post', label='KM 95% CI')
-            plt.plot(mesi_grid, weibull_surv, 'r--', label='Weibull tuned')
-            plt.fill_between(mesi_grid, weibull_lower, weibull_upper, color='r', alpha=0.15, label='Weibull 95% CI')
-            plt.axvline(last_reliable_month, color='orange', linestyle='-.', label=f'Stima affidabile fino a {last_reliable_month} mesi')
-            plt.xlabel("Mesi")
-            plt.ylabel("Probabilità di sopravvivenza")
-            # Titolo del grafico modificato
-            plt.title(f"Modello: {modello} - Gruppo STAT: {stat_code}\nTuning curve")
-            plt.legend()
-            plt.ylim(0.85, 1.01)
-            plt.xlim(0,36)
-            plt.tight_layout()
-            img_path = save_chart(fig, img_dir)
-
-            # Salva i risultati indicizzati per codice STAT
-            predizioni_json[modello][stat_code] = {
-                "stat_code": stat_code,
-                "img_path": img_path,
-                **predizioni
-            }
-
-    print(f"\nCOMPLETATE TUTTE LE PREVISIONI PER STAT: {stat_counter} gruppi elaborati.")
+        predizioni_json.setdefault(modello, {})
+
+    print(f"\nCOMPLETATE TUTTE LE PREVISIONI PER STAT: {len(groups)} gruppi elaborati.")
     return predizioni_json
 
+
+def domanda_flotta(quantita, bom_modello, bom_componente, bom_qta, prob, n_componenti):
+    """
+    Domanda attesa di ricambi per componente su un insieme di ordini, come
+    unico prodotto matrice sparsa x matrice densa.
+
+    Ogni voce BOM (modello, componente, pezzi per modello) vale
+    quantita[modello] * pezzi unità installate; la matrice sparsa
+    componenti x voci BOM le somma per componente, applicata sia alle unità
+    sia alle probabilità di rottura di ogni orizzonte.
+
+    Args:
+        quantita: array (n_modelli,) quantità ordinate per modello
+        bom_modello, bom_componente: array (n_voci,) indici di modello e componente
+        bom_qta: array (n_voci,) pezzi per modello
+        prob: array (n_voci, K) probabilità di rottura per voce BOM e colonna
+              (es. orizzonte / banda); NaN = previsione non disponibile
+        n_componenti: numero di componenti (righe del risultato)
+
+    Returns:
+        tuple (installati (n_componenti,), attesi (n_componenti, K),
+               non_coperti (n_componenti,) unità senza alcuna previsione)
+    """
+    bom_modello = np.asarray(bom_modello, dtype=np.int64)
+    bom_componente = np.asarray(bom_componente, dtype=np.int64)
+    prob = np.asarray(prob, dtype=float).reshape(len(bom_modello), -1)
+
+    unita = np.asarray(quantita, dtype=float)[bom_modello] * np.asarray(bom_qta, dtype=float)
+    somma = sparse.csr_matrix(
+        (unita, (bom_componente, np.arange(len(bom_modello)))),
+        shape=(n_componenti, len(bom_modello))
+    )
+    disponibile = ~np.isnan(prob)
+    installati = np.asarray(somma.sum(axis=1)).ravel()
+    attesi = somma @ np.where(disponibile, prob, 0.0)
+    non_coperti = somma @ (~disponibile.any(axis=1)).astype(float)
+    return installati, np.asarray(attesi), np.asarray(non_coperti).ravel()
@@ -0,0 +1,16 @@
+"""
+Configurazione gunicorn (letta automaticamente dalla cartella di avvio).
+
+Uso:
+    gunicorn --preload -w 4 -b 0.0.0.0:5010 wsgi:app
+
+Con --preload e PREVISIONI_PRELOAD=1 i dati delle previsioni sono caricati
+nel master (wsgi.py); watcher dei file sorgente e coda previsioni sono
+thread e vanno avviati in ogni worker dopo il fork.
+"""
+
+
+def post_fork(server, worker):
+    from routes.previsioni import avvia_thread_background
+
+    avvia_thread_background()
@@ -103,9 +103,44 @@ def build_df_componenti(modelli, json_per_data):
 #     return pd.DataFrame(records)
 
 
+def _assegna_fifo_gruppo(lot_dates, lot_residui, rott_dates):
+    """
+    Pointer walk FIFO per un singolo (Modello, Codice Componente).
+
+    lot_dates/lot_residui: lotti ordinati per data acquisto (solo date valide e residuo > 0)
+    rott_dates: date di apertura delle rotture nell'ordine del file (solo date valide)
+
+    Ogni rottura prende il lotto più vecchio con residuo > 0 se acquistato entro
+    la data rottura: i lotti esauriti sono quindi sempre un prefisso di quelli
+    ordinati e basta un puntatore. Ritorna la posizione del lotto per ogni
+    rottura (-1 = nessun lotto disponibile) e il residuo aggiornato.
+    """
+    residui = list(lot_residui)
+    assegnati = [-1] * len(rott_dates)
+    n_lotti = len(lot_dates)
+    p = 0
+    for i, data in enumerate(rott_dates):
+        if p >= n_lotti:
+            break
+        if lot_dates[p] <= data:
+            assegnati[i] = p
+            residui[p] -= 1
+            if residui[p] <= 0:
+                p += 1
+    return assegnati, residui
+
 def build_df_affid(df_componenti, df_rotture, data_censura="2024-12-31"):
     """
     Costruisce il dataset di affidabilità (eventi/censure) partendo dalle componenti e dalle rotture note.
+
+    Le rotture sono associate ai lotti in ordine FIFO (lotto più vecchio con residuo,
+    acquistato entro la data rottura), elaborando le rotture nell'ordine del file.
+    L'assegnazione è fatta per gruppo (Modello, Codice Componente) con un pointer
+    walk sui lotti ordinati una sola volta: O(rotture + lotti) invece di un filtro
+    sull'intero stock per ogni rottura.
+
+    Ogni riga ha un "Peso" (numero di unità rappresentate): 1 per le rotture,
+    il residuo del lotto per le censure, che quindi occupano una riga per lotto.
     """
     df_componenti = df_componenti.copy()
     df_rotture = df_rotture.copy()
@@ -113,64 +148,90 @@ def build_df_affid(df_componenti, df_rotture, data_censura="2024-12-31"):
     df_rotture["Data Apertura"] = pd.to_datetime(df_rotture["Data Apertura"], dayfirst=True, errors="coerce")
     modelli = df_componenti["Modello"].unique().tolist()
     df_rotture2 = df_rotture[df_rotture["Modello"].isin(modelli)]
-    records = []
     stock = df_componenti.copy()
     stock["Residuo"] = stock["Quantità"]
 
-    # Associa rottura a lotto di produzione (FIFO)
-    for idx, rottura in df_rotture2.iterrows():
-        modello = rottura["Modello"]
-        codice = rottura["Codice Componente"]
-        data_rottura = rottura["Data Apertura"]
-        possibili = stock[
-            (stock["Modello"] == modello) &
-            (stock["Codice Componente"] == codice) &
-            (stock["Data Acquisto"] <= data_rottura) &
-            (stock["Residuo"] > 0)
-        ].sort_values("Data Acquisto")
-        if len(possibili) == 0:
+    # Lotti utilizzabili ordinati per data (stabile: a parità di data vince l'ordine originale)
+    stock_pos = np.arange(len(stock))
+    lotti = stock.assign(_pos=stock_pos)
+    lotti = lotti[lotti["Data Acquisto"].notna() & (lotti["Residuo"] > 0)]
+    lotti = lotti.sort_values("Data Acquisto", kind="stable")
+    lotti_per_gruppo = lotti.groupby(["Modello", "Codice Componente"], sort=False).indices
+
+    rotture_valide = df_rotture2[df_rotture2["Data Apertura"].notna()]
+    rotture_per_gruppo = rotture_valide.groupby(["Modello", "Codice Componente"], sort=False).indices
+
+    lot_dates_all = lotti["Data Acquisto"].values
+    lot_res_all = lotti["Residuo"].values
+    lot_pos_all = lotti["_pos"].values
+    rott_dates_all = rotture_valide["Data Apertura"].values
+
+    residui = stock["Residuo"].to_numpy(dtype=float, copy=True)
+    rott_idx = []
+    rott_lotto = []
+    for chiave, idx_rott in rotture_per_gruppo.items():
+        idx_lotti = lotti_per_gruppo.get(chiave)
+        if idx_lotti is None:
             continue
-        idx_disp = possibili.index[0]
-        stock.at[idx_disp, "Residuo"] -= 1
-        data_acq = stock.at[idx_disp, "Data Acquisto"]
-        tempo_vita = (data_rottura - data_acq).days
-        records.append({
-            "Modello": modello,
-            "Codice Componente": codice,
-            "Data Acquisto": data_acq,
-            "Data Rottura": data_rottura,
-            "Tempo di Vita": tempo_vita,
-            "Censura": 0  # Evento osservato (rottura)
-        })
+        assegnati, residui_gruppo = _assegna_fifo_gruppo(
+            lot_dates_all[idx_lotti].tolist(),
+            lot_res_all[idx_lotti].tolist(),
+            rott_dates_all[idx_rott].tolist()
+        )
+        residui[lot_pos_all[idx_lotti]] = residui_gruppo
+        assegnati = np.asarray(assegnati)
+        ok = assegnati >= 0
+        rott_idx.append(idx_rott[ok])
+        rott_lotto.append(lot_pos_all[idx_lotti][assegnati[ok]])
+    stock["Residuo"] = residui
+
+    # Record rotture (Censura=0) nell'ordine del file
+    if rott_idx:
+        rott_idx = np.concatenate(rott_idx)
+        rott_lotto = np.concatenate(rott_lotto)
+    else:
+        rott_idx = np.array([], dtype=int)
+        rott_lotto = np.array([], dtype=int)
+    ordine = np.argsort(rott_idx, kind="stable")
+    rott_idx, rott_lotto = rott_idx[ordine], rott_lotto[ordine]
+    rotture_assegnate = rotture_valide.iloc[rott_idx]
+    data_acq = stock["Data Acquisto"].values[rott_lotto]
+    df_eventi = pd.DataFrame({
+        "Modello": rotture_assegnate["Modello"].values,
+        "Codice Componente": rotture_assegnate["Codice Componente"].values,
+        "Data Acquisto": data_acq,
+        "Data Rottura": rotture_assegnate["Data Apertura"].values,
+        "Tempo di Vita": (rotture_assegnate["Data Apertura"].values - data_acq).astype("timedelta64[D]").astype(int),
+        "Censura": 0,  # Evento osservato (rottura)
+        "Peso": 1
+    })
 
     # Inserisci componenti censurate (non rotte al 31/12/2024) - OTTIMIZZATO
     data_censura = pd.to_datetime(data_censura, errors='coerce')
-																
-    
+
     # Filtra e prepara dati in bulk
     stock_censured = stock[stock["Residuo"] > 0].copy()
     stock_censured["Data Acquisto"] = pd.to_datetime(stock_censured["Data Acquisto"], errors='coerce')
     stock_censured = stock_censured.dropna(subset=["Data Acquisto"])
     stock_censured["Tempo di Vita"] = (data_censura - stock_censured["Data Acquisto"]).dt.days
     stock_censured = stock_censured[stock_censured["Tempo di Vita"] >= 0]
-    
-    # Espandi righe in base a Residuo
-    for _, row in stock_censured.iterrows():
-        residuo = int(row["Residuo"])
-        if residuo <= 0:
-            continue
-        # Batch append per performance
-        batch = [{
-            "Modello": row["Modello"],
-            "Codice Componente": row["Codice Componente"],
-            "Data Acquisto": row["Data Acquisto"],
-            "Data Rottura": None,
-            "Tempo di Vita": row["Tempo di Vita"],
-            "Censura": 1
-        } for _ in range(residuo)]
-        records.extend(batch)
-    
-    return pd.DataFrame(records)
+
+    # Una riga per lotto con il residuo come peso (invece di una riga per unità)
+    residuo = stock_censured["Residuo"].astype(int).clip(lower=0)
+    stock_censured = stock_censured[residuo > 0]
+    df_censure = pd.DataFrame({
+        "Modello": stock_censured["Modello"].values,
+        "Codice Componente": stock_censured["Codice Componente"].values,
+        "Data Acquisto": stock_censured["Data Acquisto"].values,
+        "Data Rottura": pd.NaT,
+        "Tempo di Vita": stock_censured["Tempo di Vita"].values,
+        "Censura": 1,
+        "Peso": residuo[residuo > 0].values
+    })
+
+    if df_eventi.empty and df_censure.empty:
+        return pd.DataFrame()
+    return pd.concat([df_eventi, df_censure], ignore_index=True)
 
 def tronca_affidabilita(df_affid, max_mesi=36):
     """
@@ -9,6 +9,8 @@ from models import db, FileAnagrafica, Modello, Componente, ModelloComponente, T
 from forms import AnagraficaFileForm, AnagraficaFileEditForm, NuovaMarcaForm
 from utils.decorators import admin_required
 from utils.db_log import log_session  # Sessione separata per log (AUTONOMOUS TRANSACTION)
+from utils.dim_cache import DimensionCache
+from utils.trace_writer import TraceWriter
 import os
 import shutil
 import random
@@ -413,6 +415,8 @@ def elabora_anagrafica(anagrafica_id):
         return False, f'Errore generazione TSV: {str(e)}'
 
     # ✅ STEP 4: Leggi TSV ed elabora dati
+    # Dettagli trace bufferizzati: INSERT a blocchi sulla log_session
+    trace = TraceWriter(log_session, TraceElabDett, trace_start.id_trace)
     try:
         righe_totali = 0
         righe_ok = 0
@@ -425,7 +429,14 @@ def elabora_anagrafica(anagrafica_id):
         relazioni_create = set()
 
         with open(tsv_path, 'r', encoding='utf-8') as f:
-            reader = csv.DictReader(f, delimiter='\t')
+            reader = list(csv.DictReader(f, delimiter='\t'))
+
+            # Cache dimensioni del run: modelli, componenti e relazioni del file letti con query IN
+            cache = DimensionCache(db.session)
+            codici = [(row.get('modello', '').strip(), row.get('M&C code', '').strip()) for row in reader]
+            cache.precarica(Modello, 'cod_modello', [m for m, c in codici if m and c])
+            cache.precarica(Componente, 'cod_componente_norm', [normalize_code(c) for m, c in codici if m and c])
+            cache.precarica(ModelloComponente, 'cod_modello_componente', [f"{m}|{c}" for m, c in codici if m and c])
 
             for idx, row in enumerate(reader, start=1):
                 righe_totali += 1
@@ -443,18 +454,16 @@ def elabora_anagrafica(anagrafica_id):
                     if not cod_modello or not cod_componente:
                         savepoint.rollback()
                         righe_warning += 1
-                        trace_dett = TraceElabDett(
-                            id_trace=trace_start.id_trace,
+                        trace.aggiungi(
                             record_pos=idx,
                             record_data={'modello': cod_modello, 'componente': cod_componente},
                             stato='WARN',
                             messaggio='Modello o componente mancante'
                         )
-                        log_session.add(trace_dett)
                         continue
 
                     # UPDATE modello (cod_modello_fabbrica)
-                    modello = Modello.query.filter_by(cod_modello=cod_modello).first()
+                    modello = cache.get(Modello, 'cod_modello', cod_modello)
                     if modello:
                         if cod_modello_fabbrica:
                             modello.cod_modello_fabbrica = cod_modello_fabbrica
@@ -464,8 +473,7 @@ def elabora_anagrafica(anagrafica_id):
                             modelli_aggiornati.add(cod_modello)
 
                             # Trace UPDATE modello
-                            trace_dett = TraceElabDett(
-                                id_trace=trace_start.id_trace,
+                            trace.aggiungi(
                                 record_pos=idx,
                                 record_data={
                                     'tipo': 'UPDATE_MODELLO',
@@ -475,21 +483,18 @@ def elabora_anagrafica(anagrafica_id):
                                 stato='OK',
                                 messaggio=f'Aggiornato modello {cod_modello} con cod_modello_fabbrica'
                             )
-                            log_session.add(trace_dett)
                     else:
                         righe_warning += 1
-                        trace_dett = TraceElabDett(
-                            id_trace=trace_start.id_trace,
+                        trace.aggiungi(
                             record_pos=idx,
                             record_data={'modello': cod_modello},
                             stato='WARN',
                             messaggio=f'Modello {cod_modello} non trovato nel DB'
                         )
-                        log_session.add(trace_dett)
 
                     # CREATE/UPDATE componente
                     cod_componente_norm = normalize_code(cod_componente)
-                    componente = Componente.query.filter_by(cod_componente_norm=cod_componente_norm).first()
+                    componente = cache.get(Componente, 'cod_componente_norm', cod_componente_norm)
 
                     if componente:
                         # UPDATE
@@ -523,8 +528,7 @@ def elabora_anagrafica(anagrafica_id):
                         componenti_aggiornati.add(cod_componente)
 
                         # Trace UPDATE componente
-                        trace_dett = TraceElabDett(
-                            id_trace=trace_start.id_trace,
+                        trace.aggiungi(
                             record_pos=idx,
                             record_data={
                                 'tipo': 'UPDATE_COMPONENTE',
@@ -534,7 +538,6 @@ def elabora_anagrafica(anagrafica_id):
                             stato='OK',
                             messaggio=f'Aggiornato componente {cod_componente}'
                         )
-                        log_session.add(trace_dett)
                     else:
                         # CREATE
                         try:
@@ -569,11 +572,11 @@ def elabora_anagrafica(anagrafica_id):
                                 pass
 
                             db.session.add(componente)
+                            cache.aggiungi(componente)
                             componenti_creati.add(cod_componente)
 
                             # Trace CREATE componente
-                            trace_dett = TraceElabDett(
-                                id_trace=trace_start.id_trace,
+                            trace.aggiungi(
                                 record_pos=idx,
                                 record_data={
                                     'tipo': 'CREATE_COMPONENTE',
@@ -583,17 +586,14 @@ def elabora_anagrafica(anagrafica_id):
                                 stato='OK',
                                 messaggio=f'Creato nuovo componente {cod_componente}'
                             )
-                            log_session.add(trace_dett)
                         except Exception as e:
                             righe_errore += 1
-                            trace_dett = TraceElabDett(
-                                id_trace=trace_start.id_trace,
+                            trace.aggiungi(
                                 record_pos=idx,
                                 record_data={'componente': cod_componente},
                                 stato='KO',
                                 messaggio=f'Errore creazione componente: {str(e)}'
                             )
-                            log_session.add(trace_dett)
                             continue
 
                     # CREATE modello_componente (relazione)
@@ -601,9 +601,7 @@ def elabora_anagrafica(anagrafica_id):
                         cod_modello_componente = f"{cod_modello}|{cod_componente}"
 
                         # Verifica se esiste già
-                        existing_rel = ModelloComponente.query.filter_by(
-                            cod_modello_componente=cod_modello_componente
-                        ).first()
+                        existing_rel = cache.get(ModelloComponente, 'cod_modello_componente', cod_modello_componente)
 
                         if not existing_rel:
                             relazione = ModelloComponente(
@@ -615,11 +613,11 @@ def elabora_anagrafica(anagrafica_id):
                                 created_by=current_user.id
                             )
                             db.session.add(relazione)
+                            cache.aggiungi(relazione)
                             relazioni_create.add(cod_modello_componente)
 
                             # Trace CREATE relazione modello-componente
-                            trace_dett = TraceElabDett(
-                                id_trace=trace_start.id_trace,
+                            trace.aggiungi(
                                 record_pos=idx,
                                 record_data={
                                     'tipo': 'CREATE_RELAZIONE',
@@ -630,7 +628,6 @@ def elabora_anagrafica(anagrafica_id):
                                 stato='OK',
                                 messaggio=f'Creata relazione {cod_modello}|{cod_componente} (qtà: {qta})'
                             )
-                            log_session.add(trace_dett)
 
                     righe_ok += 1
 
@@ -641,14 +638,12 @@ def elabora_anagrafica(anagrafica_id):
                     # Rollback del savepoint (annulla operazioni per questa riga ma continua con le altre)
                     savepoint.rollback()
                     righe_errore += 1
-                    trace_dett = TraceElabDett(
-                        id_trace=trace_start.id_trace,
+                    trace.aggiungi(
                         record_pos=idx,
                         record_data={'row': str(row)[:100]},
                         stato='KO',
                         messaggio=f'Errore elaborazione riga: {str(e)}'
                     )
-                    log_session.add(trace_dett)
                     logger.error(f"[ELAB ANA] Errore riga {idx}: {str(e)}")
 
         # ALL OR NOTHING: committa dati business SOLO se nessun errore
@@ -657,6 +652,7 @@ def elabora_anagrafica(anagrafica_id):
 
     except Exception as e:
         db.session.rollback()
+        trace.chiudi()  # Dettagli accumulati fino all'errore
         trace_end = TraceElab(
             id_elab=id_elab,
             id_file=anagrafica_id,
@@ -699,9 +695,8 @@ def elabora_anagrafica(anagrafica_id):
             # Sposta file da INPUT a OUTPUT
             shutil.move(anagrafica.filepath, new_filepath)
 
-            # Commit warning log già creati durante elaborazione
-            if righe_warning > 0:
-                log_session.commit()  # ← AUTONOMOUS: Warning log persistiti
+            # Flush dei dettagli ancora nel buffer
+            trace.chiudi()  # ← AUTONOMOUS: dettagli persistiti
 
             # Crea trace END con successo (LOG SESSION)
             trace_end = TraceElab(
@@ -740,6 +735,7 @@ def elabora_anagrafica(anagrafica_id):
 
         except Exception as e:
             # Errore durante lo spostamento (LOG SESSION)
+            trace.chiudi()
             trace_end = TraceElab(
                 id_elab=id_elab,
                 id_file=anagrafica_id,
@@ -769,8 +765,8 @@ def elabora_anagrafica(anagrafica_id):
         db.session.rollback()
         logger.warning(f"[ELAB ANA] Rollback dati business: {righe_errore} righe con errori")
 
-        # Commit error/warning log già creati durante elaborazione
-        log_session.commit()  # ← AUTONOMOUS: Error log persistiti
+        # Flush dei dettagli errore/warning ancora nel buffer
+        trace.chiudi()  # ← AUTONOMOUS: Error log persistiti
 
         # Crea trace END con errore (LOG SESSION)
         trace_end = TraceElab(
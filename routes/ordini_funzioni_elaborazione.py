@@ -2,8 +2,12 @@
 Funzioni di elaborazione per inserimento ordini da TSV nel database
 """
 from datetime import datetime
+import numpy as np
+import pandas as pd
 from models import db, FileOrdine, Controparte, Modello, Ordine
 from utils.db_log import log_session
+from utils.dim_cache import DimensionCache
+from utils.tsv_validation import valida_a_blocchi, serie_errori, segnala, frame_errori
 import logging
 
 logger = logging.getLogger(__name__)
@@ -16,7 +20,7 @@ def normalizza_codice(codice):
     return str(codice).strip().upper()
 
 
-def upsert_controparte(cod_controparte, controparte_desc, current_user_id=0):
+def upsert_controparte(cod_controparte, controparte_desc, current_user_id=0, cache=None):
     """
     Inserisce o aggiorna una controparte.
 
@@ -24,6 +28,7 @@ def upsert_controparte(cod_controparte, controparte_desc, current_user_id=0):
         cod_controparte: codice controparte
         controparte_desc: descrizione controparte
         current_user_id: ID utente corrente
+        cache: DimensionCache del run (se None ne crea una)
 
     Returns:
         Controparte: oggetto controparte (nuovo o aggiornato)
@@ -31,7 +36,9 @@ def upsert_controparte(cod_controparte, controparte_desc, current_user_id=0):
     cod_norm = normalizza_codice(cod_controparte)
 
     # Cerca per codice
-    controparte = Controparte.query.filter_by(cod_controparte=cod_norm).first()
+    if cache is None:
+        cache = DimensionCache(db.session)
+    controparte = cache.get(Controparte, 'cod_controparte', cod_norm)
 
     if controparte:
         # Record esistente: SEMPRE aggiorna tracciatura (anche se dati non cambiano)
@@ -51,12 +58,13 @@ def upsert_controparte(cod_controparte, controparte_desc, current_user_id=0):
             created_by=current_user_id
         )
         db.session.add(controparte)
+        cache.aggiungi(controparte)
         logger.info(f"Controparte inserita: {cod_norm} -> {controparte_desc}")
 
     return controparte
 
 
-def upsert_modello(model_no, brand=None, current_user_id=0):
+def upsert_modello(model_no, brand=None, current_user_id=0, cache=None):
     """
     Inserisce o aggiorna un modello.
 
@@ -64,6 +72,7 @@ def upsert_modello(model_no, brand=None, current_user_id=0):
         model_no: codice modello
         brand: marca (opzionale)
         current_user_id: ID utente corrente
+        cache: DimensionCache del run (se None ne crea una)
 
     Returns:
         Modello: oggetto modello (nuovo o esistente)
@@ -71,7 +80,9 @@ def upsert_modello(model_no, brand=None, current_user_id=0):
     cod_norm = normalizza_codice(model_no)
 
     # Cerca per codice normalizzato
-    modello = Modello.query.filter_by(cod_modello_norm=cod_norm).first()
+    if cache is None:
+        cache = DimensionCache(db.session)
+    modello = cache.get(Modello, 'cod_modello_norm', cod_norm)
 
     if modello:
         # Record esistente: SEMPRE aggiorna tracciatura (anche se dati non cambiano)
@@ -95,11 +106,84 @@ def upsert_modello(model_no, brand=None, current_user_id=0):
             updated_from='ORD'
         )
         db.session.add(modello)
+        cache.aggiungi(modello)
         logger.info(f"Modello inserito: {model_no} (marca: {brand})")
 
     return modello
 
 
+# Colonne del TSV ordini (ordine di generazione)
+COLONNE_TSV_ORDINE = [
+    'file', 'cod_seller', 'seller', 'cod_buyer', 'buyer', 'date', 'obj', 'po',
+    'brand', 'item', 'ean', 'model_no', 'price', 'qty', 'amount',
+]
+
+# Campi numerici: colonna TSV -> (campo, tipo)
+CAMPI_NUMERICI_ORDINE = {
+    'price': ('prezzo_eur', float),
+    'qty': ('qta', int),
+    'amount': ('importo_eur', float),
+}
+
+
+def _numero(testo, tipo):
+    """Conversione per colonna come float()/int() sulla cella: (valori, maschera non validi)."""
+    pulito = testo.str.strip()
+    if tipo is int:
+        validi = pulito.str.fullmatch(r'[+-]?\d+').fillna(False).astype(bool)
+        messaggio = "invalid literal for int() with base 10: "
+    else:
+        validi = pd.to_numeric(pulito, errors='coerce').notna() | pulito.str.lower().isin(['nan', '+nan', '-nan'])
+        messaggio = "could not convert string to float: "
+    vuoto = testo == ''
+    valori = pd.to_numeric(pulito.where(validi & ~vuoto), errors='coerce')
+    invalidi = ~vuoto & ~validi
+    return (valori.astype('Int64') if tipo is int else valori), invalidi, messaggio + testo.map(repr)
+
+
+def _valida_blocco_ordini(df):
+    """
+    Controlli di formato su un blocco di righe del TSV ordini, nell'ordine
+    storico: numero colonne, model_no, PO, campi numerici.
+    """
+    righe = df[['riga_file', 'n_colonne', 'po', 'brand', 'item', 'ean', 'model_no']].copy()
+    errori = serie_errori(df.index)
+    prefisso = "Riga " + df['riga_file'].astype(str) + ": "
+    segnala(errori, df['n_colonne'] != 15,
+            prefisso + "numero colonne errato (atteso 15, trovato " + df['n_colonne'].astype(str) + ")")
+    segnala(errori, df['model_no'] == '', prefisso + "model_no mancante")
+    segnala(errori, df['po'] == '', prefisso + "numero PO mancante")
+    for colonna, (campo, tipo) in CAMPI_NUMERICI_ORDINE.items():
+        righe[campo], invalidi, messaggio = _numero(df[colonna], tipo)
+        segnala(errori, invalidi, prefisso + "errore parsing numeri (" + messaggio + ")")
+    return righe, errori
+
+
+def valida_ordini(righe_dati, workers=None, chunk_size=None):
+    """
+    Stadio di validazione del TSV ordini (righe già divise per tabulazione),
+    prima di qualunque accesso al database.
+
+    Returns:
+        tuple: (righe valide tipizzate, frame errori riga_file/chiave/messaggio,
+                lista warning su prezzi e quantità negativi)
+    """
+    df = pd.DataFrame([r[:15] + [''] * (15 - len(r)) for r in righe_dati], columns=COLONNE_TSV_ORDINE, dtype=object)
+    df.insert(0, 'riga_file', np.arange(2, len(df) + 2))  # +2 per contare dall'header
+    df.insert(1, 'n_colonne', [len(r) for r in righe_dati])
+
+    righe, errori = valida_a_blocchi(df, _valida_blocco_ordini, workers, chunk_size)
+    pulito = righe[errori.isna()]
+
+    # Warning per dati sospetti (come storicamente: valori non nulli e negativi)
+    prefisso = "Riga " + pulito['riga_file'].astype(str) + ": "
+    avvisi = pd.concat([
+        (prefisso + "prezzo <= 0 (" + pulito['prezzo_eur'].astype(str) + ")")[pulito['prezzo_eur'] < 0],
+        (prefisso + "quantità <= 0 (" + pulito['qta'].astype(str) + ")")[(pulito['qta'] < 0).fillna(False)],
+    ]).sort_index(kind='stable')
+    return pulito, frame_errori(righe, errori, 'po'), avvisi.tolist()
+
+
 def elabora_tsv_ordine(file_ordine_id, tsv_filepath, current_user_id=0):
     """
     Elabora un file TSV ordini e popola il database.
@@ -137,12 +221,32 @@ def elabora_tsv_ordine(file_ordine_id, tsv_filepath, current_user_id=0):
         logger.info(f"Elaborazione TSV: {len(righe_dati)} righe da processare")
 
         # Statistiche
-        num_righe_processate = 0
+        num_righe_processate = len(righe_dati)
         num_righe_ok = 0
-        num_errori = 0
-        num_warnings = 0
-        errori_dettaglio = []
-        warnings_dettaglio = []
+
+        # STEP 0: Validazione di formato su tutto il file, prima di qualunque scrittura
+        righe, errori, warnings_dettaglio = valida_ordini(righe_dati)
+        errori_dettaglio = errori['messaggio'].tolist()
+        num_errori = len(errori_dettaglio)
+        num_warnings = len(warnings_dettaglio)
+
+        if num_errori > 0:
+            stats = {
+                'righe_processate': num_righe_processate,
+                'righe_ok': 0,
+                'errori': num_errori,
+                'warnings': num_warnings,
+                'errori_dettaglio': errori_dettaglio[:20],  # Max 20 per log
+                'warnings_dettaglio': warnings_dettaglio[:20]
+            }
+            logger.warning(f"[ELAB ORD] Validazione fallita: {num_errori} righe con errori su {num_righe_processate} totali (nessuna scrittura)")
+            return False, f"Elaborazione fallita: {num_errori} righe con errori (rollback completo)", stats
+
+        # Cache dimensioni del run: controparti e modelli del file letti con query IN
+        cache = DimensionCache(db.session)
+        cache.precarica(Controparte, 'cod_controparte',
+                        [normalizza_codice(r[i]) for r in righe_dati for i in (1, 3)])
+        cache.precarica(Modello, 'cod_modello_norm', righe['model_no'].map(normalizza_codice))
 
         # Metadati ordine (dalla prima riga)
         if righe_dati:
@@ -156,8 +260,8 @@ def elabora_tsv_ordine(file_ordine_id, tsv_filepath, current_user_id=0):
                 oggetto_ordine = prima_riga[6]
 
                 # STEP 1: Upsert controparti
-                seller = upsert_controparte(cod_seller, seller_desc, current_user_id)
-                buyer = upsert_controparte(cod_buyer, buyer_desc, current_user_id)
+                seller = upsert_controparte(cod_seller, seller_desc, current_user_id, cache)
+                buyer = upsert_controparte(cod_buyer, buyer_desc, current_user_id, cache)
                 db.session.flush()  # Assicura FK disponibili
 
                 # STEP 2: Aggiorna FileOrdine con controparti e metadati
@@ -171,64 +275,16 @@ def elabora_tsv_ordine(file_ordine_id, tsv_filepath, current_user_id=0):
 
                 logger.info(f"FileOrdine aggiornato: seller={seller.cod_controparte}, buyer={buyer.cod_controparte}")
 
-        # STEP 3: Processa righe ordine
-        for idx, riga in enumerate(righe_dati, start=2):  # +2 per contare dall'header
-            num_righe_processate += 1
+        # STEP 3: Carica righe ordine (già validate e tipizzate)
+        for riga in righe.astype(object).where(righe.notna(), None).itertuples(index=False):
+            idx, po, brand, model_no = riga.riga_file, riga.po, riga.brand, riga.model_no
 
             # Crea SAVEPOINT per questa riga (permette rollback parziale)
             savepoint = db.session.begin_nested()
 
             try:
-                if len(riga) != 15:
-                    savepoint.rollback()
-                    errore = f"Riga {idx}: numero colonne errato (atteso 15, trovato {len(riga)})"
-                    errori_dettaglio.append(errore)
-                    num_errori += 1
-                    continue
-
-                # Estrai campi
-                file, cod_seller, seller, cod_buyer, buyer, date_str, obj, po, brand, item, ean, model_no, price_str, qty_str, amount_str = riga
-
-                # Validazioni
-                if not model_no:
-                    savepoint.rollback()
-                    errore = f"Riga {idx}: model_no mancante"
-                    errori_dettaglio.append(errore)
-                    num_errori += 1
-                    continue
-
-                if not po:
-                    savepoint.rollback()
-                    errore = f"Riga {idx}: numero PO mancante"
-                    errori_dettaglio.append(errore)
-                    num_errori += 1
-                    continue
-
-                # Parse numeri
-                try:
-                    price_eur = float(price_str) if price_str else None
-                    qty = int(qty_str) if qty_str else None
-                    amount_eur = float(amount_str) if amount_str else None
-                except ValueError as e:
-                    savepoint.rollback()
-                    errore = f"Riga {idx}: errore parsing numeri ({str(e)})"
-                    errori_dettaglio.append(errore)
-                    num_errori += 1
-                    continue
-
-                # Warning per dati sospetti
-                if price_eur and price_eur <= 0:
-                    warning = f"Riga {idx}: prezzo <= 0 ({price_eur})"
-                    warnings_dettaglio.append(warning)
-                    num_warnings += 1
-
-                if qty and qty <= 0:
-                    warning = f"Riga {idx}: quantità <= 0 ({qty})"
-                    warnings_dettaglio.append(warning)
-                    num_warnings += 1
-
                 # STEP 3A: Upsert modello
-                modello = upsert_modello(model_no, brand, current_user_id)
+                modello = upsert_modello(model_no, brand, current_user_id, cache)
                 db.session.flush()
 
                 # STEP 3B: Inserisci riga ordine
@@ -241,6 +297,7 @@ def elabora_tsv_ordine(file_ordine_id, tsv_filepath, current_user_id=0):
                 ).first()
 
                 if existing:
+                    savepoint.commit()  # Upsert modello confermato, riga ordine saltata
                     warning = f"Riga {idx}: ordine già esistente per PO={po}, modello={model_no} (skip)"
                     warnings_dettaglio.append(warning)
                     num_warnings += 1
@@ -253,11 +310,11 @@ def elabora_tsv_ordine(file_ordine_id, tsv_filepath, current_user_id=0):
                     cod_ordine=po,
                     cod_modello=modello.cod_modello,
                     brand=brand if brand else None,
-                    item=item if item else None,
-                    ean=ean if ean else None,
-                    prezzo_eur=price_eur,
-                    qta=qty,
-                    importo_eur=amount_eur,
+                    item=riga.item if riga.item else None,
+                    ean=riga.ean if riga.ean else None,
+                    prezzo_eur=riga.prezzo_eur,
+                    qta=riga.qta,
+                    importo_eur=riga.importo_eur,
                     created_by=current_user_id
                 )
                 db.session.add(ordine)
@@ -3,17 +3,34 @@ Blueprint per la gestione delle previsioni di affidabilità
 OTTIMIZZATO: Dati caricati solo quando necessario (lazy loading)
 """
 
-from flask import Blueprint, render_template, request, flash, redirect, url_for
-from flask_login import login_required
+from flask import Blueprint, render_template, request, flash, redirect, url_for, send_file, jsonify, abort, current_app
+from flask_login import login_required, current_user
+from utils.decorators import admin_required
+from sqlalchemy import func
+from models import db, Ordine, FileOrdine, ModelloComponente
 import os
 import json
+import time
 import logging
+import tempfile
+from datetime import date, timedelta
+import threading
 import pandas as pd
 import numpy as np
 
 # Importa le funzioni dal tuo codice esistente
 from preprocessing import build_df_componenti, build_df_affid, tronca_affidabilita
-from functions import precompute_all_predictions, precompute_all_predictions_by_stat
+from functions import (
+    precompute_all_predictions, precompute_all_predictions_by_stat, pesi_affid, weighted_percentile,
+    chart_figure, prepara_gruppi, domanda_flotta
+)
+from utils.frame_store import save_frames, load_frames, source_signature
+from utils.chart_cache import get_or_render, CHART_FORMATS
+from utils.table_export import EXPORT_FORMATS, write_xlsx, write_parquet, iter_csv, iter_file_chunks
+from utils.bom_matrix import (
+    build_anagrafica_index, build_bom_index, con_previsioni, voci_modello,
+    righe_anagrafica, valori_anagrafica
+)
 
 # Logger per questo modulo
 logger = logging.getLogger(__name__)
@@ -25,18 +42,36 @@ previsioni_bp = Blueprint('previsioni', __name__)
 # VARIABILI GLOBALI PER CACHE (caricate solo quando necessario)
 # =============================================================================
 
-_data_cache = {
-    'loaded': False,
-    'df_rotture': None,
-    'df_anagrafica': None,
-    'json_data': None,
-    'json_per_data': None,
-    'modelli_topN': None,
-    'df_affid_full': None,
-    'df_affid_troncato_full': None,
-    'precomputed_predictions': None,
-    'precomputed_predictions_stat': None
-}
+def _nuovo_snapshot():
+    """Snapshot vuoto dei dati previsioni."""
+    return {
+        'loaded': False,
+        'versione': None,
+        'signature': None,
+        'df_rotture': None,
+        'df_anagrafica': None,
+        'json_data': None,
+        'json_per_data': None,
+        'modelli': None,
+        'df_affid_full': None,
+        'df_affid_troncato_full': None,
+        'precomputed_predictions': None,
+        'precomputed_predictions_stat': None,
+        'previsioni_precedenti': (None, None),
+        'hist_index': None,
+        'anagrafica': None,
+        'bom': None,
+        'summary_groups': {},
+        'summaries': {}
+    }
+
+
+# Snapshot corrente: costruito per intero e poi pubblicato riassegnando il
+# riferimento, mai modificato dopo la pubblicazione (salvo le cache dei
+# resoconti, che crescono per aggiunta). Anche le previsioni calcolate dopo il
+# caricamento sono pubblicate come nuovo snapshot. Le route leggono _data_cache
+# una volta sola, così una ricarica concorrente non mescola dati vecchi e nuovi.
+_data_cache = _nuovo_snapshot()
 
 # Percorsi dei file (configurabili via variabili d'ambiente)
 BASE_DIR = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
@@ -46,6 +81,35 @@ JSON_PATH = os.environ.get('MODELLI_JSON_PATH') or os.path.join(BASE_DIR, "outpu
 JSON_PERDATA_PATH = os.environ.get('MODELLI_PERDATA_JSON_PATH') or os.path.join(BASE_DIR, "output_modelli_per_data.json")
 PREDICTIONS_PATH = os.path.join(BASE_DIR, "precomputed_predictions.json")
 PREDICTIONS_STAT_PATH = os.path.join(BASE_DIR, "precomputed_predictions_stat.json")
+STORE_PATH = os.environ.get('PREVISIONI_STORE_PATH') or os.path.join(BASE_DIR, "previsioni_store")
+
+# Processi usati per il precalcolo delle previsioni (1 = seriale)
+PREDICTIONS_WORKERS = int(os.environ.get('PREVISIONI_WORKERS', '1'))
+
+# Banda di confidenza Weibull: "bootstrap" (campionamento) o "delta" (analitica)
+PREDICTIONS_BAND_METHOD = os.environ.get('PREVISIONI_BAND_METHOD', 'bootstrap')
+
+# Modelli coperti dalle previsioni: tutti quelli con almeno MODELLI_MIN_ROTTURE rotture
+# (ordinati per numero di rotture), al massimo MODELLI_MAX (0 = nessun limite)
+MODELLI_MIN_ROTTURE = int(os.environ.get('PREVISIONI_MIN_ROTTURE', '1'))
+MODELLI_MAX = int(os.environ.get('PREVISIONI_MAX_MODELLI', '0'))
+# Modelli (i più rotti) con previsioni calcolate durante il caricamento; gli
+# altri sono calcolati da una coda in background o alla prima richiesta
+MODELLI_PRECALCOLO = int(os.environ.get('PREVISIONI_MODELLI_PRECALCOLO', '2'))
+# Modelli calcolati per ogni passo della coda e ogni quanti modelli salvare i JSON
+CODA_BATCH = 5
+CODA_SALVATAGGIO = 50
+
+# Cache dei grafici generati su richiesta (LRU con limite di dimensione)
+CHART_DIR = os.environ.get('PREVISIONI_CHART_DIR') or os.path.join(BASE_DIR, "static", "pred_charts")
+CHART_CACHE_MAX_MB = int(os.environ.get('PREVISIONI_CHART_CACHE_MB', '200'))
+
+# Intervallo (secondi) di controllo dei file sorgente per la ricarica automatica (0 = disattiva)
+WATCH_INTERVAL = float(os.environ.get('PREVISIONI_WATCH_INTERVAL', '60'))
+
+# Sorgente modelli/quantità per /da-ordine: "db" (tabelle ordini), "excel"
+# (Excel ordini offline) o "auto" (DB se l'ordine è stato elaborato, altrimenti Excel)
+ORDERS_SOURCE = os.environ.get('PREVISIONI_ORDINI_SOURCE', 'auto')
 
 # File richiesti per il funzionamento del modulo previsioni
 REQUIRED_FILES = {
@@ -80,279 +144,872 @@ def validate_required_files():
     logger.info("✓ Tutti i file richiesti sono presenti")
     return True, None
 
-# =============================================================================
-# FUNZIONE DI CARICAMENTO LAZY
-# =============================================================================
+def _load_json_if_exists(path):
+    """Legge un JSON se presente e valido, altrimenti None."""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"JSON non leggibile, verrà ricalcolato: {path} ({e})")
+        return None
 
-def load_data_if_needed():
+
+def _save_json_atomic(obj, path):
     """
-    Carica i dati solo se non sono già in cache
-    Questa funzione viene chiamata solo quando si visita /previsioni
+    Scrive il JSON su file temporaneo e lo rinomina (mai file a metà).
+    Il temporaneo ha nome univoco: coda previsioni, ricarica e altri worker
+    possono salvare lo stesso file in contemporanea.
     """
-    if _data_cache['loaded']:
-        return  # Dati già caricati, skip
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp",
+                                    dir=os.path.dirname(path) or ".")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(obj, f, indent=2)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
 
-    logger.info("🔄 [PREVISIONI] Caricamento dati in corso...")
+def _store_signature():
+    """Signature dei file sorgente usata per validare lo store colonnare."""
+    return source_signature(list(REQUIRED_FILES.values()),
+                            min_rotture=MODELLI_MIN_ROTTURE, max_modelli=MODELLI_MAX)
 
-    # Valida che tutti i file richiesti esistano
-    files_ok, error_msg = validate_required_files()
-    if not files_ok:
-        logger.error(error_msg)
-        raise FileNotFoundError(error_msg)
+
+def _load_json_sources(snapshot):
+    with open(JSON_PATH, "r") as f:
+        snapshot['json_data'] = json.load(f)
+    with open(JSON_PERDATA_PATH, "r") as f:
+        snapshot['json_per_data'] = json.load(f)
+
+
+def seleziona_modelli(df_rotture, json_per_data):
+    """
+    Modelli con storico rotture e lotti di produzione, ordinati per numero di
+    rotture decrescente e filtrati secondo MODELLI_MIN_ROTTURE / MODELLI_MAX.
+    """
+    rotture_per_modello = df_rotture.groupby("Modello").size().sort_values(ascending=False, kind="stable")
+    modelli = [
+        m for m, n in rotture_per_modello.items()
+        if n >= MODELLI_MIN_ROTTURE and m in json_per_data
+    ]
+    return modelli[:MODELLI_MAX] if MODELLI_MAX > 0 else modelli
+
+
+def build_previsioni_store(signature=None, snapshot=None):
+    """
+    Legge i file sorgente (Excel + JSON), prepara df_affid_full,
+    df_affid_troncato_full e anagrafica e li salva nello store colonnare.
+    Popola con i DataFrame appena costruiti lo snapshot passato (o uno nuovo)
+    e lo ritorna.
+    """
+    if signature is None:
+        files_ok, error_msg = validate_required_files()
+        if not files_ok:
+            raise FileNotFoundError(error_msg)
+        signature = _store_signature()
+    if snapshot is None:
+        snapshot = _nuovo_snapshot()
 
     # Caricamento dati grezzi
     try:
-        _data_cache['df_rotture'] = pd.read_excel(ROTTURE_PATH)
-        _data_cache['df_anagrafica'] = pd.read_excel(ANAGRAFICA_PATH)
+        snapshot['df_rotture'] = pd.read_excel(ROTTURE_PATH)
+        snapshot['df_anagrafica'] = pd.read_excel(ANAGRAFICA_PATH)
     except Exception as e:
         logger.error(f"Errore durante lettura file Excel: {e}", exc_info=True)
         raise
 
-    with open(JSON_PATH, "r") as f:
-        _data_cache['json_data'] = json.load(f)
-    with open(JSON_PERDATA_PATH, "r") as f:
-        _data_cache['json_per_data'] = json.load(f)
+    _load_json_sources(snapshot)
 
     logger.info("✓ [PREVISIONI] Dati grezzi caricati")
 
     # Preparazione DataFrame di affidabilità
-    rotture_per_modello = _data_cache['df_rotture'].groupby("Modello").size().sort_values(ascending=False)
-    _data_cache['modelli_topN'] = rotture_per_modello.head(2).index.tolist()
-    logger.info(f"✓ [PREVISIONI] Modelli selezionati: {_data_cache['modelli_topN']}")
+    # Un solo passaggio raggruppato per tutti i modelli (FIFO vettorizzato per gruppo)
+    snapshot['modelli'] = seleziona_modelli(snapshot['df_rotture'], snapshot['json_per_data'])
+    logger.info(f"✓ [PREVISIONI] Modelli selezionati: {len(snapshot['modelli'])}")
 
-    df_componenti_full = build_df_componenti(_data_cache['modelli_topN'], _data_cache['json_per_data'])
-    _data_cache['df_affid_full'] = build_df_affid(df_componenti_full, _data_cache['df_rotture'])
+    df_componenti_full = build_df_componenti(snapshot['modelli'], snapshot['json_per_data'])
+    snapshot['df_affid_full'] = build_df_affid(df_componenti_full, snapshot['df_rotture'])
 
     # Aggiungi colonna 'stat'
-    codice_to_stat_map = _data_cache['df_anagrafica'].drop_duplicates(subset=['codice']).set_index('codice')['stat'].to_dict()
-    _data_cache['df_affid_full']['stat'] = _data_cache['df_affid_full']['Codice Componente'].map(codice_to_stat_map)
-    _data_cache['df_affid_troncato_full'] = tronca_affidabilita(_data_cache['df_affid_full'], max_mesi=36)
+    codice_to_stat_map = snapshot['df_anagrafica'].drop_duplicates(subset=['codice']).set_index('codice')['stat'].to_dict()
+    snapshot['df_affid_full']['stat'] = snapshot['df_affid_full']['Codice Componente'].map(codice_to_stat_map)
+    snapshot['df_affid_troncato_full'] = tronca_affidabilita(snapshot['df_affid_full'], max_mesi=36)
 
     logger.info("✓ [PREVISIONI] Preparazione dati completata")
 
-    # Caricamento o calcolo previsioni
-    if not os.path.exists(PREDICTIONS_PATH):
-        logger.info("⚙️ [PREVISIONI] Calcolo previsioni per COMPONENTE...")
-        predizioni_json = precompute_all_predictions(
-            df_affid=_data_cache['df_affid_troncato_full'],
-            modelli_topN=_data_cache['modelli_topN'],
-            img_dir="static/pred_charts"
-        )
-        with open(PREDICTIONS_PATH, "w") as f:
-            json.dump(predizioni_json, f, indent=2)
-        logger.info("✓ [PREVISIONI] Predizioni per componente salvate")
-
-    with open(PREDICTIONS_PATH, "r") as f:
-        _data_cache['precomputed_predictions'] = json.load(f)
-
-    if not os.path.exists(PREDICTIONS_STAT_PATH):
-        logger.info("⚙️ [PREVISIONI] Calcolo previsioni per GRUPPO STAT...")
-        predizioni_stat_json = precompute_all_predictions_by_stat(
-            df_affid_with_stat=_data_cache['df_affid_troncato_full'],
-            modelli_topN=_data_cache['modelli_topN'],
-            img_dir="static/pred_charts_stat"
+    try:
+        save_frames(
+            STORE_PATH,
+            {
+                'df_affid_full': snapshot['df_affid_full'],
+                'df_affid_troncato_full': snapshot['df_affid_troncato_full'],
+                'df_anagrafica': snapshot['df_anagrafica'],
+            },
+            signature,
+            extra={'modelli': snapshot['modelli']}
         )
-        with open(PREDICTIONS_STAT_PATH, "w") as f:
-            json.dump(predizioni_stat_json, f, indent=2)
-        logger.info("✓ [PREVISIONI] Predizioni per STAT salvate")
+        logger.info(f"✓ [PREVISIONI] Store colonnare salvato: {STORE_PATH}")
+    except Exception as e:
+        # Lo store è solo un'accelerazione: se non si riesce a scrivere si prosegue
+        logger.warning(f"Impossibile salvare lo store colonnare: {e}", exc_info=True)
 
-    with open(PREDICTIONS_STAT_PATH, "r") as f:
-        _data_cache['precomputed_predictions_stat'] = json.load(f)
+    return snapshot
+
+# =============================================================================
+# FUNZIONE DI CARICAMENTO LAZY
+# =============================================================================
+
+# Un solo caricamento alla volta (single-flight): le richieste concorrenti
+# attendono il caricamento in corso invece di ripeterlo
+_load_lock = threading.Lock()
+_load_start_lock = threading.Lock()
+_watcher_lock = threading.Lock()
+_watcher_thread = None
+
+# Stato del caricamento, esposto dall'endpoint /previsioni/stato
+_load_status = {
+    'stato': 'non_caricato',  # non_caricato | in_caricamento | pronto | errore
+    'fase': None,
+    'completamento': 0.0,
+    'errore': None,
+    'avviato': None,
+    'completato': None,
+    'versione': None,          # Timestamp dello snapshot servito
+    'in_ricarica': False,      # Ricarica in corso (lo snapshot attuale resta servito)
+    'errore_ricarica': None,
+    'modelli_totali': 0,       # Modelli coperti dalle previsioni
+    'modelli_calcolati': 0,    # ... di cui con previsioni già calcolate
+}
+
+
+def _set_fase(fase, completamento):
+    _load_status['fase'] = fase
+    _load_status['completamento'] = completamento
+
+
+def load_data_if_needed(avvia_thread=True):
+    """
+    Carica i dati solo se non sono già in cache (bloccante).
+    Thread-safe: se un altro thread sta già caricando, attende che finisca.
+    Con avvia_thread=False non parte nessun thread di background (warm-up
+    nel master prima del fork).
+    """
+    if _data_cache['loaded']:
+        return  # Dati già caricati, skip
+
+    with _load_lock:
+        if _data_cache['loaded']:
+            return  # Caricati da un'altra richiesta mentre attendevamo il lock
+        _carica_e_pubblica(avvia_thread)
+
+
+def reload_data():
+    """
+    Ricarica i dati (bloccante): il nuovo snapshot è costruito mentre quello
+    attuale continua a essere servito e lo sostituisce solo se completo.
+    In caso di errore resta in servizio lo snapshot precedente.
+    """
+    with _load_lock:
+        _carica_e_pubblica()
+
+
+def _carica_e_pubblica(avvia_thread=True):
+    """Costruisce un nuovo snapshot e lo pubblica (con _load_lock acquisito)."""
+    global _data_cache
+    iniziale = not _data_cache['loaded']
+    if iniziale:
+        _load_status.update(stato='in_caricamento', errore=None, avviato=time.time(), completato=None)
+    else:
+        _load_status.update(in_ricarica=True, errore_ricarica=None, avviato=time.time(), completato=None)
+    try:
+        snapshot = _load_data()
+    except Exception as e:
+        if iniziale:
+            _load_status.update(stato='errore', errore=str(e))
+        else:
+            _load_status.update(in_ricarica=False, errore_ricarica=str(e), fase=None, completamento=1.0)
+        raise
+
+    # Pubblicazione atomica: una sola assegnazione del riferimento
+    _data_cache = snapshot
+    _load_status.update(stato='pronto', in_ricarica=False, fase=None, completamento=1.0,
+                        completato=time.time(), versione=snapshot['versione'])
+    _aggiorna_stato_previsioni(snapshot)
+    if avvia_thread:
+        avvia_thread_background()
+
+
+def avvia_thread_background():
+    """
+    Avvia nel processo corrente watcher dei file sorgente e coda previsioni,
+    se i dati sono caricati. Con gunicorn --preload va chiamata nel worker
+    dopo il fork (hook post_fork in gunicorn.conf.py): i thread del master
+    non sopravvivono al fork.
+    """
+    snapshot = _data_cache
+    if not snapshot['loaded']:
+        return
+    _start_watcher()
+    _avvia_coda_previsioni(snapshot)
+
+
+def _start_background(target, name):
+    """Avvia target in un thread di background se nessun caricamento è in corso."""
+    with _load_start_lock:
+        if _load_status['stato'] == 'in_caricamento' or _load_status['in_ricarica'] or _load_lock.locked():
+            return False
+        # Lo stato cambia subito: nessun secondo thread parte
+        if _data_cache['loaded']:
+            _load_status.update(in_ricarica=True, errore_ricarica=None)
+        else:
+            _load_status.update(stato='in_caricamento', errore=None, fase='avvio', completamento=0.0)
+        threading.Thread(target=target, name=name, daemon=True).start()
+    return True
+
+
+def start_background_load():
+    """
+    Avvia il caricamento in un thread di background se non è già in corso.
+
+    Returns:
+        bool: True se i dati sono già pronti, False se il caricamento è in corso
+    """
+    if _data_cache['loaded']:
+        # Dati ereditati dal master (warm-up): i thread partono nel worker
+        avvia_thread_background()
+        return True
+    _start_background(_background_load, 'previsioni-loader')
+    return False
+
+
+def start_background_reload():
+    """
+    Avvia una ricarica in background (hot reload, senza riavvio del processo).
+
+    Returns:
+        bool: True se la ricarica è stata avviata, False se un caricamento è già in corso
+    """
+    return _start_background(_background_reload, 'previsioni-reload')
+
+
+def _background_load():
+    try:
+        load_data_if_needed()
+    except Exception as e:
+        logger.error(f"❌ [PREVISIONI] Caricamento in background fallito: {e}", exc_info=True)
+
+
+def _background_reload():
+    try:
+        reload_data()
+        logger.info("✅ [PREVISIONI] Ricarica completata, nuovo snapshot in servizio")
+    except Exception as e:
+        logger.error(f"❌ [PREVISIONI] Ricarica fallita, resta in servizio lo snapshot precedente: {e}", exc_info=True)
+
+
+def warm_up():
+    """
+    Caricamento anticipato, da chiamare prima del fork dei worker
+    (es. gunicorn --preload): i worker condividono le pagine copy-on-write.
+    Costruisce e pubblica solo lo snapshot: nel master non parte nessun
+    thread e nessun lock resta acquisito al fork. Watcher e coda previsioni
+    partono nei worker (avvia_thread_background).
+    """
+    logger.info("🔥 [PREVISIONI] Warm-up dati prima dell'avvio dei worker")
+    load_data_if_needed(avvia_thread=False)
+
+
+def _signature_previsioni():
+    """Signature dei JSON delle previsioni (scritti anche da altri worker)."""
+    return source_signature([p for p in (PREDICTIONS_PATH, PREDICTIONS_STAT_PATH) if os.path.exists(p)])
+
+
+def _current_signature():
+    """Signature attuale di sorgenti e previsioni, confrontabile con snapshot['signature']."""
+    return {'sorgenti': _store_signature(), 'previsioni': _signature_previsioni()}
+
+
+def _start_watcher():
+    """Avvia (una volta per processo) il thread che controlla i file sorgente."""
+    global _watcher_thread
+    if WATCH_INTERVAL <= 0:
+        return
+    with _watcher_lock:
+        if _watcher_thread is not None and _watcher_thread.is_alive():
+            return
+        _watcher_thread = threading.Thread(target=_watch_sources, name='previsioni-watcher', daemon=True)
+        _watcher_thread.start()
+
+
+def _watch_sources():
+    """
+    Polling dei file sorgente: se la signature cambia rispetto allo snapshot
+    servito e resta stabile per un intero intervallo (file completamente
+    scritti), avvia una ricarica. Una signature la cui ricarica è fallita non
+    viene ritentata finché i file non cambiano di nuovo.
+    """
+    precedente = None
+    fallita = None
+    while True:
+        time.sleep(WATCH_INTERVAL)
+        try:
+            attuale = _current_signature()
+        except OSError:
+            continue  # File in sostituzione: si riprova al prossimo giro
+        attuale = json.loads(json.dumps(attuale, default=str))
+        if attuale == _data_cache['signature'] or attuale == fallita:
+            precedente = None
+            continue
+        if attuale != precedente:
+            precedente = attuale  # Cambiamento rilevato: attende che si stabilizzi
+            continue
+        logger.info("🔁 [PREVISIONI] File sorgente modificati, ricarica in background")
+        try:
+            reload_data()
+        except Exception as e:
+            fallita = attuale
+            logger.error(f"❌ [PREVISIONI] Ricarica automatica fallita: {e}", exc_info=True)
+        precedente = None
 
-    _data_cache['loaded'] = True
-    logger.info("✅ [PREVISIONI] Setup completato e cachato in memoria")
 
 # =============================================================================
-# FUNZIONI HELPER
+# PREVISIONI PER MODELLO (precalcolo parziale, coda in background, calcolo su richiesta)
 # =============================================================================
 
-def get_historical_stats(df, modello, code, group_type="Componente"):
-    """Recupera il numero totale e di rotture per un componente o gruppo STAT."""
-    if group_type == "Componente":
-        data_slice = df[(df["Modello"] == modello) & (df["Codice Componente"] == code)]
-    else:  # group_type == "STAT"
-        data_slice = df[(df["Modello"] == modello) & (df["stat"] == code)]
+# Un solo calcolo di previsioni alla volta (coda e richieste): un modello non
+# viene mai calcolato due volte e le previsioni crescono solo per aggiunta
+_previsioni_lock = threading.Lock()
+_coda_lock = threading.Lock()
+_coda_thread = None
 
-    if data_slice.empty:
-        return {'total': 0, 'broken': 0}
 
-    n_tot = len(data_slice)
-    n_rott = (data_slice["Censura"] == 0).sum()
-    return {'total': n_tot, 'broken': n_rott}
+def _calcola_previsioni_modelli(snapshot, modelli):
+    """
+    Calcola (o riusa dai JSON precedenti) le previsioni per componente e per
+    gruppo STAT dei modelli indicati. Ritorna ({modello: ...}, {modello: ...})
+    senza modificare lo snapshot (vedi _con_previsioni).
+    """
+    if not modelli:
+        return {}, {}
+    prev_comp, prev_stat = snapshot['previsioni_precedenti']
+    df = snapshot['df_affid_troncato_full']
+    comp = precompute_all_predictions(
+        df_affid=df,
+        modelli_topN=modelli,
+        n_workers=PREDICTIONS_WORKERS,
+        previous={m: prev_comp[m] for m in modelli if prev_comp and m in prev_comp},
+        band_method=PREDICTIONS_BAND_METHOD
+    )
+    stat = precompute_all_predictions_by_stat(
+        df_affid_with_stat=df,
+        modelli_topN=modelli,
+        n_workers=PREDICTIONS_WORKERS,
+        previous={m: prev_stat[m] for m in modelli if prev_stat and m in prev_stat},
+        band_method=PREDICTIONS_BAND_METHOD
+    )
+    # Stessi tipi di un JSON riletto da disco (liste, float)
+    comp, stat = json.loads(json.dumps(comp)), json.loads(json.dumps(stat))
+    return {m: comp.get(m, {}) for m in modelli}, {m: stat.get(m, {}) for m in modelli}
 
-def generate_reliability_summary(df, modello, code, group_type="Componente"):
-    """Genera un resoconto testuale delle statistiche di affidabilità storiche."""
-    data_slice = df[(df["Modello"] == modello) & 
-                    ((df["Codice Componente"] == code) if group_type == "Componente" else (df["stat"] == code))]
-    
-    if data_slice.empty:
+
+def _con_previsioni(snapshot, comp, stat):
+    """Nuovo snapshot: quello dato più le previsioni dei modelli appena calcolati."""
+    nuovo = dict(snapshot)
+    nuovo['precomputed_predictions'] = {**(snapshot['precomputed_predictions'] or {}), **comp}
+    nuovo['precomputed_predictions_stat'] = {**(snapshot['precomputed_predictions_stat'] or {}), **stat}
+    if snapshot['bom'] is not None:
+        nuovo['bom'] = con_previsioni(snapshot['bom'], comp, stat)
+    return nuovo
+
+
+def _pubblica_previsioni(snapshot, nuovo):
+    """
+    Pubblica nuovo al posto di snapshot, se questo è ancora lo snapshot servito
+    (sotto _load_lock, come una ricarica). Con una ricarica in corso non
+    pubblica: lo snapshot sta per essere sostituito. True se pubblicato.
+    """
+    global _data_cache
+    if not _load_lock.acquire(blocking=False):
+        return False
+    try:
+        if _data_cache is not snapshot:
+            return False
+        _data_cache = nuovo
+    finally:
+        _load_lock.release()
+    _aggiorna_stato_previsioni(nuovo)
+    return True
+
+
+def _snapshot_corrente(snapshot):
+    """Snapshot servito se è della stessa versione dati di snapshot, altrimenti snapshot."""
+    attuale = _data_cache
+    return attuale if attuale['versione'] == snapshot['versione'] else snapshot
+
+
+def _modelli_mancanti(snapshot, modelli=None):
+    calcolati = snapshot['precomputed_predictions'] or {}
+    selezionati = snapshot['modelli'] or []
+    if modelli is not None:
+        ammessi = set(selezionati)
+        selezionati = [m for m in dict.fromkeys(modelli) if m in ammessi]
+    return [m for m in selezionati if m not in calcolati]
+
+
+def _aggiorna_stato_previsioni(snapshot):
+    if snapshot is _data_cache:
+        _load_status.update(modelli_totali=len(snapshot['modelli'] or []),
+                            modelli_calcolati=len(snapshot['precomputed_predictions'] or {}))
+
+
+def _salva_previsioni(snapshot):
+    """
+    Salva i JSON delle previsioni: quelle calcolate più quelle precedenti
+    ancora valide per i modelli non ancora calcolati (riusabili al riavvio).
+    """
+    calcolate = (snapshot['precomputed_predictions'], snapshot['precomputed_predictions_stat'])
+    selezionati = set(snapshot['modelli'] or [])
+    for path, nuove, precedenti in zip(
+        (PREDICTIONS_PATH, PREDICTIONS_STAT_PATH), calcolate, snapshot['previsioni_precedenti']
+    ):
+        dati = {m: v for m, v in (precedenti or {}).items() if m in selezionati and m not in nuove}
+        dati.update(nuove)
+        if dati != precedenti:
+            _save_json_atomic(dati, path)
+            logger.info(f"✓ [PREVISIONI] Predizioni salvate: {path}")
+    # I JSON appena scritti non devono far scattare la ricarica automatica:
+    # nuovo snapshot con la signature aggiornata (durante il caricamento la
+    # signature non è ancora impostata)
+    if snapshot['signature'] is not None:
+        firma = json.loads(json.dumps(_signature_previsioni(), default=str))
+        with _previsioni_lock:
+            attuale = _snapshot_corrente(snapshot)
+            _pubblica_previsioni(attuale, {**attuale, 'signature': {**attuale['signature'], 'previsioni': firma}})
+
+
+def assicura_previsioni(snapshot, modelli):
+    """
+    Calcola subito le previsioni dei modelli richiesti non ancora calcolati
+    (calcolo su richiesta): chi chiede un modello non attende la coda.
+    Ritorna lo snapshot da usare per il resto della richiesta, con le
+    previsioni dei modelli richiesti (pubblicato se ancora in servizio).
+    """
+    if not _modelli_mancanti(snapshot, modelli):
+        return snapshot
+    with _previsioni_lock:
+        # Coda o altre richieste possono aver già pubblicato i modelli mancanti
+        snapshot = _snapshot_corrente(snapshot)
+        mancanti = _modelli_mancanti(snapshot, modelli)
+        if mancanti:
+            logger.info(f"⚙️ [PREVISIONI] Calcolo su richiesta: {mancanti}")
+            nuovo = _con_previsioni(snapshot, *_calcola_previsioni_modelli(snapshot, mancanti))
+            _pubblica_previsioni(snapshot, nuovo)
+            snapshot = nuovo
+    return snapshot
+
+
+def completa_previsioni(snapshot):
+    """
+    Calcola le previsioni di tutti i modelli mancanti, CODA_BATCH alla volta,
+    salvando i JSON ogni CODA_SALVATAGGIO modelli e alla fine. Ogni batch è
+    pubblicato come nuovo snapshot; si interrompe se lo snapshot viene
+    sostituito da una ricarica.
+    """
+    da_salvare = 0
+    while True:
+        with _previsioni_lock:
+            attuale = _snapshot_corrente(snapshot)
+            if attuale is not _data_cache:
+                return  # Ricaricato: la coda riparte sul nuovo snapshot
+            snapshot = attuale
+            batch = _modelli_mancanti(snapshot)[:CODA_BATCH]
+            if batch:
+                nuovo = _con_previsioni(snapshot, *_calcola_previsioni_modelli(snapshot, batch))
+                if not _pubblica_previsioni(snapshot, nuovo):
+                    return  # Ricarica in corso
+                snapshot = nuovo
+        if not batch:
+            break
+        da_salvare += len(batch)
+        if da_salvare >= CODA_SALVATAGGIO:
+            _salva_previsioni(snapshot)
+            da_salvare = 0
+    if da_salvare:
+        _salva_previsioni(snapshot)
+
+
+def _avvia_coda_previsioni(snapshot):
+    """Avvia (una volta per processo) il thread che completa le previsioni in background."""
+    global _coda_thread
+    if (_coda_thread is not None and _coda_thread.is_alive()) or not _modelli_mancanti(snapshot):
+        return
+    with _coda_lock:
+        if _coda_thread is not None and _coda_thread.is_alive():
+            return
+        _coda_thread = threading.Thread(target=_coda_previsioni, args=(snapshot,),
+                                        name='previsioni-coda', daemon=True)
+        _coda_thread.start()
+
+
+def _coda_previsioni(snapshot):
+    try:
+        completa_previsioni(snapshot)
+        logger.info("✅ [PREVISIONI] Coda previsioni completata")
+    except Exception as e:
+        logger.error(f"❌ [PREVISIONI] Errore nella coda previsioni: {e}", exc_info=True)
+
+
+def _load_data():
+    """
+    Caricamento completo in un nuovo snapshot: store/Excel, indici e
+    previsioni incrementali. Ritorna lo snapshot pronto da pubblicare.
+    """
+    logger.info("🔄 [PREVISIONI] Caricamento dati in corso...")
+    snapshot = _nuovo_snapshot()
+
+    # Valida che tutti i file richiesti esistano
+    _set_fase('validazione file', 0.05)
+    files_ok, error_msg = validate_required_files()
+    if not files_ok:
+        logger.error(error_msg)
+        raise FileNotFoundError(error_msg)
+
+    # Store colonnare: se valido per i file sorgente evita Excel e build_df_affid
+    _set_fase('caricamento dati', 0.1)
+    signature = _store_signature()
+    loaded = load_frames(STORE_PATH, signature)
+    if loaded is not None:
+        frames, extra = loaded
+        snapshot['df_anagrafica'] = frames['df_anagrafica']
+        snapshot['df_affid_full'] = frames['df_affid_full']
+        snapshot['df_affid_troncato_full'] = frames['df_affid_troncato_full']
+        snapshot['modelli'] = extra['modelli']
+        _load_json_sources(snapshot)
+        logger.info(f"✓ [PREVISIONI] Dati preparati caricati dallo store colonnare: {STORE_PATH}")
+    else:
+        build_previsioni_store(signature, snapshot)
+        snapshot['df_rotture'] = None  # Serve solo alla costruzione dello store
+
+    # Statistiche storiche per (modello, componente/stat): le tabelle fanno solo lookup
+    _set_fase('indici statistiche storiche', 0.4)
+    snapshot['hist_index'] = build_historical_index(snapshot['df_affid_full'])
+
+    # Anagrafica e matrice BOM con array allineati: le tabelle sono fette vettoriali
+    snapshot['anagrafica'] = build_anagrafica_index(snapshot['df_anagrafica'])
+    snapshot['bom'] = build_bom_index(snapshot['json_data'], snapshot['anagrafica'], snapshot['hist_index'])
+
+    # Calcolo incrementale previsioni: i gruppi con fingerprint invariato
+    # vengono riusati dal JSON precedente, solo quelli cambiati sono ricalcolati.
+    # Qui solo i modelli principali, gli altri in coda / alla prima richiesta
+    _set_fase('previsioni modelli principali', 0.5)
+    snapshot['previsioni_precedenti'] = (
+        _load_json_if_exists(PREDICTIONS_PATH), _load_json_if_exists(PREDICTIONS_STAT_PATH)
+    )
+    snapshot['precomputed_predictions'] = {}
+    snapshot['precomputed_predictions_stat'] = {}
+    snapshot = _con_previsioni(
+        snapshot, *_calcola_previsioni_modelli(snapshot, snapshot['modelli'][:max(MODELLI_PRECALCOLO, 0)]))
+    _salva_previsioni(snapshot)
+
+    # Sorgenti con la signature letta prima della lettura (una modifica durante
+    # il caricamento verrà rilevata), previsioni dopo la scrittura dei JSON
+    snapshot['signature'] = json.loads(json.dumps(
+        {'sorgenti': signature, 'previsioni': _signature_previsioni()}, default=str))
+    snapshot['versione'] = time.time()
+    snapshot['loaded'] = True
+    logger.info("✅ [PREVISIONI] Setup completato e cachato in memoria")
+    return snapshot
+
+# =============================================================================
+# FUNZIONI HELPER
+# =============================================================================
+
+def build_historical_index(df):
+    """
+    Indice delle statistiche storiche, calcolato una volta sola su df_affid:
+    {"Componente": {(modello, codice): {'total', 'broken'}}, "STAT": {(modello, stat): {...}}}.
+    I conteggi sono in unità: ogni riga vale "Peso" (le censure sono aggregate per lotto).
+    """
+    pesi = pesi_affid(df)
+    base = pd.DataFrame({
+        'Modello': df['Modello'].values,
+        'total': pesi,
+        'broken': np.where(df['Censura'].values == 0, pesi, 0),
+    })
+    index = {}
+    for group_type, col in (("Componente", "Codice Componente"), ("STAT", "stat")):
+        if col not in df.columns:
+            index[group_type] = {}
+            continue
+        agg = base.assign(code=df[col].values).groupby(
+            ['Modello', 'code'], sort=False, observed=True
+        )[['total', 'broken']].sum()
+        index[group_type] = {
+            chiave: {'total': int(tot), 'broken': int(rott)}
+            for chiave, tot, rott in zip(agg.index, agg['total'].values, agg['broken'].values)
+        }
+    return index
+
+def get_historical_stats(hist_index, modello, code, group_type="Componente"):
+    """Recupera il numero totale e di rotture per un componente o gruppo STAT (vedi build_historical_index)."""
+    return hist_index[group_type].get((modello, code), {'total': 0, 'broken': 0})
+
+# Soglie (mesi) del resoconto storico
+SUMMARY_MESI_ROTTURE = [6, 12, 18, 24, 30, 36]
+SUMMARY_MESI_ATTIVI = [0, 6, 12, 18, 24, 30, 36]
+
+def reliability_stats(T, E, w):
+    """
+    Statistiche storiche di un gruppo per il resoconto. I conteggi per soglia
+    usano istogrammi cumulativi: una sola searchsorted sui tempi ordinati per
+    tutte le soglie, invece di un filtro booleano per soglia.
+    """
+    T = np.asarray(T, dtype=float)
+    w = np.asarray(w, dtype=float)
+    eventi = np.asarray(E) == 0
+    stats = {
+        'total': int(w.sum()),
+        'broken': int(w[eventi].sum()),
+        'tempi_rottura': None,
+    }
+    if stats['broken'] > 0:
+        T_rotture, w_rotture = T[eventi], w[eventi]
+        stats['tempi_rottura'] = {
+            'min': float(np.min(T_rotture)),
+            'media': float(np.average(T_rotture, weights=w_rotture)),
+            'mediana': float(weighted_percentile(T_rotture, w_rotture, 50)),
+            'max': float(np.max(T_rotture)),
+        }
+
+    # Rotture entro la soglia: T <= giorni tra gli eventi
+    ordine = np.argsort(T[eventi], kind="stable")
+    T_ev = T[eventi][ordine]
+    cum_ev = np.concatenate([[0.0], np.cumsum(w[eventi][ordine])])
+    giorni = np.array(SUMMARY_MESI_ROTTURE) * 30.44
+    stats['rotture_cumulative'] = {
+        str(m): int(n) for m, n in zip(SUMMARY_MESI_ROTTURE, cum_ev[np.searchsorted(T_ev, giorni, side='right')])
+    }
+
+    # Ancora attivi alla soglia: T >= giorni = totale - (T < giorni)
+    ordine = np.argsort(T, kind="stable")
+    cum = np.concatenate([[0.0], np.cumsum(w[ordine])])
+    giorni = np.array(SUMMARY_MESI_ATTIVI) * 30.44
+    stats['attivi'] = {
+        str(m): int(cum[-1] - n) for m, n in zip(SUMMARY_MESI_ATTIVI, cum[np.searchsorted(T[ordine], giorni, side='left')])
+    }
+    return stats
+
+def format_reliability_summary(stats, modello, code, group_type="Componente"):
+    """Testo del resoconto a partire da reliability_stats (None = nessun dato)."""
+    if stats is None:
         return f"Nessun dato di affidabilità trovato per {group_type} {code} nel modello {modello}."
-    
-    T, E = data_slice["Tempo di Vita"].values, data_slice["Censura"].values
-    n_tot, n_rott = len(T), (E == 0).sum()
-    
+
+    n_tot, n_rott = stats['total'], stats['broken']
     summary = f"Resoconto per {group_type}: {code}\n" + "-"*50
     summary += f"\nTotale unità osservate: {n_tot}\nRotture totali osservate: {n_rott}"
     if n_tot > 0:
         summary += f" ({n_rott/n_tot:.2%} del totale)\n\n"
     else:
         summary += "\n\n"
-    
+
     summary += "Statistiche descrittive del tempo di vita (giorni) delle unità rotte:\n"
-    if n_rott > 0:
-        T_rotture = T[E == 0]
-        summary += f"  - Min: {np.min(T_rotture):.0f}\n"
-        summary += f"  - Media: {np.mean(T_rotture):.0f}\n"
-        summary += f"  - Mediana: {np.median(T_rotture):.0f}\n"
-        summary += f"  - Max: {np.max(T_rotture):.0f}\n\n"
+    tempi = stats['tempi_rottura']
+    if tempi is not None:
+        summary += f"  - Min: {tempi['min']:.0f}\n"
+        summary += f"  - Media: {tempi['media']:.0f}\n"
+        summary += f"  - Mediana: {tempi['mediana']:.0f}\n"
+        summary += f"  - Max: {tempi['max']:.0f}\n\n"
     else:
         summary += "  - Nessuna rottura osservata.\n\n"
-    
+
     summary += "Rotture cumulative nel tempo (basate su dati storici):\n"
-    for mesi in [6, 12, 18, 24, 30, 36]:
-        rotture_periodo = ((E == 0) & (T <= mesi * 30.44)).sum()
-        summary += f"  - Entro {mesi} mesi: {rotture_periodo} rotture\n"
-        
+    for mesi in SUMMARY_MESI_ROTTURE:
+        summary += f"  - Entro {mesi} mesi: {stats['rotture_cumulative'][str(mesi)]} rotture\n"
+
     summary += "\nComponenti ancora attivi nel tempo (Risk Set):\n"
-    for mesi in [0, 6, 12, 18, 24, 30, 36]:
-        giorni = mesi * 30.44
-        ancora_attivi = (T >= giorni).sum()
-        summary += f"  - A {mesi} mesi: {ancora_attivi} unità attive\n"
-        
+    for mesi in SUMMARY_MESI_ATTIVI:
+        summary += f"  - A {mesi} mesi: {stats['attivi'][str(mesi)]} unità attive\n"
+
     return summary
 
-def tabella_componenti_con_previsioni(modelli, quantita, json_modelli, json_predizioni_comp, 
-                                     json_predizioni_stat, df_anagrafica_completa, df_affid):
-    """Crea la tabella dettagliata per singolo componente."""
-    mappa_anagrafica = df_anagrafica_completa.drop_duplicates(subset="codice").set_index("codice").to_dict("index")
-    tabelle = {}
-    mesi = [12, 24, 36]
-    
-    for modello in modelli:
-        componenti = json_modelli.get(modello, {}).get("componenti", {})
-        dati = []
-        
-        for codice, qta_per_mod in componenti.items():
-            info_comp = mappa_anagrafica.get(codice, {})
-            price = info_comp.get("price", 0)
-            stat_code = info_comp.get("stat")
-            
-            row = {
-                "Codice componente": codice,
-                "Descrizione Componente": info_comp.get("descrizione", ""),
-                "Descrizione Inglese": info_comp.get("descrizione_en", ""),
-                "Prezzo": price,
-                "stat": stat_code,
-                "Quantità  per modello": qta_per_mod,
-                "Quantità  totale": qta_per_mod * quantita,
-            }
-            
-            # Dati storici
-            hist_stats_comp = get_historical_stats(df_affid, modello, codice, "Componente")
-            row['total_comp'] = hist_stats_comp['total']
-            row['broken_comp'] = hist_stats_comp['broken']
-            
-            if stat_code:
-                hist_stats_stat = get_historical_stats(df_affid, modello, stat_code, "STAT")
-                row['total_stat'] = hist_stats_stat['total']
-                row['broken_stat'] = hist_stats_stat['broken']
-            
-            # Previsioni Componente
-            pred_comp = json_predizioni_comp.get(modello, {}).get(codice, {})
-            for m in mesi:
-                prob = pred_comp.get(f"prev{m}")
-                row[f"rottura_comp_{m}_mesi"] = prob
-                row[f"ci_min_comp_{m}_mesi"] = pred_comp.get(f"prev{m}_lower")
-                row[f"ci_max_comp_{m}_mesi"] = pred_comp.get(f"prev{m}_upper")
-                row[f"costo_comp_{m}_mesi"] = prob * row["Quantità  totale"] * price if prob and price else None
-
-            # Previsioni STAT
-            pred_stat = json_predizioni_stat.get(modello, {}).get(stat_code, {})
-            for m in mesi:
-                prob = pred_stat.get(f"prev{m}")
-                row[f"rottura_stat_{m}_mesi"] = prob
-                row[f"ci_min_stat_{m}_mesi"] = pred_stat.get(f"prev{m}_lower")
-                row[f"ci_max_stat_{m}_mesi"] = pred_stat.get(f"prev{m}_upper")
-                row[f"costo_stat_{m}_mesi"] = prob * row["Quantità  totale"] * price if prob and price else None
-
-            dati.append(row)
-        
-        if dati:
-            tabelle[modello] = pd.DataFrame(dati)
+def generate_reliability_summary(df, modello, code, group_type="Componente"):
+    """Genera un resoconto testuale delle statistiche di affidabilità storiche."""
+    data_slice = df[(df["Modello"] == modello) & 
+                    ((df["Codice Componente"] == code) if group_type == "Componente" else (df["stat"] == code))]
     
-    return tabelle
+    if data_slice.empty:
+        return format_reliability_summary(None, modello, code, group_type)
+
+    stats = reliability_stats(data_slice["Tempo di Vita"].values, data_slice["Censura"].values, pesi_affid(data_slice))
+    return format_reliability_summary(stats, modello, code, group_type)
 
-def tabella_componenti_con_previsioni_multi_qty(modelli, quantita_dict, json_modelli, json_predizioni_comp, 
-                                                json_predizioni_stat, df_anagrafica_completa, df_affid):
+def get_reliability_summary(modello, code, group_type="Componente"):
+    """
+    Resoconto di un gruppo come JSON (bytes), calcolato alla prima richiesta e
+    poi servito dalla cache. Le voci della cache non vengono mai modificate.
+    """
+    snapshot = _data_cache
+    cache = snapshot['summaries']
+    chiave = (group_type, modello, code)
+    payload = cache.get(chiave)
+    if payload is not None:
+        return payload
+
+    # Fette per gruppo su df_affid_full, preparate una volta per tipo di gruppo
+    gruppi = snapshot['summary_groups'].get(group_type)
+    if gruppi is None:
+        df = snapshot['df_affid_full']
+        col = "Codice Componente" if group_type == "Componente" else "stat"
+        gruppi = prepara_gruppi(df, list(pd.unique(df["Modello"])), col)
+        gruppi['posizioni'] = {k: i for i, k in enumerate(gruppi['chiavi'])}
+        snapshot['summary_groups'][group_type] = gruppi
+
+    i = gruppi['posizioni'].get((modello, code))
+    stats = None
+    if i is not None:
+        fetta = slice(gruppi['offsets'][i], gruppi['offsets'][i + 1])
+        stats = reliability_stats(gruppi['T'][fetta], gruppi['censura'][fetta], gruppi['pesi'][fetta])
+    payload = json.dumps({
+        'modello': modello,
+        'codice': code,
+        'tipo': group_type,
+        'stats': stats,
+        'summary_text': format_reliability_summary(stats, modello, code, group_type),
+    }).encode('utf-8')
+    cache[chiave] = payload
+    return payload
+
+# Colonne delle tabelle previsioni, nell'ordine usato per gli export CSV/Parquet
+COLONNE_TABELLA = [
+    "Codice componente", "Descrizione Componente", "Descrizione Inglese", "Prezzo", "stat",
+    "Quantità per modello", "Quantità totale",
+    "total_comp", "broken_comp", "total_stat", "broken_stat",
+] + [
+    f"{voce}_{tipo}_{m}_mesi"
+    for tipo in ("comp", "stat") for m in (12, 24, 36) for voce in ("rottura", "ci_min", "ci_max", "costo")
+]
+COLONNE_TESTO = {"Codice componente", "Descrizione Componente", "Descrizione Inglese", "stat"}
+
+def _tabella_modello(voci, quantita):
+    """Tabella di un modello dalle sue voci BOM (voci_modello): sole operazioni per colonna."""
+    totale = voci['pezzi'] * quantita
+    prezzo = voci['price']
+    tabella = {
+        "Codice componente": voci['codice'],
+        "Descrizione Componente": voci['descrizione'],
+        "Descrizione Inglese": voci['descrizione_en'],
+        "Prezzo": prezzo,
+        "stat": voci['stat'],
+        "Quantità per modello": voci['pezzi'],
+        "Quantità totale": totale,
+        "total_comp": voci['total_comp'],
+        "broken_comp": voci['broken_comp'],
+    }
+    # Conteggi STAT interi se tutti i componenti hanno un gruppo STAT
+    for col in ("total_stat", "broken_stat"):
+        valori = voci[col]
+        tabella[col] = valori if np.isnan(valori).any() else valori.astype(np.int64)
+
+    for tipo in ("comp", "stat"):
+        pred = voci[f'pred_{tipo}']
+        for j, m in enumerate([12, 24, 36]):
+            prob = pred[:, 3 * j]
+            tabella[f"rottura_{tipo}_{m}_mesi"] = prob
+            tabella[f"ci_min_{tipo}_{m}_mesi"] = pred[:, 3 * j + 1]
+            tabella[f"ci_max_{tipo}_{m}_mesi"] = pred[:, 3 * j + 2]
+            # Costo solo con probabilità e prezzo valorizzati e non nulli
+            tabella[f"costo_{tipo}_{m}_mesi"] = np.where(
+                (prob != 0) & (prezzo != 0), prob * totale * prezzo, np.nan
+            )
+    return pd.DataFrame(tabella)
+
+
+def tabella_componenti_con_previsioni(modelli, quantita, cache):
+    """Crea la tabella dettagliata per singolo componente."""
+    return tabella_componenti_con_previsioni_multi_qty(modelli, {}, cache, quantita_default=quantita)
+
+
+def tabella_componenti_con_previsioni_multi_qty(modelli, quantita_dict, cache, quantita_default=1):
     """
     Crea la tabella dettagliata per singolo componente (quantità per-modello).
+    Le righe sono fette della matrice BOM dello snapshot (vedi utils.bom_matrix),
+    con le previsioni già allineate per voce.
     
     Args:
         quantita_dict: dizionario {modello: quantità}
     """
-    mappa_anagrafica = df_anagrafica_completa.drop_duplicates(subset="codice").set_index("codice").to_dict("index")
-    tabelle = {}
-    mesi = [12, 24, 36]
-    
-    for modello in modelli:
-        quantita_modello = quantita_dict.get(modello, 1)
-        componenti = json_modelli.get(modello, {}).get("componenti", {})
-        dati = []
-        
-        for codice, qta_per_mod in componenti.items():
-            info_comp = mappa_anagrafica.get(codice, {})
-            price = info_comp.get("price", 0)
-            stat_code = info_comp.get("stat")
-            
-            row = {
-                "Codice componente": codice,
-                "Descrizione Componente": info_comp.get("descrizione", ""),
-                "Descrizione Inglese": info_comp.get("descrizione_en", ""),
-                "Prezzo": price,
-                "stat": stat_code,
-                "Quantità per modello": qta_per_mod,
-                "Quantità totale": qta_per_mod * quantita_modello,
-            }
-            
-            # Dati storici
-            hist_stats_comp = get_historical_stats(df_affid, modello, codice, "Componente")
-            row['total_comp'] = hist_stats_comp['total']
-            row['broken_comp'] = hist_stats_comp['broken']
-            
-            if stat_code:
-                hist_stats_stat = get_historical_stats(df_affid, modello, stat_code, "STAT")
-                row['total_stat'] = hist_stats_stat['total']
-                row['broken_stat'] = hist_stats_stat['broken']
-            
-            # Previsioni Componente
-            pred_comp = json_predizioni_comp.get(modello, {}).get(codice, {})
-            for m in mesi:
-                prob = pred_comp.get(f"prev{m}")
-                row[f"rottura_comp_{m}_mesi"] = prob
-                row[f"ci_min_comp_{m}_mesi"] = pred_comp.get(f"prev{m}_lower")
-                row[f"ci_max_comp_{m}_mesi"] = pred_comp.get(f"prev{m}_upper")
-                row[f"costo_comp_{m}_mesi"] = prob * row["Quantità totale"] * price if prob and price else None
-
-            # Previsioni STAT
-            pred_stat = json_predizioni_stat.get(modello, {}).get(stat_code, {})
-            for m in mesi:
-                prob = pred_stat.get(f"prev{m}")
-                row[f"rottura_stat_{m}_mesi"] = prob
-                row[f"ci_min_stat_{m}_mesi"] = pred_stat.get(f"prev{m}_lower")
-                row[f"ci_max_stat_{m}_mesi"] = pred_stat.get(f"prev{m}_upper")
-                row[f"costo_stat_{m}_mesi"] = prob * row["Quantità totale"] * price if prob and price else None
-
-            dati.append(row)
-        
-        if dati:
-            tabelle[modello] = pd.DataFrame(dati)
-    
-    return tabelle
+    return dict(iter_tabelle_modelli(modelli, quantita_dict, cache, quantita_default))
+
+
+def iter_tabelle_modelli(modelli, quantita_dict, cache, quantita_default=1):
+    """
+    Genera (modello, tabella) un modello alla volta, saltando i modelli senza
+    voci BOM: per l'esportazione streaming (utils.table_export), che tiene in
+    memoria al più una tabella.
+    """
+    for modello in dict.fromkeys(modelli):
+        voci = voci_modello(cache['bom'], modello)
+        if len(voci['codice']):
+            yield modello, _tabella_modello(voci, quantita_dict.get(modello, quantita_default))
+
+
+def righe_tabella(df):
+    """Righe per i template: valori mancanti (NaN) come None."""
+    return df.astype(object).where(df.notna(), None).to_dict('records')
 
 # =============================================================================
 # ROUTES
 # =============================================================================
 
+def _pagina_caricamento():
+    """Pagina di attesa mostrata finché il caricamento dati non è completo."""
+    return render_template("previsioni/caricamento.html", load_status=dict(_load_status)), 503
+
+
+def _risposta_non_pronto():
+    """Risposta JSON 503 per gli endpoint chiamati prima della fine del caricamento."""
+    response = jsonify({'pronto': False, 'stato': _load_status['stato'], 'fase': _load_status['fase']})
+    response.status_code = 503
+    response.headers['Retry-After'] = '5'
+    return response
+
+
+@previsioni_bp.route('/stato')
+def stato():
+    """
+    Readiness del modulo previsioni: stato e avanzamento del caricamento dati.
+    Risponde 200 quando i dati sono pronti, 503 altrimenti (utilizzabile come
+    readiness probe). Non avvia il caricamento e non richiede login; il
+    dettaglio degli errori è mostrato solo agli utenti autenticati.
+    """
+    status = dict(_load_status)
+    status['pronto'] = bool(_data_cache['loaded'])
+    if not current_user.is_authenticated:
+        status['errore'] = None if status['errore'] is None else 'errore di caricamento'
+        status['errore_ricarica'] = None if status['errore_ricarica'] is None else 'errore di ricarica'
+    return jsonify(status), (200 if status['pronto'] else 503)
+
+
+@previsioni_bp.route('/ricarica', methods=['POST'])
+@admin_required
+def ricarica():
+    """
+    Ricarica a caldo dei dati previsioni (nuovi Excel/JSON o previsioni
+    ricalcolate) senza riavviare l'applicazione: il nuovo snapshot è costruito
+    in background e sostituisce quello attuale solo quando è completo.
+    """
+    if start_background_reload():
+        logger.info(f"🔁 [PREVISIONI] Ricarica avviata da {current_user.username}")
+        flash('Ricarica dei dati previsioni avviata: le previsioni attuali restano disponibili fino al termine.', 'info')
+    else:
+        flash('Un caricamento dei dati previsioni è già in corso.', 'warning')
+    return redirect(url_for('previsioni.index'))
+
+
 @previsioni_bp.route('/', methods=['GET', 'POST'])
 @login_required
 def index():
@@ -360,8 +1017,10 @@ def index():
     Pagina principale delle previsioni di affidabilità
     I dati vengono caricati SOLO quando questa route viene chiamata
     """
-    # Carica dati solo se necessario (lazy loading)
-    load_data_if_needed()
+    # Carica dati solo se necessario (lazy loading, in background)
+    if not start_background_load():
+        return _pagina_caricamento()
+    cache = _data_cache  # Snapshot coerente per tutta la richiesta
     
     selected_models = []
     quantity = 1
@@ -373,45 +1032,27 @@ def index():
         quantity = int(request.form.get("quantita", 1))
         
         if selected_models:
-            tabelle_comp = tabella_componenti_con_previsioni(
-                selected_models, quantity, 
-                _data_cache['json_data'], 
-                _data_cache['precomputed_predictions'],
-                _data_cache['precomputed_predictions_stat'], 
-                _data_cache['df_anagrafica'], 
-                _data_cache['df_affid_full']
-            )
-            tabelle_previsioni = {k: df.to_dict('records') for k, df in tabelle_comp.items()}
+            cache = assicura_previsioni(cache, selected_models)
+            tabelle_comp = tabella_componenti_con_previsioni(selected_models, quantity, cache)
+            tabelle_previsioni = {k: righe_tabella(df) for k, df in tabelle_comp.items()}
 
             for modello in selected_models:
                 # Calcola data primo ordine per il modello
-                sotto_df = _data_cache['df_affid_full'][_data_cache['df_affid_full']["Modello"] == modello]
+                sotto_df = cache['df_affid_full'][cache['df_affid_full']["Modello"] == modello]
                 if not sotto_df.empty:
                     data_minima = sotto_df["Data Acquisto"].min()
                     if pd.notna(data_minima):
                         periodi_osservazione[modello] = data_minima.strftime("%d/%m/%y")
 
-                # Aggiunge i resoconti statistici
-                if modello in _data_cache['precomputed_predictions']:
-                    for comp_code, data in _data_cache['precomputed_predictions'][modello].items():
-                        data['summary_text'] = generate_reliability_summary(
-                            _data_cache['df_affid_full'], modello, comp_code, "Componente"
-                        )
-                        
-                if modello in _data_cache['precomputed_predictions_stat']:
-                    for stat_code, data in _data_cache['precomputed_predictions_stat'][modello].items():
-                        data['summary_text'] = generate_reliability_summary(
-                            _data_cache['df_affid_full'], modello, stat_code, "STAT"
-                        )
 
     return render_template(
         "previsioni/previsioni.html",
-        modelli=_data_cache['modelli_topN'],
+        modelli=cache['modelli'],
         selected_models=selected_models,
         quantity=quantity,
         tabelle_previsioni=tabelle_previsioni,
-        precomputed_predictions=_data_cache['precomputed_predictions'],
-        precomputed_predictions_stat=_data_cache['precomputed_predictions_stat'],
+        precomputed_predictions=cache['precomputed_predictions'],
+        precomputed_predictions_stat=cache['precomputed_predictions_stat'],
         periodi_osservazione=periodi_osservazione
     )
     
@@ -422,37 +1063,13 @@ ORDERS_XLSX_PATH = os.path.join(BASE_DIR, "preprocessing_PO", "orders_model_quan
 
 def get_modelli_from_orders_excel(file_nome: str):
     """
-    Legge l'Excel preprocessing_PO/orders_model_quantity_FINAL_shadow.xlsx,
-    filtra per colonna 'file' == file_nome e ritorna i valori DISTINCT di 'modello' ordinati.
+    Valori DISTINCT di 'modello' ordinati per il 'file' indicato, dall'Excel
+    preprocessing_PO/orders_model_quantity_FINAL_shadow.xlsx (via indice in cache).
     """
     if not file_nome:
         return []
-    if not os.path.exists(ORDERS_XLSX_PATH):
-        print(f"[PREVISIONI] Excel ordini NON trovato: {ORDERS_XLSX_PATH}")
-        return []
-    try:
-        df = pd.read_excel(ORDERS_XLSX_PATH)
-    except Exception as e:
-        print(f"[PREVISIONI] Errore lettura Excel ordini: {e}")
-        return []
-
-    # normalizza colonne attese
-    cols = {c.lower(): c for c in df.columns}
-    col_file = cols.get('file')
-    col_modello = cols.get('modello')
-    if not col_file or not col_modello:
-        print("[PREVISIONI] Colonne 'file' / 'modello' non trovate nell'Excel ordini.")
-        return []
-
-    modelli = (
-        df.loc[df[col_file] == file_nome, col_modello]
-        .dropna()
-        .astype(str)
-        .drop_duplicates()
-        .sort_values()
-        .tolist()
-    )
-    return modelli
+    voce = _orders_index().get(file_nome)
+    return list(voce[0]) if voce else []
 
 @previsioni_bp.route('/da-ordine', methods=['GET', 'POST'])
 @login_required
@@ -463,12 +1080,14 @@ def da_ordine():
     - PO: precompilato col 'file'
     - Modelli: DISTINCT da Excel per quel 'file' + somma quantità per la tendina
     """
-    load_data_if_needed()
+    if not start_background_load():
+        return _pagina_caricamento()
+    cache = _data_cache  # Snapshot coerente per tutta la richiesta
 
     file_nome = request.args.get('file', '').strip()
 
     # ⬅️ Prendi sia i modelli sia le quantità sommate da Excel
-    modelli_prepopolati, modelli_qty = get_modelli_e_quantita_from_orders_excel(file_nome)
+    modelli_prepopolati, modelli_qty = get_modelli_e_quantita_ordine(file_nome)
 
     selected_models: list[str] = []
     selected_models_distinct: list[str] = []
@@ -509,36 +1128,19 @@ def da_ordine():
         models_for_calc = selected_models_distinct
         
         if models_for_calc:
+            cache = assicura_previsioni(cache, models_for_calc)
             # Chiamata con quantità per-modello
-            tabelle_comp = tabella_componenti_con_previsioni_multi_qty(
-                models_for_calc, 
-                quantita_dict,
-                _data_cache['json_data'],
-                _data_cache['precomputed_predictions'],
-                _data_cache['precomputed_predictions_stat'],
-                _data_cache['df_anagrafica'],
-                _data_cache['df_affid_full']
-            )
-            tabelle_previsioni = {k: df.to_dict('records') for k, df in tabelle_comp.items()}
+            tabelle_comp = tabella_componenti_con_previsioni_multi_qty(models_for_calc, quantita_dict, cache)
+            tabelle_previsioni = {k: righe_tabella(df) for k, df in tabelle_comp.items()}
             
-            # periodi di osservazione e summary text
+            # periodi di osservazione (i resoconti sono caricati su richiesta)
             for modello in models_for_calc:
-                sotto_df = _data_cache['df_affid_full'][_data_cache['df_affid_full']["Modello"] == modello]
+                sotto_df = cache['df_affid_full'][cache['df_affid_full']["Modello"] == modello]
                 if not sotto_df.empty:
                     data_minima = sotto_df["Data Acquisto"].min()
                     if pd.notna(data_minima):
                         periodi_osservazione[modello] = data_minima.strftime("%d/%m/%y")
-                
-                if modello in _data_cache['precomputed_predictions']:
-                    for comp_code, data in _data_cache['precomputed_predictions'][modello].items():
-                        data['summary_text'] = generate_reliability_summary(
-                            _data_cache['df_affid_full'], modello, comp_code, "Componente"
-                        )
-                if modello in _data_cache['precomputed_predictions_stat']:
-                    for stat_code, data in _data_cache['precomputed_predictions_stat'][modello].items():
-                        data['summary_text'] = generate_reliability_summary(
-                            _data_cache['df_affid_full'], modello, stat_code, "STAT"
-                        )
+
 
 
     # render
@@ -552,27 +1154,135 @@ def da_ordine():
         quantities_used=quantita_dict,
         quantity=quantity,
         tabelle_previsioni=tabelle_previsioni,
-        precomputed_predictions=_data_cache['precomputed_predictions'],
-        precomputed_predictions_stat=_data_cache['precomputed_predictions_stat'],
+        precomputed_predictions=cache['precomputed_predictions'],
+        precomputed_predictions_stat=cache['precomputed_predictions_stat'],
         periodi_osservazione=periodi_osservazione
     )
 
 
+@previsioni_bp.route('/grafico/<tipo>')
+@login_required
+def grafico(tipo):
+    """
+    Grafico KM/Weibull di un componente o gruppo STAT, generato alla prima
+    richiesta dalle curve precalcolate e poi servito dalla cache su disco.
+
+    Query string: modello, codice, formato (png | svg | json).
+    Con formato=json ritorna le curve per il disegno lato client.
+    """
+    if not start_background_load():
+        return _risposta_non_pronto()
+    if tipo not in ('componente', 'stat'):
+        abort(404)
+
+    modello = request.args.get('modello', '')
+    codice = request.args.get('codice', '')
+    formato = request.args.get('formato', 'png').lower()
+    cache = assicura_previsioni(_data_cache, [modello])
+    if tipo == 'componente':
+        predizioni = cache['precomputed_predictions']
+    else:
+        predizioni = cache['precomputed_predictions_stat']
+    entry = (predizioni or {}).get(modello, {}).get(codice)
+    if entry is None or 'curve' not in entry:
+        abort(404)
+
+    if formato == 'json':
+        return jsonify({
+            'modello': modello,
+            'codice': codice,
+            'titolo': entry['titolo'],
+            'ultimo_mese_affidabile': entry['ultimo_mese_affidabile'],
+            'curve': entry['curve']
+        })
+    if formato not in CHART_FORMATS:
+        abort(404)
+
+    # Nome file deterministico: il fingerprint cambia se cambiano dati o parametri
+    path = get_or_render(
+        CHART_DIR,
+        f"{tipo}_{entry['fingerprint']}",
+        formato,
+        lambda: chart_figure(entry['curve'], entry['titolo'], entry['ultimo_mese_affidabile']),
+        max_bytes=CHART_CACHE_MAX_MB * 1024 * 1024
+    )
+    return send_file(path, mimetype=CHART_FORMATS[formato], max_age=3600)
+
+
+@previsioni_bp.route('/resoconto/<tipo>')
+@login_required
+def resoconto(tipo):
+    """
+    Resoconto storico (testo + statistiche) di un componente o gruppo STAT,
+    richiesto dalla pagina quando l'utente apre la relativa sezione.
+
+    Query string: modello, codice.
+    """
+    if not start_background_load():
+        return _risposta_non_pronto()
+
+    group_type = {'componente': "Componente", 'stat': "STAT"}.get(tipo)
+    if group_type is None:
+        abort(404)
+    payload = get_reliability_summary(request.args.get('modello', ''), request.args.get('codice', ''), group_type)
+    return current_app.response_class(payload, mimetype='application/json')
+
+
+@previsioni_bp.route('/flotta')
+@login_required
+def flotta():
+    """
+    Previsione a livello di flotta: domanda di ricambi per componente a
+    12/24/36 mesi su tutti i PO con data ordine nell'intervallo.
+
+    Query string: dal, al (YYYY-MM-DD, default ultimi 12 mesi), formato (html | json).
+    """
+    if not start_background_load():
+        if request.args.get('formato') == 'json':
+            return _risposta_non_pronto()
+        return _pagina_caricamento()
+    cache = _data_cache
+
+    al = _parse_data(request.args.get('al')) or date.today()
+    dal = _parse_data(request.args.get('dal')) or (al - timedelta(days=365))
+    if dal > al:
+        dal, al = al, dal
+
+    tabella, info = previsione_flotta(dal, al, cache)
+    righe = righe_tabella(tabella)
+
+    if request.args.get('formato') == 'json':
+        return jsonify({'dal': dal.isoformat(), 'al': al.isoformat(), **info, 'componenti': righe})
+
+    return render_template(
+        "previsioni/flotta.html",
+        dal=dal,
+        al=al,
+        info=info,
+        righe=righe,
+        mesi=FLOTTA_MESI
+    )
+
+
 @previsioni_bp.route('/esporta-excel', methods=['POST'])
 @login_required
 def esporta_excel():
     """
-    Esporta le tabelle previsioni in un file Excel multi-foglio.
-    Un foglio per ogni modello.
+    Esporta le tabelle previsioni: Excel multi-foglio (un foglio per modello,
+    default), CSV unico con colonna Modello o Parquet (formato=xlsx|csv|parquet).
+    Il file è scritto riga per riga e inviato a blocchi, senza tenere in
+    memoria l'intero workbook.
     """
-    from flask import send_file
-    from io import BytesIO
     from datetime import datetime
     
-    load_data_if_needed()
-    
     # Leggi parametri POST
     po = request.form.get('po', 'ordine')
+    
+    if not start_background_load():
+        flash('Dati previsioni in caricamento: riprova l\'esportazione tra qualche istante.', 'warning')
+        return redirect(url_for('previsioni.da_ordine', file=po))
+    cache = _data_cache
+    formato = request.form.get('formato', 'xlsx').lower()
     modelli_export = request.form.getlist('modelli_export')
     
     # Leggi quantità per ogni modello
@@ -588,49 +1298,51 @@ def esporta_excel():
     if not modelli_export:
         flash('Nessun modello selezionato per l\'esportazione.', 'warning')
         return redirect(url_for('previsioni.da_ordine', file=po))
+    if formato not in EXPORT_FORMATS:
+        flash(f'Formato di esportazione non supportato: {formato}', 'warning')
+        return redirect(url_for('previsioni.da_ordine', file=po))
+    
+    mimetype, estensione = EXPORT_FORMATS[formato]
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    filename = f"previsioni_{po}_{timestamp}.{estensione}"
+    headers = {'Content-Disposition': f'attachment; filename="{filename}"'}
+    tmp_path = None
     
     try:
-        # Rigenera le tabelle
-        tabelle_comp = tabella_componenti_con_previsioni_multi_qty(
-            modelli_export,
-            quantita_dict,
-            _data_cache['json_data'],
-            _data_cache['precomputed_predictions'],
-            _data_cache['precomputed_predictions_stat'],
-            _data_cache['df_anagrafica'],
-            _data_cache['df_affid_full']
-        )
-        
-        # Crea Excel multi-foglio in memoria
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            for modello, df in tabelle_comp.items():
-                # Arrotonda tutte le colonne numeriche a 2 decimali
-                df_rounded = df.copy()
-                numeric_cols = df_rounded.select_dtypes(include=['float64', 'float32', 'int64', 'int32']).columns
-                df_rounded[numeric_cols] = df_rounded[numeric_cols].round(2)
-                        
-                # Pulizia nome foglio (Excel max 31 char, no caratteri speciali)
-                sheet_name = modello[:31].replace('/', '_').replace('\\', '_').replace('*', '_')
-                #df.to_excel(writer, sheet_name=sheet_name, index=False)
-                df_rounded.to_excel(writer, sheet_name=sheet_name, index=False)
+        # Tabelle generate una alla volta durante la scrittura
+        cache = assicura_previsioni(cache, modelli_export)
+        tabelle_comp = iter_tabelle_modelli(modelli_export, quantita_dict, cache)
         
-        output.seek(0)
-        
-        # Nome file con timestamp
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        filename = f"previsioni_{po}_{timestamp}.xlsx"
+        if formato == 'csv':
+            # Generato riga per riga direttamente nella risposta
+            return current_app.response_class(
+                iter_csv(tabelle_comp, COLONNE_TABELLA), mimetype=mimetype, headers=headers
+            )
         
-        return send_file(
-            output,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            as_attachment=True,
-            download_name=filename
+        # XLSX / Parquet: scritti su file temporaneo e inviati a blocchi
+        fd, tmp_path = tempfile.mkstemp(prefix='previsioni_export_', suffix=f'.{estensione}')
+        os.close(fd)
+        if formato == 'parquet':
+            write_parquet(tabelle_comp, COLONNE_TABELLA, COLONNE_TESTO, tmp_path)
+        else:
+            write_xlsx(tabelle_comp, tmp_path)
+        headers['Content-Length'] = str(os.path.getsize(tmp_path))
+        response = current_app.response_class(
+            iter_file_chunks(tmp_path, delete=True), mimetype=mimetype, headers=headers
         )
-        
+        tmp_path = None  # Eliminato dal generatore a invio completato
+        return response
+    
+    except ImportError:
+        flash('Esportazione Parquet non disponibile: installare pyarrow.', 'warning')
+        return redirect(url_for('previsioni.da_ordine', file=po))
     except Exception as e:
+        logger.error(f"Errore durante l'esportazione ({formato}): {e}", exc_info=True)
         flash(f'Errore durante l\'esportazione: {str(e)}', 'danger')
         return redirect(url_for('previsioni.da_ordine', file=po))
+    finally:
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
 
 # ========================================
@@ -639,8 +1351,6 @@ def esporta_excel():
 
 import re
 
-ORDERS_XLSX_PATH = os.path.join(BASE_DIR, "preprocessing_PO", "orders_model_quantity_FINAL_shadow.xlsx")
-
 def _norm(s: str) -> str:
     s = s.lower().strip()
     s = s.replace("à","a").replace("á","a").replace("è","e").replace("é","e") \
@@ -663,67 +1373,281 @@ def _guess_qty_col(columns):
     normmap = {_norm(c): c for c in columns}
     for k in cand:
         if k in normmap:
-            print(f"[DEBUG] Colonna quantita trovata: {normmap[k]}")
+            logger.debug(f"[PREVISIONI] Colonna quantità trovata: {normmap[k]}")
             return normmap[k]
          
     # Match parziale
     for col_orig in columns:
         col_norm = _norm(col_orig)
         if any(kw in col_norm for kw in ["quantit", "qty", "qta", "pezz", "piece"]):
-            print(f"[DEBUG] Colonna trovata (match parziale): {col_orig}")
+            logger.debug(f"[PREVISIONI] Colonna quantità trovata (match parziale): {col_orig}")
             return col_orig
     
-    print(f"[DEBUG] ⚠️ Colonna quantita NON trovata! Colonne: {list(columns)}")
+    logger.debug(f"[PREVISIONI] Colonna quantità non trovata. Colonne: {list(columns)}")
     
     return None
 
-def get_modelli_e_quantita_from_orders_excel(file_nome: str):
+# Indice dell'Excel ordini {file: (modelli ordinati, {modello: quantità})},
+# ricostruito solo quando cambiano mtime/size del file
+_orders_cache = {'signature': None, 'index': {}}
+_orders_lock = threading.Lock()
+
+
+def _orders_index():
+    """Ritorna l'indice per file dell'Excel ordini, rileggendolo solo se è cambiato."""
+    try:
+        stat = os.stat(ORDERS_XLSX_PATH)
+    except OSError:
+        # Segnalato una sola volta, finché il file non ricompare
+        if _orders_cache['signature'] != 'mancante':
+            logger.warning(f"⚠️ [PREVISIONI] Excel ordini non trovato: {ORDERS_XLSX_PATH}")
+            _orders_cache.update(index={}, signature='mancante')
+        return {}
+    signature = (stat.st_mtime_ns, stat.st_size)
+    if _orders_cache['signature'] == signature:
+        return _orders_cache['index']
+
+    with _orders_lock:
+        if _orders_cache['signature'] != signature:
+            # Anche un file illeggibile viene "cachato" (indice vuoto) fino alla prossima modifica
+            _orders_cache.update(index=_build_orders_index(ORDERS_XLSX_PATH), signature=signature)
+        return _orders_cache['index']
+
+
+def _build_orders_index(path):
     """
-    Ritorna:
-      - lista modelli DISTINCT per quel file
-      - dizionario {modello: somma_quantita} per quel file
+    Legge l'Excel ordini una volta e somma le quantità per (file, modello).
+    La colonna quantità è individuata qui, una sola volta per versione del file.
     """
-    if not file_nome or not os.path.exists(ORDERS_XLSX_PATH):
-        return [], {}
-
     try:
-        df = pd.read_excel(ORDERS_XLSX_PATH)
+        df = pd.read_excel(path)
     except Exception as e:
-        print(f"[PREVISIONI] Errore lettura Excel ordini: {e}")
-        return [], {}
+        logger.exception(f"❌ [PREVISIONI] Errore lettura Excel ordini {path}: {e}")
+        return {}
 
     # colonne
     cols_lc = {c.lower(): c for c in df.columns}
     col_file = cols_lc.get('file')
     col_modello = cols_lc.get('modello')
     if not col_file or not col_modello:
-        print("[PREVISIONI] Colonne 'file' o 'modello' non trovate nell'Excel ordini.")
-        return [], {}
+        logger.warning(f"⚠️ [PREVISIONI] Colonne 'file' o 'modello' non trovate nell'Excel ordini: {path}")
+        return {}
 
     col_qta = _guess_qty_col(df.columns)
 
-    df_f = df[df[col_file] == file_nome].copy()
-    if df_f.empty:
+    df = df[df[col_modello].notna()]
+    # normalizza quantità (se presente); numeri tipo "12", "12.0", "12,0", altrimenti 0
+    if col_qta:
+        testo = df[col_qta].astype(str).str.strip().str.replace(",", ".", regex=False)
+        qta = pd.to_numeric(testo, errors="coerce")
+        qta = np.trunc(qta.where(np.isfinite(qta), 0)).astype(np.int64)
+    else:
+        qta = pd.Series(0, index=df.index, dtype=np.int64)
+
+    somme = (
+        pd.DataFrame({'file': df[col_file], 'modello': df[col_modello].astype(str), 'qta': qta})
+        .groupby(['file', 'modello'], sort=False)['qta']
+        .sum()
+    )
+    index = {}
+    for (file_nome, modello), totale in somme.items():
+        index.setdefault(file_nome, ([], {}))
+        index[file_nome][0].append(modello)
+        index[file_nome][1][modello] = int(totale)
+    for modelli, _ in index.values():
+        modelli.sort()
+    logger.info(f"✓ [PREVISIONI] Indice Excel ordini costruito: {len(index)} file")
+    return index
+
+
+def get_modelli_e_quantita_from_orders_excel(file_nome: str):
+    """
+    Ritorna:
+      - lista modelli DISTINCT per quel file
+      - dizionario {modello: somma_quantita} per quel file
+    """
+    if not file_nome:
+        return [], {}
+    voce = _orders_index().get(file_nome)
+    if not voce:
         return [], {}
+    modelli, modelli_qty = voce
+    return list(modelli), dict(modelli_qty)
 
-    # normalizza quantità (se presente); se non c'è, metti 0
-    if col_qta and col_qta in df_f.columns:
-        def _to_int(x):
-            try:
-                s = str(x).strip()
-                if s == "" or s.lower() == "nan":
-                    return 0
-                # numeri tipo "12", "12.0", "12,0"
-                s = s.replace(",", ".")
-                return int(float(s))
-            except:
-                return 0
-        df_f[col_qta] = df_f[col_qta].apply(_to_int)
-        serie = df_f.groupby(col_modello, dropna=True)[col_qta].sum()
-        modelli_qty = {str(k): int(v) for k, v in serie.items()}
-    else:
-        modelli_qty = {str(m): 0 for m in df_f[col_modello].astype(str)}
 
-    modelli = list(modelli_qty.keys())
-    modelli.sort()
-    return modelli, modelli_qty
+def get_modelli_e_quantita_from_db(file_nome: str):
+    """
+    Modelli e quantità sommate per un ordine già elaborato (elabora_tsv_ordine),
+    con una sola query aggregata su ordini per FileOrdine.filename.
+
+    Returns:
+        (modelli ordinati, {modello: somma_quantita}) oppure None se l'ordine
+        non ha righe nel database
+    """
+    if not file_nome:
+        return None
+    righe = (
+        db.session.query(Ordine.cod_modello, func.coalesce(func.sum(Ordine.qta), 0))
+        .join(FileOrdine, FileOrdine.id == Ordine.id_file_ordine)
+        .filter(FileOrdine.filename == file_nome)
+        .group_by(Ordine.cod_modello)
+        .order_by(Ordine.cod_modello)
+        .all()
+    )
+    if not righe:
+        return None
+    modelli_qty = {str(modello): int(qta) for modello, qta in righe}
+    return list(modelli_qty), modelli_qty
+
+
+def get_modelli_e_quantita_ordine(file_nome: str):
+    """Modelli e quantità dell'ordine dalla sorgente configurata (PREVISIONI_ORDINI_SOURCE)."""
+    if ORDERS_SOURCE in ('db', 'auto'):
+        try:
+            risultato = get_modelli_e_quantita_from_db(file_nome)
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Errore lettura ordine {file_nome} dal database: {e}", exc_info=True)
+            risultato = None
+        if risultato is not None:
+            return risultato
+        if ORDERS_SOURCE == 'db':
+            return [], {}
+    return get_modelli_e_quantita_from_orders_excel(file_nome)
+
+
+# ========================================
+# Previsione di flotta (tutti i PO di un periodo)
+# ========================================
+
+FLOTTA_MESI = [12, 24, 36]
+
+# Numero massimo di parametri per singola clausola IN (limite SQLite)
+_IN_CHUNK = 500
+
+
+def _parse_data(valore):
+    try:
+        return date.fromisoformat(valore) if valore else None
+    except ValueError:
+        return None
+
+
+def get_quantita_flotta(dal, al):
+    """
+    Quantità ordinate per modello sommate su tutti i PO con data_ordine in
+    [dal, al], con una query aggregata. Ritorna ({modello: quantità}, numero PO).
+    """
+    filtro = (FileOrdine.data_ordine >= dal, FileOrdine.data_ordine <= al)
+    righe = (
+        db.session.query(Ordine.cod_modello, func.coalesce(func.sum(Ordine.qta), 0))
+        .join(FileOrdine, FileOrdine.id == Ordine.id_file_ordine)
+        .filter(*filtro)
+        .group_by(Ordine.cod_modello)
+        .all()
+    )
+    n_po = (
+        db.session.query(func.count(func.distinct(Ordine.id_file_ordine)))
+        .join(FileOrdine, FileOrdine.id == Ordine.id_file_ordine)
+        .filter(*filtro)
+        .scalar()
+    )
+    return {str(modello): int(qta) for modello, qta in righe}, int(n_po or 0)
+
+
+def get_bom_flotta(modelli, json_modelli):
+    """
+    Voci BOM (modello, componente, pezzi per modello) dalla tabella
+    modelli_componenti; per i modelli senza BOM nel database si usano i
+    componenti del JSON modelli, come nelle tabelle per singolo PO.
+    """
+    voci = []
+    for i in range(0, len(modelli), _IN_CHUNK):
+        voci.extend(
+            db.session.query(ModelloComponente.cod_modello, ModelloComponente.cod_componente, ModelloComponente.qta)
+            .filter(ModelloComponente.cod_modello.in_(modelli[i:i + _IN_CHUNK]))
+            .all()
+        )
+    # Pezzi non valorizzati: almeno un pezzo per modello
+    voci = [(m, c, q if q is not None else 1) for m, c, q in voci]
+
+    con_bom = {m for m, _, _ in voci}
+    for modello in modelli:
+        if modello not in con_bom:
+            for codice, qta in (json_modelli or {}).get(modello, {}).get("componenti", {}).items():
+                voci.append((modello, codice, qta))
+    return voci
+
+
+def previsione_flotta(dal, al, cache):
+    """
+    Domanda aggregata di ricambi per componente su tutti i PO del periodo.
+    Probabilità di rottura dalla previsione del componente o, se assente,
+    del suo gruppo STAT; le unità senza previsione sono riportate a parte.
+    Usa solo le previsioni già nello snapshot: i modelli non ancora calcolati
+    restano alla coda in background (avviata se ferma), mai calcolati qui.
+
+    Returns:
+        tuple (DataFrame per componente, info riepilogo)
+    """
+    quantita, n_po = get_quantita_flotta(dal, al)
+    modelli = sorted(quantita)
+    _avvia_coda_previsioni(cache)
+    voci = get_bom_flotta(modelli, cache['json_data'])
+    info = {
+        'n_po': n_po,
+        'n_modelli': len(modelli),
+        'unita_ordinate': int(sum(quantita.values())),
+        'modelli_senza_previsioni': sorted(set(modelli) - set(cache['precomputed_predictions'] or {})),
+    }
+
+    componenti = sorted({c for _, c, _ in voci})
+    if not voci:
+        return pd.DataFrame(columns=["Codice componente"]), info
+
+    pos_modello = {m: i for i, m in enumerate(modelli)}
+    pos_componente = {c: i for i, c in enumerate(componenti)}
+    righe = righe_anagrafica(cache['anagrafica'], componenti)
+    stat_componente = valori_anagrafica(cache['anagrafica'], 'stat', righe)
+
+    # Probabilità per voce BOM: per ogni orizzonte stima, limite inferiore e superiore
+    chiavi = [f"prev{m}{suffisso}" for m in FLOTTA_MESI for suffisso in ("", "_lower", "_upper")]
+    pred_comp = cache['precomputed_predictions'] or {}
+    pred_stat = cache['precomputed_predictions_stat'] or {}
+    prob = np.full((len(voci), len(chiavi)), np.nan)
+    for i, (modello, codice, _) in enumerate(voci):
+        pred = pred_comp.get(modello, {}).get(codice)
+        if pred is None:
+            stat_code = stat_componente[pos_componente[codice]]
+            pred = pred_stat.get(modello, {}).get(stat_code) if stat_code is not None else None
+        if pred is not None:
+            prob[i] = [np.nan if pred.get(k) is None else pred[k] for k in chiavi]
+
+    installati, attesi, non_coperti = domanda_flotta(
+        [quantita[m] for m in modelli],
+        [pos_modello[m] for m, _, _ in voci],
+        [pos_componente[c] for _, c, _ in voci],
+        [q for _, _, q in voci],
+        prob,
+        len(componenti)
+    )
+
+    prezzo = valori_anagrafica(cache['anagrafica'], 'price', righe, np.nan)
+    tabella = pd.DataFrame({
+        "Codice componente": componenti,
+        "Descrizione Componente": valori_anagrafica(cache['anagrafica'], 'descrizione', righe),
+        "stat": stat_componente,
+        "Prezzo": prezzo,
+        "Unità installate": installati,
+        "Unità senza previsione": non_coperti,
+    })
+    for j, m in enumerate(FLOTTA_MESI):
+        tabella[f"Pezzi attesi {m} mesi"] = attesi[:, 3 * j]
+        tabella[f"CI min {m} mesi"] = attesi[:, 3 * j + 1]
+        tabella[f"CI max {m} mesi"] = attesi[:, 3 * j + 2]
+        tabella[f"Costo {m} mesi"] = attesi[:, 3 * j] * prezzo
+    tabella = tabella.sort_values(
+        [f"Costo {FLOTTA_MESI[-1]} mesi", f"Pezzi attesi {FLOTTA_MESI[-1]} mesi"],
+        ascending=False, na_position="last", kind="stable"
+    ).reset_index(drop=True)
+    return tabella, info
@@ -1,9 +1,18 @@
 """
 Funzioni di utilità per elaborazione file rotture
 """
+import logging
+import numpy as np
 import pandas as pd
 from datetime import datetime
 
+from utils.bulk_db import fetch_by_keys, insert_rows, update_rows, upsert_rows
+from utils.dim_cache import DimensionCache
+from utils.trace_writer import TraceWriter
+from utils.tsv_validation import valida_a_blocchi, serie_errori, segnala, frame_errori
+
+logger = logging.getLogger(__name__)
+
 
 def normalizza_codice(codice):
     """Normalizza un codice rimuovendo spazi, maiuscole e valori null"""
@@ -31,6 +40,220 @@ def parse_date(date_value):
         return None
 
 
+# Formati data espliciti dei TSV (gli stessi provati da parse_date)
+FORMATI_DATA = ['%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y']
+
+
+def normalizza_date(testo, formati=FORMATI_DATA, campione=1000):
+    """
+    Converte una colonna di date (testo, NaN se vuota) con operazioni per colonna.
+
+    Il formato principale è dedotto una volta sola sul campione (quello che
+    converte più valori); le celle che non lo rispettano sono riprovate con
+    gli altri formati espliciti e solo le rimanenti passano per parse_date.
+
+    Returns:
+        tuple: (Series di date o None, indici delle celle convertite con
+                parse_date, indici delle celle non convertibili)
+    """
+    valori = testo.dropna()
+    date = pd.Series(pd.NaT, index=testo.index, dtype='datetime64[ns]')
+    if not valori.empty:
+        esempio = valori.iloc[:campione]
+        ordine = sorted(formati, key=lambda f: -pd.to_datetime(esempio, format=f, errors='coerce').notna().sum())
+        for fmt in ordine:
+            convertite = pd.to_datetime(valori, format=fmt, errors='coerce')
+            date[convertite.index[convertite.notna()]] = convertite[convertite.notna()]
+            valori = valori[convertite.isna()]
+            if valori.empty:
+                break
+
+    risultato = date.dt.date.astype(object).where(date.notna(), None)
+    # Residui (formati liberi o fuori dall'intervallo di pandas): una conversione per valore distinto
+    residui = valori.map({v: parse_date(v) for v in valori.unique()})
+    risultato[residui.index] = residui
+    return risultato, residui.index[residui.notna()], residui.index[residui.isna()]
+
+
+# Campi anagrafica modello aggiornabili dal file rotture
+CAMPI_MODELLO = ['divisione', 'marca', 'desc_modello', 'produttore', 'famiglia', 'tipo']
+
+# Campi testo della rottura: attributo Rottura -> colonna TSV
+CAMPI_TESTO_ROTTURA = {
+    'cat': 'C.A.T.',
+    'flag_consumer': 'flag_consumer',
+    'flag_da_fatturare': 'flag_da_fatturare',
+    'cod_matricola': 'cod_matricola',
+    'cod_modello_fabbrica': 'cod_modello_fabbrica',
+    'difetto': 'difetto',
+    'problema_segnalato': 'problema_segnalato',
+    'riparazione': 'riparazione',
+}
+CAMPI_DATA_ROTTURA = ['data_competenza', 'data_acquisto', 'data_apertura']
+CAMPI_INTERI_ROTTURA = {'gg_vita_prodotto': 'gg_vita_prodotto', 'qta': 'qtà'}
+
+# Codici letti dal TSV (chiavi e campi delle tabelle collegate)
+COLONNE_CODICI = [
+    'prot', 'cod_modello', 'cod_componente', 'cod_utente', 'pv_utente', 'comune_utente',
+    'cod_rivenditore', 'pv_rivenditore',
+]
+
+
+def _colonna_testo(df, colonna):
+    """Colonna del TSV come testo senza spazi ai bordi; vuoto o mancante = NaN."""
+    if colonna not in df.columns:
+        return pd.Series(np.nan, index=df.index, dtype=object)
+    testo = df[colonna].str.strip()
+    return testo.mask(testo == '')
+
+
+def _righe_file(indici, massimo=20):
+    """Numeri di riga del file (header = riga 1) per il log, al più massimo."""
+    righe = [int(i) + 2 for i in indici[:massimo]]
+    return ", ".join(map(str, righe)) + (" ..." if len(indici) > massimo else "")
+
+
+def _valori(serie):
+    """Valori della serie per gli INSERT: NaN come None."""
+    return serie.astype(object).where(serie.notna(), None).tolist()
+
+
+def prepara_rotture(df):
+    """
+    Normalizza il frame TSV (letto come testo) con operazioni per colonna:
+    codici e campi testo ripuliti, date convertite, interi validati.
+    La colonna 'errore_formato' riporta i valori numerici non validi.
+    """
+    righe = pd.DataFrame({'riga_file': df.index + 2}, index=df.index)
+    for col in COLONNE_CODICI + CAMPI_MODELLO:
+        righe[col] = _colonna_testo(df, col)
+    for campo, col in CAMPI_TESTO_ROTTURA.items():
+        righe[campo] = _colonna_testo(df, col)
+
+    # Date: formato dedotto per colonna, parse_date solo per le celle residue
+    for campo in CAMPI_DATA_ROTTURA:
+        righe[campo], liberi, invalidi = normalizza_date(_colonna_testo(df, campo))
+        if len(liberi):
+            logger.info(f"📅 {campo}: {len(liberi)} date in formato non standard, righe {_righe_file(liberi)}")
+        if len(invalidi):
+            logger.warning(f"⚠️ {campo}: {len(invalidi)} date non riconosciute (lasciate vuote), righe {_righe_file(invalidi)}")
+
+    righe['errore_formato'] = pd.Series(np.nan, index=df.index, dtype=object)
+    for campo, col in CAMPI_INTERI_ROTTURA.items():
+        testo = _colonna_testo(df, col)
+        numeri = pd.to_numeric(testo, errors='coerce')
+        righe[campo] = np.trunc(numeri).astype('Int64')
+        invalidi = testo.notna() & numeri.isna() & righe['errore_formato'].isna()
+        righe.loc[invalidi, 'errore_formato'] = f"Valore non numerico per {col}: " + testo[invalidi]
+
+    righe['cod_componente_norm'] = righe['cod_componente'].str.lower().str.replace(' ', '', regex=False)
+    return righe
+
+
+def _valida_blocco_rotture(df):
+    """
+    Controlli di formato su un blocco di righe del TSV, senza database:
+    primo errore di ogni riga (NaN se valida) nell'ordine dell'elaborazione.
+    """
+    righe = prepara_rotture(df)
+    errori = serie_errori(righe.index)
+    segnala(errori, righe['prot'].isna(), "Protocollo mancante")
+    segnala(errori, righe['cod_modello'].isna(), "Modello mancante")
+    segnala(errori, righe['cod_utente'].isna(), "Utente mancante")
+    segnala(errori, righe['cod_rivenditore'].isna(), "Rivenditore mancante")
+    segnala(errori, righe['errore_formato'].notna(), righe['errore_formato'])
+    return righe, errori
+
+
+def valida_rotture(df, workers=None, chunk_size=None):
+    """
+    Stadio di validazione del TSV rotture (letto come testo), prima di
+    qualunque accesso al database: controlli per riga a blocchi (anche su più
+    processi, vedi utils.tsv_validation) e protocolli duplicati nel file.
+
+    Returns:
+        tuple: (righe valide normalizzate e tipizzate, frame errori
+                riga_file/chiave/messaggio)
+    """
+    righe, errori = valida_a_blocchi(df, _valida_blocco_rotture, workers, chunk_size)
+    segnala(errori, righe['prot'].notna() & righe['prot'].duplicated(),
+            "Protocollo " + righe['prot'].astype(str) + " duplicato nel file")
+    pulito = righe[errori.isna()].drop(columns='errore_formato')
+    return pulito, frame_errori(righe, errori, 'prot')
+
+
+def trace_errori(errori):
+    """Genera i dettagli trace KO (dict per TraceWriter.estendi) dal frame errori."""
+    for riga_file, chiave, messaggio in errori.itertuples(index=False):
+        yield {'record_pos': int(riga_file),
+               'record_data': {'key': chiave if isinstance(chiave, str) else f'riga_{int(riga_file)}'},
+               'stato': 'KO', 'messaggio': messaggio}
+
+
+def _errori_rotture(righe, cod_rottura, modelli, rotture_esistenti, norm_in_conflitto):
+    """Controlli sulle righe già validate che richiedono il database."""
+    errori = serie_errori(righe.index)
+    segnala(errori, ~righe['cod_modello'].isin(set(modelli)),
+            "Modello " + righe['cod_modello'].astype(str) + " non trovato in anagrafica")
+    segnala(errori, righe['cod_componente'].isin(norm_in_conflitto),
+            "Componente " + righe['cod_componente'].astype(str) + ": codice normalizzato già presente in anagrafica")
+    segnala(errori, cod_rottura.isin(rotture_esistenti), "Rottura " + cod_rottura + " già presente")
+    return errori
+
+
+def _trace_righe(righe, cod_rottura, modelli, utenti_esistenti, rivenditori_esistenti, componenti_esistenti):
+    """
+    Genera i dettagli trace (dict per TraceWriter.estendi) delle righe
+    caricate, nell'ordine del file: uno alla volta, senza accumularli.
+    """
+    # Divisione/marca del modello dopo l'aggiornamento della riga (ultimo valore valorizzato)
+    correnti = {}
+    for campo in ('divisione', 'marca'):
+        iniziali = righe['cod_modello'].map({m: valori[campo] for m, valori in modelli.items()})
+        correnti[campo] = righe.groupby('cod_modello')[campo].ffill().fillna(iniziali)
+    aggiornato = righe[CAMPI_MODELLO].notna().any(axis=1)
+    utente_nuovo = ~righe['cod_utente'].isin(utenti_esistenti) & ~righe['cod_utente'].duplicated()
+    rivenditore_nuovo = ~righe['cod_rivenditore'].isin(rivenditori_esistenti) & ~righe['cod_rivenditore'].duplicated()
+    componente_nuovo = (righe['cod_componente'].notna() & ~righe['cod_componente'].isin(componenti_esistenti)
+                        & ~righe['cod_componente'].duplicated())
+
+    colonne = zip(
+        righe['riga_file'], _valori(righe['prot']), _valori(righe['cod_modello']),
+        _valori(righe['cod_utente']), _valori(righe['pv_utente']), _valori(righe['comune_utente']),
+        _valori(righe['cod_rivenditore']), _valori(righe['pv_rivenditore']),
+        _valori(righe['cod_componente']), cod_rottura, _valori(righe['cod_matricola']), _valori(righe['difetto']),
+        _valori(correnti['divisione']), _valori(correnti['marca']),
+        aggiornato, utente_nuovo, rivenditore_nuovo, componente_nuovo
+    )
+    for (riga_file, prot, cod_modello, cod_utente, pv_utente, comune_utente, cod_rivenditore, pv_rivenditore,
+         cod_componente, cod_rot, cod_matricola, difetto, divisione, marca,
+         modello_aggiornato, utente_is_new, rivenditore_is_new, componente_is_new) in colonne:
+        riga_file = int(riga_file)
+
+        def _dett(record_data, messaggio, stato='OK'):
+            return {'record_pos': riga_file, 'record_data': record_data, 'stato': stato, 'messaggio': messaggio}
+
+        if modello_aggiornato:
+            yield _dett({'tipo': 'UPDATE_MODELLO', 'cod_modello': cod_modello, 'divisione': divisione, 'marca': marca},
+                        f'Aggiornato modello {cod_modello} da rotture')
+        yield _dett({'tipo': 'CREATE_UTENTE' if utente_is_new else 'UPDATE_UTENTE', 'cod_utente': cod_utente,
+                     'pv': pv_utente, 'comune': comune_utente},
+                    f'{"Creato" if utente_is_new else "Aggiornato"} utente {cod_utente}')
+        yield _dett({'tipo': 'CREATE_RIVENDITORE' if rivenditore_is_new else 'UPDATE_RIVENDITORE',
+                     'cod_rivenditore': cod_rivenditore, 'pv': pv_rivenditore},
+                    f'{"Creato" if rivenditore_is_new else "Aggiornato"} rivenditore {cod_rivenditore}')
+        if componente_is_new:
+            yield _dett({'tipo': 'CREATE_COMPONENTE', 'cod_componente': cod_componente},
+                        f'Creato componente {cod_componente} (non presente in anagrafiche)', 'WARN')
+        yield _dett({'tipo': 'CREATE_ROTTURA', 'prot': prot, 'cod_modello': cod_modello,
+                     'cod_matricola': cod_matricola, 'difetto': difetto},
+                    f'Creata rottura {prot} per modello {cod_modello}')
+        if cod_componente is not None:
+            yield _dett({'tipo': 'CREATE_ROTTURA_COMPONENTE', 'prot': prot,
+                         'cod_rottura': cod_rot, 'cod_componente': cod_componente},
+                        f'Associato componente {cod_componente} a rottura {prot}')
+
+
 def elabora_file_rottura_completo(file_rottura, db, current_user, current_app, models_dict, log_session):
     """
     Elaborazione completa file rotture:
@@ -39,6 +262,11 @@ def elabora_file_rottura_completo(file_rottura, db, current_user, current_app, m
     3. Inserisce/aggiorna database
     4. Gestisce trace ed errori (AUTONOMOUS TRANSACTION per log)
 
+    Caricamento set-based: il TSV è validato per intero con pandas, le chiavi
+    referenziate (modelli, utenti, rivenditori, componenti, rotture) sono lette
+    con poche query IN e le tabelle sono scritte con INSERT/UPSERT a blocchi.
+    Se anche una sola riga non è valida non viene scritto nulla (tutto o niente).
+
     Args:
         file_rottura: oggetto FileRottura
         db: istanza database
@@ -52,13 +280,7 @@ def elabora_file_rottura_completo(file_rottura, db, current_user, current_app, m
     """
     import os
 
-    # Estrai modelli dal dizionario
-    Rottura = models_dict['Rottura']
-    RotturaComponente = models_dict['RotturaComponente']
-    Modello = models_dict['Modello']
-    Componente = models_dict['Componente']
-    UtenteRottura = models_dict['UtenteRottura']
-    Rivenditore = models_dict['Rivenditore']
+    # Estrai modelli dal dizionario (le tabelle operative sono usate da carica_rotture)
     TraceElab = models_dict['TraceElab']
     TraceElabDett = models_dict['TraceElabDett']
 
@@ -87,8 +309,9 @@ def elabora_file_rottura_completo(file_rottura, db, current_user, current_app, m
     log_session.add(trace_start)
     log_session.commit()  # ← AUTONOMOUS: Commit immediato
 
-    # Usa trace_start.id_trace per i dettagli
+    # Usa trace_start.id_trace per i dettagli, scritti a blocchi durante l'elaborazione
     id_trace_start = trace_start.id_trace
+    dettagli = TraceWriter(log_session, TraceElabDett, id_trace_start)
 
     try:
         # STEP 1: Il TSV è già stato generato da genera_tsv_simulato_rotture()
@@ -96,7 +319,7 @@ def elabora_file_rottura_completo(file_rottura, db, current_user, current_app, m
         if not os.path.exists(tsv_filepath):
             raise Exception(f"File TSV non trovato: {tsv_filepath}. Assicurati di generare il TSV prima di elaborare.")
 
-        df = pd.read_csv(tsv_filepath, sep='\t', encoding='utf-8')
+        df = pd.read_csv(tsv_filepath, sep='\t', encoding='utf-8', dtype=str)
 
         trace_rec = TraceElabDett(
             id_trace=id_trace_start,
@@ -108,259 +331,18 @@ def elabora_file_rottura_completo(file_rottura, db, current_user, current_app, m
         log_session.add(trace_rec)
         log_session.commit()  # ← AUTONOMOUS: Log record persistito
 
-        # STEP 2: Leggi TSV e inserisci dati
-
-        num_rotture = 0
-        num_errori = 0
-        user_id = current_user.id if current_user.is_authenticated else None
-
-        for idx, row in df.iterrows():
-            riga_file = idx + 2  # +2 perché idx parte da 0 e c'è l'header
-
-            # Crea SAVEPOINT per questa riga (permette rollback parziale)
-            savepoint = db.session.begin_nested()
-
-            try:
-                # Estrai dati dalla riga (gestisci NaN di pandas)
-                prot_raw = row.get('prot', '')
-                prot = str(prot_raw).strip() if pd.notna(prot_raw) else ''
-
-                cod_modello_raw = row.get('cod_modello', '')
-                cod_modello = str(cod_modello_raw).strip() if pd.notna(cod_modello_raw) else ''
-
-                cod_componente_raw_val = row.get('cod_componente', '')
-                cod_componente_raw = str(cod_componente_raw_val).strip() if pd.notna(cod_componente_raw_val) else ''
-
-                if not prot:
-                    raise ValueError("Protocollo mancante")
-
-                # Normalizza codici
-                cod_modello_norm = normalizza_codice(cod_modello)
-                cod_componente_norm = normalizza_codice(cod_componente_raw)
-
-                # Verifica modello usando cod_modello (FK)
-                if cod_modello:
-                    modello = Modello.query.filter_by(cod_modello=cod_modello).first()
-                    if not modello:
-                        # Modello non trovato - segnala e skippa
-                        trace_rec = TraceElabDett(
-                            id_trace=id_trace_start,
-                            record_pos=riga_file,
-                            record_data={'key': f'rottura|{prot}'},
-                            stato='KO',
-                            messaggio=f'Modello {cod_modello} non trovato in anagrafica'
-                        )
-                        log_session.add(trace_rec)
-                        num_errori += 1
-                        continue
-
-                    # Aggiorna dati modello se presenti
-                    modello_aggiornato = False
-                    if row.get('divisione'):
-                        modello.divisione = str(row['divisione']).strip()
-                        modello_aggiornato = True
-                    if row.get('marca'):
-                        modello.marca = str(row['marca']).strip()
-                        modello_aggiornato = True
-                    if row.get('desc_modello'):
-                        modello.desc_modello = str(row['desc_modello']).strip()
-                        modello_aggiornato = True
-                    if row.get('produttore'):
-                        modello.produttore = str(row['produttore']).strip()
-                        modello_aggiornato = True
-                    if row.get('famiglia'):
-                        modello.famiglia = str(row['famiglia']).strip()
-                        modello_aggiornato = True
-                    if row.get('tipo'):
-                        modello.tipo = str(row['tipo']).strip()
-                        modello_aggiornato = True
-                    modello.updated_by = user_id
-                    modello.updated_from = 'rotture'
-
-                    # Trace UPDATE modello
-                    if modello_aggiornato:
-                        trace_rec = TraceElabDett(
-                            id_trace=id_trace_start,
-                            record_pos=riga_file,
-                            record_data={
-                                'tipo': 'UPDATE_MODELLO',
-                                'cod_modello': cod_modello,
-                                'divisione': modello.divisione,
-                                'marca': modello.marca
-                            },
-                            stato='OK',
-                            messaggio=f'Aggiornato modello {cod_modello} da rotture'
-                        )
-                        log_session.add(trace_rec)
-
-                # Gestisci UtenteRottura (insert/update)
-                cod_utente = str(row.get('cod_utente', '')).strip()
-                if cod_utente:
-                    utente = UtenteRottura.query.get(cod_utente)
-                    utente_is_new = (utente is None)
-                    if not utente:
-                        utente = UtenteRottura(cod_utente_rottura=cod_utente, created_by=user_id)
-                        db.session.add(utente)
-                    utente.pv_utente_rottura = str(row.get('pv_utente', '')).strip() if row.get('pv_utente') else None
-                    utente.comune_utente_rottura = str(row.get('comune_utente', '')).strip() if row.get('comune_utente') else None
-                    utente.updated_by = user_id
-
-                    # Trace CREATE/UPDATE utente
-                    trace_rec = TraceElabDett(
-                        id_trace=id_trace_start,
-                        record_pos=riga_file,
-                        record_data={
-                            'tipo': 'CREATE_UTENTE' if utente_is_new else 'UPDATE_UTENTE',
-                            'cod_utente': cod_utente,
-                            'pv': utente.pv_utente_rottura,
-                            'comune': utente.comune_utente_rottura
-                        },
-                        stato='OK',
-                        messaggio=f'{"Creato" if utente_is_new else "Aggiornato"} utente {cod_utente}'
-                    )
-                    log_session.add(trace_rec)
-
-                # Gestisci Rivenditore (insert/update)
-                cod_rivenditore = str(row.get('cod_rivenditore', '')).strip()
-                if cod_rivenditore:
-                    rivenditore = Rivenditore.query.get(cod_rivenditore)
-                    rivenditore_is_new = (rivenditore is None)
-                    if not rivenditore:
-                        rivenditore = Rivenditore(cod_rivenditore=cod_rivenditore, created_by=user_id)
-                        db.session.add(rivenditore)
-                    rivenditore.pv_rivenditore = str(row.get('pv_rivenditore', '')).strip() if row.get('pv_rivenditore') else None
-                    rivenditore.updated_by = user_id
-
-                    # Trace CREATE/UPDATE rivenditore
-                    trace_rec = TraceElabDett(
-                        id_trace=id_trace_start,
-                        record_pos=riga_file,
-                        record_data={
-                            'tipo': 'CREATE_RIVENDITORE' if rivenditore_is_new else 'UPDATE_RIVENDITORE',
-                            'cod_rivenditore': cod_rivenditore,
-                            'pv': rivenditore.pv_rivenditore
-                        },
-                        stato='OK',
-                        messaggio=f'{"Creato" if rivenditore_is_new else "Aggiornato"} rivenditore {cod_rivenditore}'
-                    )
-                    log_session.add(trace_rec)
-
-                # Gestisci Componente usando cod_componente (FK)
-                if cod_componente_raw:
-                    componente = Componente.query.filter_by(cod_componente=cod_componente_raw).first()
-                    if not componente:
-                        # Nota: secondo le specifiche, i componenti dovrebbero essere READ only
-                        # Ma il codice esistente li crea se non esistono - mantengo comportamento
-                        componente = Componente(
-                            cod_componente=cod_componente_raw,
-                            cod_componente_norm=cod_componente_norm,
-                            created_by=user_id
-                        )
-                        db.session.add(componente)
-
-                        # Trace CREATE componente (anche se non nelle specifiche originali)
-                        trace_rec = TraceElabDett(
-                            id_trace=id_trace_start,
-                            record_pos=riga_file,
-                            record_data={
-                                'tipo': 'CREATE_COMPONENTE',
-                                'cod_componente': cod_componente_raw
-                            },
-                            stato='WARN',
-                            messaggio=f'Creato componente {cod_componente_raw} (non presente in anagrafiche)'
-                        )
-                        log_session.add(trace_rec)
-                    # Aggiorna campi non chiave (qui puoi aggiungere logica per altri campi)
-                    componente.updated_by = user_id
-
-                # Crea Rottura
-                cod_rottura = f"{file_rottura.id}|{prot}"
-                rottura = Rottura(
-                    cod_rottura=cod_rottura,
-                    id_file_rotture=file_rottura.id,
-                    prot=prot,
-                    cod_modello=cod_modello if cod_modello else None,
-                    cod_rivenditore=cod_rivenditore if cod_rivenditore else None,
-                    cod_utente=cod_utente if cod_utente else None,
-                    cat=str(row.get('C.A.T.', '')).strip() if pd.notna(row.get('C.A.T.')) and str(row.get('C.A.T.')).strip() else None,
-                    flag_consumer=str(row.get('flag_consumer', '')).strip() if pd.notna(row.get('flag_consumer')) and str(row.get('flag_consumer')).strip() else None,
-                    flag_da_fatturare=str(row.get('flag_da_fatturare', '')).strip() if pd.notna(row.get('flag_da_fatturare')) and str(row.get('flag_da_fatturare')).strip() else None,
-                    cod_matricola=str(row.get('cod_matricola', '')).strip() if pd.notna(row.get('cod_matricola')) and str(row.get('cod_matricola')).strip() else None,
-                    cod_modello_fabbrica=str(row.get('cod_modello_fabbrica', '')).strip() if pd.notna(row.get('cod_modello_fabbrica')) and str(row.get('cod_modello_fabbrica')).strip() else None,
-                    data_competenza=parse_date(row.get('data_competenza')),
-                    data_acquisto=parse_date(row.get('data_acquisto')),
-                    data_apertura=parse_date(row.get('data_apertura')),
-                    difetto=str(row.get('difetto', '')).strip() if pd.notna(row.get('difetto')) and str(row.get('difetto')).strip() else None,
-                    problema_segnalato=str(row.get('problema_segnalato', '')).strip() if pd.notna(row.get('problema_segnalato')) and str(row.get('problema_segnalato')).strip() else None,
-                    riparazione=str(row.get('riparazione', '')).strip() if pd.notna(row.get('riparazione')) and str(row.get('riparazione')).strip() else None,
-                    gg_vita_prodotto=int(row.get('gg_vita_prodotto')) if pd.notna(row.get('gg_vita_prodotto')) else None,
-                    qta=int(row.get('qtà')) if pd.notna(row.get('qtà')) else None,
-                    created_by=user_id
-                )
-                db.session.add(rottura)
-                db.session.flush()  # Per ottenere id_rottura
-
-                # Trace CREATE rottura
-                trace_rec = TraceElabDett(
-                    id_trace=id_trace_start,
-                    record_pos=riga_file,
-                    record_data={
-                        'tipo': 'CREATE_ROTTURA',
-                        'prot': prot,
-                        'cod_modello': cod_modello,
-                        'cod_matricola': rottura.cod_matricola,
-                        'difetto': rottura.difetto
-                    },
-                    stato='OK',
-                    messaggio=f'Creata rottura {prot} per modello {cod_modello}'
-                )
-                log_session.add(trace_rec)
-
-                # Crea relazione RotturaComponente
-                if cod_componente_raw:
-                    rottura_comp = RotturaComponente(
-                        cod_rottura=cod_rottura,
-                        cod_componente=cod_componente_raw,
-                        created_by=user_id
-                    )
-                    db.session.add(rottura_comp)
-
-                    # Trace CREATE rottura_componente
-                    trace_rec = TraceElabDett(
-                        id_trace=id_trace_start,
-                        record_pos=riga_file,
-                        record_data={
-                            'tipo': 'CREATE_ROTTURA_COMPONENTE',
-                            'prot': prot,
-                            'cod_rottura': cod_rottura,
-                            'cod_componente': cod_componente_raw
-                        },
-                        stato='OK',
-                        messaggio=f'Associato componente {cod_componente_raw} a rottura {prot}'
-                    )
-                    log_session.add(trace_rec)
-
-                num_rotture += 1
-
-                # Commit del savepoint (conferma operazioni per questa riga)
-                savepoint.commit()
-
-            except Exception as e:
-                # Rollback del savepoint (annulla operazioni per questa riga ma continua con le altre)
-                savepoint.rollback()
-                # Trace errore per singola riga
-                trace_rec = TraceElabDett(
-                    id_trace=id_trace_start,
-                    record_pos=riga_file,
-                    record_data={'key': prot if 'prot' in locals() else f'riga_{riga_file}'},
-                    stato='KO',
-                    messaggio=str(e)
-                )
-                log_session.add(trace_rec)
-                num_errori += 1
-                continue
-
-        # ALL OR NOTHING: se anche una sola riga ha errori, rollback completo
+        # Validazione di formato su tutto il file, prima di qualunque scrittura
+        righe, errori = valida_rotture(df)
+        if len(errori):
+            num_rotture, num_errori = 0, len(errori)
+            dettagli.estendi(trace_errori(errori))  # Dettagli righe KO
+        else:
+            user_id = current_user.id if current_user.is_authenticated else None
+            num_rotture, num_errori = carica_rotture(
+                righe, file_rottura.id, user_id, db.session, models_dict, dettagli
+            )
+
+        # ALL OR NOTHING: se anche una sola riga ha errori, nulla è stato scritto
         if num_errori > 0:
             db.session.rollback()
 
@@ -377,6 +359,7 @@ def elabora_file_rottura_completo(file_rottura, db, current_user, current_app, m
                 righe_errore=num_errori,
                 righe_warning=0
             )
+            dettagli.chiudi()
             log_session.add(trace_end)
             log_session.commit()  # ← AUTONOMOUS: Log END persistito
 
@@ -398,6 +381,7 @@ def elabora_file_rottura_completo(file_rottura, db, current_user, current_app, m
             righe_errore=0,
             righe_warning=0
         )
+        dettagli.chiudi()
         log_session.add(trace_end)
         log_session.commit()  # ← AUTONOMOUS: Log END persistito
 
@@ -405,6 +389,8 @@ def elabora_file_rottura_completo(file_rottura, db, current_user, current_app, m
 
     except Exception as e:
         db.session.rollback()  # ← Rollback solo tabelle operative, log già salvati!
+        log_session.rollback()
+        dettagli.chiudi()  # Dettagli ancora nel buffer
 
         # Crea trace END con errore critico
         trace_end = TraceElab(
@@ -423,3 +409,120 @@ def elabora_file_rottura_completo(file_rottura, db, current_user, current_app, m
         log_session.commit()  # ← AUTONOMOUS: Log END persistito anche su errore
 
         return False, f'Errore durante elaborazione: {str(e)}', 0
+
+
+def carica_rotture(righe, id_file, user_id, session, models_dict, trace, cache=None):
+    """
+    Carica le rotture già validate (valida_rotture) nella sessione (senza commit).
+
+    1. lettura delle chiavi referenziate con query IN
+    2. controlli che richiedono il database (modello in anagrafica, codici
+       componente normalizzati, rotture già presenti) con maschere pandas
+    3. se tutte valide: UPDATE modelli, UPSERT utenti/rivenditori, INSERT
+       componenti mancanti, rotture e rotture_componenti a blocchi
+
+    Args:
+        righe: frame pulito restituito da valida_rotture
+        trace: TraceWriter dei dettagli, alimentato riga per riga
+        cache: DimensionCache del run (se None ne crea una)
+
+    Returns:
+        tuple: (righe caricate, righe non valide); con righe non valide non
+               carica nulla e traccia solo le righe KO
+    """
+    Rottura = models_dict['Rottura']
+    RotturaComponente = models_dict['RotturaComponente']
+    Modello = models_dict['Modello']
+    Componente = models_dict['Componente']
+    UtenteRottura = models_dict['UtenteRottura']
+    Rivenditore = models_dict['Rivenditore']
+
+    cod_rottura = f"{id_file}|" + righe['prot']
+
+    # Chiavi referenziate già presenti nel database (una query IN per blocco di chiavi)
+    if cache is None:
+        cache = DimensionCache(session)
+    modelli = {
+        cod: {c: getattr(modello, c) for c in CAMPI_MODELLO}
+        for cod, modello in cache.precarica(Modello, 'cod_modello', righe['cod_modello'].dropna()).items()
+        if modello is not None
+    }
+    cache.precarica(UtenteRottura, 'cod_utente_rottura', righe['cod_utente'].dropna())
+    cache.precarica(Rivenditore, 'cod_rivenditore', righe['cod_rivenditore'].dropna())
+    cache.precarica(Componente, 'cod_componente', righe['cod_componente'].dropna())
+    utenti_esistenti = cache.esistenti(UtenteRottura, 'cod_utente_rottura')
+    rivenditori_esistenti = cache.esistenti(Rivenditore, 'cod_rivenditore')
+    componenti_esistenti = cache.esistenti(Componente, 'cod_componente')
+    rotture_esistenti = {r[0] for r in fetch_by_keys(
+        session, [Rottura.cod_rottura], Rottura.cod_rottura, cod_rottura)}
+
+    # Componenti nuovi: il codice normalizzato deve restare univoco (vince il primo nel file)
+    nuovi = righe.loc[righe['cod_componente'].notna() & ~righe['cod_componente'].isin(componenti_esistenti),
+                      ['cod_componente', 'cod_componente_norm']].drop_duplicates('cod_componente')
+    cache.precarica(Componente, 'cod_componente_norm', nuovi['cod_componente_norm'])
+    norm_esistenti = cache.esistenti(Componente, 'cod_componente_norm')
+    in_conflitto = nuovi['cod_componente_norm'].isin(norm_esistenti) | nuovi['cod_componente_norm'].duplicated()
+    norm_in_conflitto = set(nuovi.loc[in_conflitto, 'cod_componente'])
+    nuovi = nuovi[~in_conflitto]
+
+    errori = _errori_rotture(righe, cod_rottura, modelli, rotture_esistenti, norm_in_conflitto)
+    if errori.notna().any():
+        # Nessuna scrittura: trace solo per le righe non valide
+        errori = frame_errori(righe, errori, 'prot')
+        trace.estendi(trace_errori(errori))
+        return 0, len(errori)
+
+    creato_da = {'created_by': user_id} if user_id is not None else {}
+
+    # Modelli: ultimo valore valorizzato di ogni campo nel file
+    aggiornamenti = righe.groupby('cod_modello', sort=False)[CAMPI_MODELLO].last()
+    update_rows(session, Modello, [
+        {'cod_modello': cod_modello, 'updated_by': user_id, 'updated_from': 'rotture',
+         **{c: v for c, v in zip(CAMPI_MODELLO, valori) if v is not None}}
+        for cod_modello, *valori in aggiornamenti.astype(object).where(aggiornamenti.notna(), None).itertuples()
+    ])
+
+    # Utenti e rivenditori: vale l'ultima riga del file per ogni codice
+    utenti = righe.drop_duplicates('cod_utente', keep='last')
+    upsert_rows(session, UtenteRottura, [
+        {'cod_utente_rottura': cod, 'pv_utente_rottura': pv, 'comune_utente_rottura': comune,
+         'updated_by': user_id, **creato_da}
+        for cod, pv, comune in zip(utenti['cod_utente'], _valori(utenti['pv_utente']), _valori(utenti['comune_utente']))
+    ], ['cod_utente_rottura'], ['pv_utente_rottura', 'comune_utente_rottura', 'updated_by'])
+    rivenditori = righe.drop_duplicates('cod_rivenditore', keep='last')
+    upsert_rows(session, Rivenditore, [
+        {'cod_rivenditore': cod, 'pv_rivenditore': pv, 'updated_by': user_id, **creato_da}
+        for cod, pv in zip(rivenditori['cod_rivenditore'], _valori(rivenditori['pv_rivenditore']))
+    ], ['cod_rivenditore'], ['pv_rivenditore', 'updated_by'])
+
+    # Componenti: creati se mancanti (comportamento storico), tracciati gli esistenti
+    insert_rows(session, Componente, [
+        {'cod_componente': cod, 'cod_componente_norm': norm, 'updated_by': user_id, **creato_da}
+        for cod, norm in zip(nuovi['cod_componente'], nuovi['cod_componente_norm'])
+    ])
+    update_rows(session, Componente, [
+        {'cod_componente': cod, 'updated_by': user_id}
+        for cod in righe['cod_componente'].dropna().unique() if cod in componenti_esistenti
+    ])
+
+    # Rotture e componenti sostituiti
+    valori = {campo: _valori(righe[campo]) for campo in (
+        'prot', 'cod_modello', 'cod_rivenditore', 'cod_utente',
+        *CAMPI_TESTO_ROTTURA, *CAMPI_DATA_ROTTURA
+    )}
+    for campo in CAMPI_INTERI_ROTTURA:
+        valori[campo] = [None if v is None else int(v) for v in _valori(righe[campo])]
+    insert_rows(session, Rottura, [
+        {'cod_rottura': cod, 'id_file_rotture': id_file, **creato_da,
+         **{campo: colonna[i] for campo, colonna in valori.items()}}
+        for i, cod in enumerate(cod_rottura)
+    ])
+    con_componente = righe['cod_componente'].notna()
+    insert_rows(session, RotturaComponente, [
+        {'cod_rottura': cod, 'cod_componente': comp, **creato_da}
+        for cod, comp in zip(cod_rottura[con_componente], righe.loc[con_componente, 'cod_componente'])
+    ])
+
+    trace.estendi(_trace_righe(righe, cod_rottura, modelli, utenti_esistenti, rivenditori_esistenti,
+                               componenti_esistenti))
+    return len(righe), 0
@@ -7,6 +7,7 @@ Fixtures disponibili:
 - app: Flask app configurata per testing
 - client: Flask test client
 - db: Database per testing
+- sqlite_app: App Flask minimale con SQLite in memoria (pipeline su database)
 - runner: Flask CLI runner
 - auth: Helper per autenticazione nei test
 """
@@ -16,6 +17,8 @@ import os
 import tempfile
 from datetime import datetime, timezone
 
+from flask import Flask
+
 from app import create_app
 from models import db as _db, User
 from config import Config
@@ -127,6 +130,27 @@ def db(app):
         yield _db
 
 
+@pytest.fixture(scope='function')
+def sqlite_app():
+    """
+    App Flask minimale (senza blueprint né utenti) con SQLite in memoria e
+    tabelle create, per i test delle pipeline di elaborazione su database.
+    Il test gira dentro l'app context.
+
+    Yields:
+        Flask app con app context attivo
+    """
+    app = Flask(__name__)
+    app.config.update(SQLALCHEMY_DATABASE_URI='sqlite:///:memory:')
+    _db.init_app(app)
+
+    with app.app_context():
+        _db.create_all()
+        yield app
+        _db.session.remove()
+        _db.drop_all()
+
+
 class AuthActions:
     """Helper class per azioni di autenticazione nei test."""
 
@@ -0,0 +1,236 @@
+"""
+Unit Tests - Functions
+======================
+Test per le funzioni di calcolo affidabilità (functions.py).
+"""
+
+import pytest
+import numpy as np
+import pandas as pd
+
+from functions import (
+    weibull_logpost, fit_weibull_and_score, fit_weibull_map_batch, best_prior_weibull,
+    group_fingerprint, weighted_percentile, predict_group, kaplan_meier_grid,
+    prepara_gruppi, weibull_confidence_bands, domanda_flotta
+)
+
+
+def _dati_weibull(n=3000, k=1.4, lam=5000, seed=0):
+    """Genera tempi di vita Weibull censurati a 1095 giorni (E=1 censurato)."""
+    rng = np.random.default_rng(seed)
+    vita = lam * rng.weibull(k, n)
+    censura = rng.uniform(0, 1095, n)
+    T = np.maximum(np.minimum(vita, censura).round(), 1)
+    E = (vita > censura).astype(int)
+    return T, E
+
+
+# ============================================================================
+# Test Weibull MAP batch
+# ============================================================================
+
+@pytest.mark.unit
+def test_fit_weibull_map_batch_matches_scipy():
+    """Il fitter batch trova un MAP almeno buono quanto scipy per ogni prior."""
+    T, E = _dati_weibull()
+    k_priors = np.array([1.0, 1.1, 1.2])
+    lambda_priors = np.array([600.0, 800.0, 1000.0])
+
+    k_map, lam_map = fit_weibull_map_batch(T, E, k_priors, lambda_priors)
+
+    for i, (k_p, l_p) in enumerate(zip(k_priors, lambda_priors)):
+        _, k_ref, lam_ref = fit_weibull_and_score(
+            T, E, np.array([0.0]), np.array([1.0]), k_p, l_p, 0.05, 0.15
+        )
+        post_batch = weibull_logpost([k_map[i], lam_map[i]], T, E, k_p, l_p, 0.05, 0.15)
+        post_ref = weibull_logpost([k_ref, lam_ref], T, E, k_p, l_p, 0.05, 0.15)
+        assert post_batch <= post_ref + 1e-6
+        assert k_map[i] == pytest.approx(k_ref, rel=1e-2)
+        assert lam_map[i] == pytest.approx(lam_ref, rel=1e-2)
+
+
+@pytest.mark.unit
+def test_best_prior_weibull_returns_grid_prior():
+    """best_prior_weibull ritorna una coppia della griglia e parametri nei bound."""
+    T, E = _dati_weibull(seed=1)
+    giorni_grid = np.arange(0, 37) * 30.42
+    km_grid = giorni_grid[giorni_grid <= T[E == 0].max()]
+    surv_km = np.exp(-(km_grid / 5000) ** 1.4)
+    k_grid = np.linspace(1.0, 1.2, 6)
+    lambda_grid = np.linspace(np.percentile(T, 60), np.percentile(T, 90), 8)
+
+    (k_p, l_p), k_map, lam_map = best_prior_weibull(T, E, km_grid, surv_km, k_grid, lambda_grid)
+
+    assert k_p in k_grid
+    assert l_p in lambda_grid
+    assert 0.1 <= k_map <= 10
+    assert 10 <= lam_map <= 10000
+
+
+@pytest.mark.unit
+def test_weighted_fit_matches_expanded_rows():
+    """Righe con peso danno le stesse previsioni delle righe espanse una per unità."""
+    T, E = _dati_weibull(n=400)
+    T, E = np.round(T / 30) * 30, E  # tempi ripetuti, come le censure per lotto
+    chiavi, pesi = np.unique(np.stack([T, E]), axis=1, return_counts=True)
+    T_w, E_w = chiavi[0], chiavi[1].astype(int)
+
+    for q in (10, 50, 60, 90):
+        assert weighted_percentile(T_w, pesi, q) == pytest.approx(np.percentile(T, q))
+
+    pesata = predict_group(T_w, E_w, "pesata", seed=[0, 1], weights=pesi)
+    espansa = predict_group(T, E, "espansa", seed=[0, 1])
+    pesata.pop("titolo"), espansa.pop("titolo")
+    curve_pesate, curve_espanse = pesata.pop("curve"), espansa.pop("curve")
+    assert pesata.keys() == espansa.keys()
+    for chiave, valore in espansa.items():
+        assert pesata[chiave] == pytest.approx(valore, abs=1e-9)
+    for chiave, valori in curve_espanse.items():
+        np.testing.assert_allclose(curve_pesate[chiave], valori, atol=1e-9)
+
+
+# ============================================================================
+# Test bande di confidenza Weibull
+# ============================================================================
+
+@pytest.mark.unit
+def test_weibull_bands_bootstrap_reproducible():
+    """Bootstrap vettorizzato: stesso risultato del ciclo curva per curva, a parità di seed."""
+    giorni_grid = np.arange(0, 37) * 30.42
+    lower, upper = weibull_confidence_bands(None, None, 1.2, 4000, giorni_grid, rng=np.random.default_rng(7))
+
+    rng = np.random.default_rng(7)
+    k_samples = rng.normal(1.2, np.sqrt(0.05), 200)
+    lam_samples = rng.normal(4000, np.sqrt(0.15), 200)
+    k_samples, lam_samples = k_samples[k_samples > 0], lam_samples[lam_samples > 0]
+    curve = [np.exp(-(giorni_grid / lam)**k)
+             for k, lam in zip(rng.choice(k_samples, 200), rng.choice(lam_samples, 200))]
+
+    np.testing.assert_array_equal(lower, np.percentile(curve, 2.5, axis=0))
+    np.testing.assert_array_equal(upper, np.percentile(curve, 97.5, axis=0))
+
+
+@pytest.mark.unit
+def test_weibull_bands_delta_contains_curve():
+    """La banda analitica contiene la curva MAP, vale 1 a t=0 ed è vicina al bootstrap."""
+    giorni_grid = np.arange(0, 37) * 30.42
+    surv = np.exp(-(giorni_grid / 4000)**1.2)
+
+    lower, upper = weibull_confidence_bands(None, None, 1.2, 4000, giorni_grid, method="delta")
+    boot_lower, boot_upper = weibull_confidence_bands(
+        None, None, 1.2, 4000, giorni_grid, n_boot=5000, rng=np.random.default_rng(0)
+    )
+
+    assert lower[0] == upper[0] == 1.0
+    assert np.all(lower <= surv) and np.all(surv <= upper)
+    np.testing.assert_allclose(lower, boot_lower, atol=0.05)
+    np.testing.assert_allclose(upper, boot_upper, atol=0.05)
+    with pytest.raises(ValueError):
+        weibull_confidence_bands(None, None, 1.2, 4000, giorni_grid, method="altro")
+
+
+# ============================================================================
+# Test Kaplan-Meier su griglia
+# ============================================================================
+
+@pytest.mark.unit
+def test_kaplan_meier_grid_matches_lifelines():
+    """KM multi-gruppo pesato uguale a lifelines + interpolazione sulla griglia."""
+    lifelines = pytest.importorskip("lifelines")
+    from scipy.interpolate import interp1d
+
+    giorni_grid = np.arange(0, 37) * 30.42
+    gruppi = []
+    for seed in range(4):
+        T, E = _dati_weibull(n=150, seed=seed)
+        pesi = np.random.default_rng(seed).integers(1, 20, len(T))
+        gruppi.append((np.round(T), E, pesi))
+    # Gruppo in cui tutte le unità si rompono: S arriva a 0
+    gruppi.append((np.array([10.0, 20.0, 20.0]), np.zeros(3, dtype=int), np.array([1, 2, 1])))
+    offsets = np.concatenate([[0], np.cumsum([len(T) for T, _, _ in gruppi])])
+
+    surv, lower, upper = kaplan_meier_grid(
+        np.concatenate([T for T, _, _ in gruppi]),
+        np.concatenate([E == 0 for _, E, _ in gruppi]),
+        giorni_grid,
+        weights=np.concatenate([p for _, _, p in gruppi]),
+        offsets=offsets
+    )
+
+    for i, (T, E, pesi) in enumerate(gruppi):
+        kmf = lifelines.KaplanMeierFitter().fit(T, event_observed=E == 0, weights=pesi)
+        attese = [
+            kmf.survival_function_.iloc[:, 0],
+            kmf.confidence_interval_.iloc[:, 0],
+            kmf.confidence_interval_.iloc[:, 1],
+        ]
+        for curva, attesa in zip((surv[i], lower[i], upper[i]), attese):
+            f = interp1d(attesa.index, attesa.values, bounds_error=False, fill_value=(1, attesa.values[-1]))
+            np.testing.assert_allclose(curva, f(giorni_grid), atol=1e-12)
+
+
+# ============================================================================
+# Test preparazione gruppi
+# ============================================================================
+
+@pytest.mark.unit
+def test_prepara_gruppi_slices_per_group():
+    """Un solo ordinamento: fette contigue per gruppo, ordine modelli e prima apparizione."""
+    df = pd.DataFrame({
+        "Modello": ["M2", "M1", "M2", "M1", "M1", "M3"],
+        "Codice Componente": ["B", "C", "A", "A", "C", "X"],
+        "Tempo di Vita": [5, 1, 6, 2, 3, 9],
+        "Censura": [0, 1, 0, 1, 0, 1],
+        "Peso": [1, 10, 1, 20, 1, 5],
+    })
+
+    prep = prepara_gruppi(df, ["M1", "M2"], "Codice Componente")
+
+    assert prep["chiavi"] == [("M1", "C"), ("M1", "A"), ("M2", "B"), ("M2", "A")]
+    assert prep["offsets"].tolist() == [0, 2, 3, 4, 5]
+    assert prep["T"].tolist() == [1, 3, 2, 5, 6]
+    assert prep["censura"].tolist() == [1, 0, 1, 0, 0]
+    assert prep["pesi"].tolist() == [10, 1, 20, 1, 1]
+
+
+# ============================================================================
+# Test fingerprint per cache incrementale
+# ============================================================================
+
+@pytest.mark.unit
+def test_group_fingerprint_ignores_row_order():
+    """Il fingerprint non dipende dall'ordine delle righe ma dai dati e dai parametri."""
+    T, E = _dati_weibull(n=200)
+    perm = np.random.default_rng(0).permutation(len(T))
+    params = {"riskset_threshold": 1000, "seed": 0}
+
+    fp = group_fingerprint("M1", "C1", T, E, params)
+
+    assert fp == group_fingerprint("M1", "C1", T[perm], E[perm], params)
+    assert fp != group_fingerprint("M1", "C1", T[1:], E[1:], params)
+    assert fp != group_fingerprint("M1", "C1", T, E, {**params, "seed": 1})
+    assert fp != group_fingerprint("M1", "C2", T, E, params)
+
+
+# ============================================================================
+# Test previsione di flotta
+# ============================================================================
+
+@pytest.mark.unit
+def test_domanda_flotta_matches_loop():
+    """Il prodotto sparso coincide con la somma esplicita su modelli e voci BOM."""
+    quantita = np.array([10, 4])
+    # Voci BOM: (modello, componente, pezzi)
+    bom_m = np.array([0, 0, 1, 1])
+    bom_c = np.array([0, 1, 1, 2])
+    bom_q = np.array([2, 1, 3, 1])
+    prob = np.array([[0.1, 0.2], [0.5, 0.6], [0.05, 0.1], [np.nan, np.nan]])
+
+    installati, attesi, non_coperti = domanda_flotta(quantita, bom_m, bom_c, bom_q, prob, 3)
+
+    atteso = np.zeros((3, 2))
+    for m, c, q, p in zip(bom_m, bom_c, bom_q, prob):
+        atteso[c] += quantita[m] * q * np.nan_to_num(p)
+    np.testing.assert_allclose(attesi, atteso)
+    np.testing.assert_allclose(installati, [20, 22, 4])
+    np.testing.assert_allclose(non_coperti, [0, 0, 4])
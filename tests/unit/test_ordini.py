@@ -0,0 +1,56 @@
+"""
+Unit Tests - Ordini
+===================
+Test per l'elaborazione dei file ordini (routes/ordini_funzioni_elaborazione.py).
+"""
+
+import pytest
+
+
+# ============================================================================
+# Test elaborazione ordini
+# ============================================================================
+
+@pytest.mark.unit
+def test_dimension_cache_ordini(tmp_path, sqlite_app):
+    """Elaborazione ordini: ogni chiave dimensione letta al più una volta, entità nuove riusate."""
+    from sqlalchemy import event
+    from models import db as _db, FileOrdine, Controparte, Modello, Ordine
+    from routes.ordini_funzioni_elaborazione import elabora_tsv_ordine
+    from utils.dim_cache import DimensionCache
+
+    righe = [
+        ["PO1.xlsx", "S1", "Seller", "B1", "Buyer", "2024-03-01", "Ordine", "PO1", "HISENSE", "1", "", "M1", "10", "2", "20"],
+        ["PO1.xlsx", "S1", "Seller", "B1", "Buyer", "2024-03-01", "Ordine", "PO1", "HISENSE", "2", "", "m2", "10", "1", "10"],
+        ["PO1.xlsx", "S1", "Seller", "B1", "Buyer", "2024-03-01", "Ordine", "PO2", "HISENSE", "3", "", "M2", "10", "1", "10"],
+    ]
+    tsv = tmp_path / "PO1.tsv"
+    tsv.write_text("header\n" + "\n".join("\t".join(r) for r in righe) + "\n", encoding="utf-8")
+
+    _db.session.add(FileOrdine(id=1, anno=2024, filename="PO1.xlsx", filepath="/tmp/PO1.xlsx"))
+    _db.session.add(Modello(cod_modello="M1", cod_modello_norm="M1"))
+    _db.session.commit()
+
+    select_dimensioni = []
+
+    @event.listens_for(_db.engine, "before_cursor_execute")
+    def _conta(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith("SELECT") and ("FROM modelli" in statement or "FROM controparti" in statement):
+            select_dimensioni.append(statement)
+
+    success, _, stats = elabora_tsv_ordine(1, str(tsv), 1)
+    event.remove(_db.engine, "before_cursor_execute", _conta)
+
+    assert success, stats
+    # Una query IN per controparti e una per modelli, nessuna per riga
+    assert len(select_dimensioni) == 2
+    # "m2" e "M2" hanno lo stesso codice normalizzato: un solo modello creato
+    assert sorted(m.cod_modello for m in Modello.query) == ["M1", "m2"]
+    assert Controparte.query.count() == 2
+    assert sorted(o.ordine_modello for o in Ordine.query) == ["PO1|M1", "PO1|m2", "PO2|m2"]
+
+    cache = DimensionCache(_db.session)
+    cache.precarica(Modello, 'cod_modello', ["M1", "M9"])
+    assert cache.esistenti(Modello, 'cod_modello') == {"M1"}
+    assert cache.get(Modello, 'cod_modello', "M9") is None
+    assert cache.query_eseguite == 1
@@ -0,0 +1,67 @@
+"""
+Unit Tests - Preprocessing
+==========================
+Test per la costruzione del dataset di affidabilità (preprocessing.py).
+"""
+
+import pytest
+import pandas as pd
+
+from preprocessing import build_df_affid
+
+
+# ============================================================================
+# Test build_df_affid (assegnazione FIFO rotture -> lotti)
+# ============================================================================
+
+@pytest.mark.unit
+def test_build_df_affid_fifo_assignment():
+    """Le rotture prendono il lotto più vecchio disponibile, nell'ordine del file."""
+    df_componenti = pd.DataFrame([
+        {"Modello": "M1", "Codice Componente": "C1", "Data Acquisto": "01/01/2022", "Quantità": 1},
+        {"Modello": "M1", "Codice Componente": "C1", "Data Acquisto": "01/01/2023", "Quantità": 2},
+        {"Modello": "M1", "Codice Componente": "C2", "Data Acquisto": "01/06/2022", "Quantità": 1},
+    ])
+    df_rotture = pd.DataFrame([
+        # Prende il lotto 2022 (il più vecchio)
+        {"Modello": "M1", "Codice Componente": "C1", "Data Apertura": "01/03/2024"},
+        # Data precedente al lotto 2023 e lotto 2022 esaurito -> nessuna assegnazione
+        {"Modello": "M1", "Codice Componente": "C1", "Data Apertura": "01/06/2022"},
+        # Prende il lotto 2023
+        {"Modello": "M1", "Codice Componente": "C1", "Data Apertura": "01/02/2023"},
+        # Modello non presente nelle componenti -> ignorata
+        {"Modello": "M9", "Codice Componente": "C1", "Data Apertura": "01/02/2023"},
+    ])
+
+    df = build_df_affid(df_componenti, df_rotture, data_censura="2024-12-31")
+
+    eventi = df[df["Censura"] == 0]
+    assert eventi["Data Acquisto"].dt.year.tolist() == [2022, 2023]
+    assert eventi["Tempo di Vita"].tolist() == [
+        (pd.Timestamp("2024-03-01") - pd.Timestamp("2022-01-01")).days,
+        (pd.Timestamp("2023-02-01") - pd.Timestamp("2023-01-01")).days,
+    ]
+
+    # Residui censurati: 1 unità del lotto C1/2023 e 1 unità del lotto C2
+    censure = df[df["Censura"] == 1]
+    assert len(censure) == 2
+    assert sorted(censure["Codice Componente"].tolist()) == ["C1", "C2"]
+    assert censure["Data Rottura"].isna().all()
+    assert df["Peso"].tolist() == [1, 1, 1, 1]
+
+
+@pytest.mark.unit
+def test_build_df_affid_censure_aggregate_per_lotto():
+    """Il residuo di un lotto è una sola riga censurata con Peso pari al residuo."""
+    df_componenti = pd.DataFrame([
+        {"Modello": "M1", "Codice Componente": "C1", "Data Acquisto": "01/01/2022", "Quantità": 500},
+    ])
+    df_rotture = pd.DataFrame([
+        {"Modello": "M1", "Codice Componente": "C1", "Data Apertura": "01/03/2023"},
+    ])
+
+    df = build_df_affid(df_componenti, df_rotture, data_censura="2024-12-31")
+
+    assert len(df) == 2
+    assert df.loc[df["Censura"] == 1, "Peso"].tolist() == [499]
+    assert df["Peso"].sum() == 500
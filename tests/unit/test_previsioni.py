@@ -0,0 +1,224 @@
+"""
+Unit Tests - Previsioni
+=======================
+Test per caricamento dati, snapshot e ricerca ordini delle previsioni (routes/previsioni.py).
+"""
+
+import pytest
+
+
+# ============================================================================
+# Test indice statistiche storiche
+# ============================================================================
+
+@pytest.mark.unit
+def test_historical_index_counts_weighted_units():
+    """L'indice conta le unità (colonna Peso) per componente e per gruppo STAT."""
+    import pandas as pd
+    from routes.previsioni import build_historical_index, get_historical_stats
+
+    df = pd.DataFrame({
+        "Modello": ["M1", "M1", "M1", "M2"],
+        "Codice Componente": ["C1", "C1", "C2", "C1"],
+        "stat": ["S1", "S1", "S1", None],
+        "Censura": [0, 1, 0, 1],
+        "Peso": [1, 40, 1, 7],
+    })
+
+    index = build_historical_index(df)
+
+    assert get_historical_stats(index, "M1", "C1", "Componente") == {'total': 41, 'broken': 1}
+    assert get_historical_stats(index, "M1", "S1", "STAT") == {'total': 42, 'broken': 2}
+    assert get_historical_stats(index, "M2", "C1", "Componente") == {'total': 7, 'broken': 0}
+    assert get_historical_stats(index, "M2", "C9", "Componente") == {'total': 0, 'broken': 0}
+
+
+@pytest.mark.unit
+def test_reliability_stats_cumulative_thresholds():
+    """Rotture entro soglia e unità attive contate con gli istogrammi cumulativi pesati."""
+    from routes.previsioni import reliability_stats, format_reliability_summary
+
+    # Rotture a 100 e 400 giorni, lotto di 10 unità censurato a 300 giorni
+    stats = reliability_stats([100, 400, 300], [0, 0, 1], [1, 1, 10])
+
+    assert stats['total'] == 12
+    assert stats['broken'] == 2
+    assert stats['rotture_cumulative']['6'] == 1
+    assert stats['rotture_cumulative']['18'] == 2
+    assert stats['attivi']['0'] == 12
+    assert stats['attivi']['6'] == 11
+    assert stats['attivi']['12'] == 1
+    assert "Entro 36 mesi: 2 rotture" in format_reliability_summary(stats, "M1", "C1")
+
+
+# ============================================================================
+# Test caricamento dati e snapshot
+# ============================================================================
+
+@pytest.mark.unit
+def test_load_data_single_flight(monkeypatch):
+    """Caricamenti concorrenti eseguono _load_data una sola volta."""
+    import threading
+    import time
+    import routes.previsioni as previsioni
+
+    chiamate = []
+
+    def finto_caricamento():
+        chiamate.append(1)
+        time.sleep(0.05)
+        snapshot = previsioni._nuovo_snapshot()
+        snapshot.update(loaded=True, versione=time.time())
+        return snapshot
+
+    monkeypatch.setattr(previsioni, '_data_cache', previsioni._nuovo_snapshot())
+    monkeypatch.setattr(previsioni, '_load_status', dict(previsioni._load_status))
+    monkeypatch.setattr(previsioni, '_load_data', finto_caricamento)
+    monkeypatch.setattr(previsioni, 'WATCH_INTERVAL', 0)
+
+    threads = [threading.Thread(target=previsioni.load_data_if_needed) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(chiamate) == 1
+    assert previsioni._load_status['stato'] == 'pronto'
+    assert previsioni.start_background_load() is True
+
+
+@pytest.mark.unit
+def test_reload_failure_keeps_serving_snapshot(monkeypatch):
+    """Una ricarica fallita lascia in servizio lo snapshot precedente."""
+    import routes.previsioni as previsioni
+
+    attuale = previsioni._nuovo_snapshot()
+    attuale.update(loaded=True, versione=1.0)
+
+    def caricamento_fallito():
+        raise FileNotFoundError("file sorgente mancante")
+
+    monkeypatch.setattr(previsioni, '_data_cache', attuale)
+    monkeypatch.setattr(previsioni, '_load_status', dict(previsioni._load_status, stato='pronto'))
+    monkeypatch.setattr(previsioni, '_load_data', caricamento_fallito)
+
+    with pytest.raises(FileNotFoundError):
+        previsioni.reload_data()
+
+    assert previsioni._data_cache is attuale
+    assert previsioni._load_status['stato'] == 'pronto'
+    assert previsioni._load_status['in_ricarica'] is False
+    assert "mancante" in previsioni._load_status['errore_ricarica']
+
+
+@pytest.mark.unit
+def test_assicura_previsioni_pubblica_nuovo_snapshot(monkeypatch):
+    """Le previsioni calcolate su richiesta arrivano in un nuovo snapshot, quello servito non cambia."""
+    import routes.previsioni as previsioni
+
+    attuale = previsioni._nuovo_snapshot()
+    attuale.update(loaded=True, versione=1.0, modelli=['M1', 'M2'],
+                   precomputed_predictions={'M1': {}}, precomputed_predictions_stat={'M1': {}})
+
+    def finto_calcolo(snapshot, modelli):
+        return {m: {'C1': {'prev12': 0.1}} for m in modelli}, {m: {} for m in modelli}
+
+    monkeypatch.setattr(previsioni, '_data_cache', attuale)
+    monkeypatch.setattr(previsioni, '_load_status', dict(previsioni._load_status))
+    monkeypatch.setattr(previsioni, '_calcola_previsioni_modelli', finto_calcolo)
+
+    nuovo = previsioni.assicura_previsioni(attuale, ['M2', 'M9'])
+
+    assert nuovo is not attuale and previsioni._data_cache is nuovo
+    assert list(nuovo['precomputed_predictions']) == ['M1', 'M2']
+    assert list(attuale['precomputed_predictions']) == ['M1']
+    assert previsioni.assicura_previsioni(attuale, ['M2']) is nuovo  # Già pubblicato
+
+
+@pytest.mark.unit
+def test_seleziona_modelli_order_and_limits(monkeypatch):
+    """Modelli ordinati per rotture, filtrati per soglia, lotti disponibili e limite."""
+    import pandas as pd
+    import routes.previsioni as previsioni
+
+    df_rotture = pd.DataFrame({"Modello": ["B", "A", "B", "C", "B", "A", "D"]})
+    json_per_data = {"A": {}, "B": {}, "C": {}}  # D senza lotti di produzione
+
+    monkeypatch.setattr(previsioni, 'MODELLI_MIN_ROTTURE', 1)
+    monkeypatch.setattr(previsioni, 'MODELLI_MAX', 0)
+    assert previsioni.seleziona_modelli(df_rotture, json_per_data) == ["B", "A", "C"]
+
+    monkeypatch.setattr(previsioni, 'MODELLI_MIN_ROTTURE', 2)
+    assert previsioni.seleziona_modelli(df_rotture, json_per_data) == ["B", "A"]
+
+    monkeypatch.setattr(previsioni, 'MODELLI_MAX', 1)
+    assert previsioni.seleziona_modelli(df_rotture, json_per_data) == ["B"]
+
+
+# ============================================================================
+# Test ricerca modelli per ordine (Excel e database)
+# ============================================================================
+
+@pytest.mark.unit
+def test_orders_excel_index_cached_and_invalidated(tmp_path, monkeypatch, caplog):
+    """L'Excel ordini è letto una volta per versione e indicizzato per file."""
+    import os
+    import pandas as pd
+    import routes.previsioni as previsioni
+
+    path = tmp_path / "ordini.xlsx"
+    pd.DataFrame({
+        "File": ["PO1", "PO1", "PO1", "PO2"],
+        "Modello": ["M2", "M1", "M2", "M1"],
+        "Quantità Ordinata": ["12,0", 3, "x", 5],
+    }).to_excel(path, index=False)
+
+    monkeypatch.setattr(previsioni, "ORDERS_XLSX_PATH", str(path))
+    monkeypatch.setattr(previsioni, "_orders_cache", {'signature': None, 'index': {}})
+    letture = []
+    originale = pd.read_excel
+    monkeypatch.setattr(previsioni.pd, "read_excel", lambda *a, **k: letture.append(1) or originale(*a, **k))
+
+    assert previsioni.get_modelli_e_quantita_from_orders_excel("PO1") == (["M1", "M2"], {"M1": 3, "M2": 12})
+    assert previsioni.get_modelli_from_orders_excel("PO2") == ["M1"]
+    assert previsioni.get_modelli_e_quantita_from_orders_excel("PO9") == ([], {})
+    assert len(letture) == 1
+
+    pd.DataFrame({"File": ["PO1"], "Modello": ["M3"], "Qty": [7]}).to_excel(path, index=False)
+    os.utime(path, ns=(0, 10**9))  # mtime sicuramente diverso
+    assert previsioni.get_modelli_e_quantita_from_orders_excel("PO1") == (["M3"], {"M3": 7})
+    assert len(letture) == 2
+
+    # File rimosso: indice vuoto, avviso registrato una sola volta
+    os.remove(path)
+    with caplog.at_level("WARNING", logger=previsioni.logger.name):
+        assert previsioni.get_modelli_from_orders_excel("PO1") == []
+        assert previsioni.get_modelli_from_orders_excel("PO1") == []
+    assert sum("non trovato" in r.getMessage() for r in caplog.records) == 1
+
+
+@pytest.mark.unit
+def test_order_lookup_from_db(monkeypatch, sqlite_app):
+    """Modelli e quantità di un ordine elaborato con una query aggregata sul database."""
+    from datetime import date
+    from models import db as _db, FileOrdine, Ordine, Modello
+    import routes.previsioni as previsioni
+
+    _db.session.add_all([Modello(cod_modello=m, cod_modello_norm=m.lower()) for m in ("M1", "M2")])
+    _db.session.add(FileOrdine(id=1, anno=2024, filename="PO1.pdf", filepath="/tmp/PO1.pdf", data_ordine=date(2024, 1, 1)))
+    _db.session.add_all([
+        Ordine(ordine_modello="A|M2", id_file_ordine=1, cod_ordine="A", cod_modello="M2", qta=5),
+        Ordine(ordine_modello="B|M2", id_file_ordine=1, cod_ordine="B", cod_modello="M2", qta=7),
+        Ordine(ordine_modello="A|M1", id_file_ordine=1, cod_ordine="A", cod_modello="M1", qta=None),
+    ])
+    _db.session.commit()
+
+    assert previsioni.get_modelli_e_quantita_from_db("PO1.pdf") == (["M1", "M2"], {"M1": 0, "M2": 12})
+    assert previsioni.get_modelli_e_quantita_from_db("PO9.pdf") is None
+
+    # In modalità auto un ordine non presente nel DB ricade sull'Excel
+    monkeypatch.setattr(previsioni, "get_modelli_e_quantita_from_orders_excel", lambda f: (["X"], {"X": 1}))
+    assert previsioni.get_modelli_e_quantita_ordine("PO1.pdf") == (["M1", "M2"], {"M1": 0, "M2": 12})
+    assert previsioni.get_modelli_e_quantita_ordine("PO9.pdf") == (["X"], {"X": 1})
+    monkeypatch.setattr(previsioni, "ORDERS_SOURCE", "db")
+    assert previsioni.get_modelli_e_quantita_ordine("PO9.pdf") == ([], {})
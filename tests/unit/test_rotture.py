@@ -0,0 +1,129 @@
+"""
+Unit Tests - Rotture
+====================
+Test per validazione e caricamento dei file rotture (routes/rotture_funzioni_elaborazione.py).
+"""
+
+import pytest
+
+
+# ============================================================================
+# Test validazione rotture
+# ============================================================================
+
+@pytest.mark.unit
+def test_valida_rotture_a_blocchi():
+    """Validazione di formato senza database, identica in seriale e a blocchi su più processi."""
+    import pandas as pd
+    from routes.rotture_funzioni_elaborazione import valida_rotture
+
+    df = pd.DataFrame({
+        'prot': ['1', '2', None, '1', '5', '6'],
+        'cod_modello': ['M1', ' ', 'M1', 'M1', 'M1', 'M1'],
+        'cod_utente': ['U1'] * 6,
+        'cod_rivenditore': ['R1', 'R1', 'R1', 'R1', None, 'R1'],
+        'qtà': ['1', '1', '1', '1', '1', 'x'],
+    }, dtype=object)
+
+    pulito, errori = valida_rotture(df, workers=1)
+    assert pulito['prot'].tolist() == ['1']
+    assert pulito['qta'].dtype == 'Int64'
+    assert errori.to_dict('records') == [
+        {'riga_file': 3, 'chiave': '2', 'messaggio': 'Modello mancante'},
+        {'riga_file': 4, 'chiave': None, 'messaggio': 'Protocollo mancante'},
+        {'riga_file': 5, 'chiave': '1', 'messaggio': 'Protocollo 1 duplicato nel file'},
+        {'riga_file': 6, 'chiave': '5', 'messaggio': 'Rivenditore mancante'},
+        {'riga_file': 7, 'chiave': '6', 'messaggio': 'Valore non numerico per qtà: x'},
+    ]
+
+    pulito_par, errori_par = valida_rotture(df, workers=2, chunk_size=2)
+    pd.testing.assert_frame_equal(pulito_par, pulito)
+    pd.testing.assert_frame_equal(errori_par, errori)
+
+
+@pytest.mark.unit
+def test_normalizza_date_per_colonna():
+    """Formato dedotto per colonna; parse_date solo per le celle residue, segnalate per indice."""
+    from datetime import date
+    import pandas as pd
+    from routes.rotture_funzioni_elaborazione import normalizza_date
+
+    testo = pd.Series(['01/06/2023', '2/6/2023', '2023-05-01', None, '3 May 2021', 'xx', '01/01/1600'], dtype=object)
+    date_col, liberi, invalidi = normalizza_date(testo)
+
+    assert date_col.tolist() == [date(2023, 6, 1), date(2023, 6, 2), date(2023, 5, 1), None,
+                                 date(2021, 5, 3), None, date(1600, 1, 1)]
+    assert list(liberi) == [4, 6]  # Formato libero e data fuori dall'intervallo di pandas
+    assert list(invalidi) == [5]
+
+
+# ============================================================================
+# Test caricamento rotture
+# ============================================================================
+
+@pytest.mark.unit
+def test_carica_rotture_bulk(sqlite_app):
+    """Caricamento set-based: upsert delle dimensioni, insert a blocchi, nulla scritto se una riga è KO."""
+    import pandas as pd
+    from models import (db as _db, FileRottura, Rottura, RotturaComponente, Modello, Componente,
+                        UtenteRottura, Rivenditore)
+    from routes.rotture_funzioni_elaborazione import carica_rotture, valida_rotture
+
+    class Dettagli(list):
+        """Raccoglie i dettagli trace come TraceWriter.estendi."""
+        def estendi(self, dettagli):
+            assert not isinstance(dettagli, list)  # Generati uno alla volta, non accumulati
+            self.extend(dettagli)
+
+    models_dict = {'Rottura': Rottura, 'RotturaComponente': RotturaComponente, 'Modello': Modello,
+                   'Componente': Componente, 'UtenteRottura': UtenteRottura, 'Rivenditore': Rivenditore}
+    df = pd.DataFrame({
+        'prot': ['1', '2', '3'],
+        'cod_modello': ['M1', 'M1', 'M1'],
+        'marca': ['HISENSE', None, 'HOMA'],
+        'cod_utente': ['U1', 'U2', 'U1'],
+        'pv_utente': ['MI', 'RM', 'TO'],
+        'cod_rivenditore': ['R1', 'R1', 'R1'],
+        'cod_componente': ['C1', None, 'C NEW'],
+        'data_acquisto': ['2023-05-01', '01/06/2023', None],
+        'qtà': ['1', None, '2'],
+    }, dtype=object)
+
+    _db.session.add(FileRottura(id=7, anno=2024, filename="rot.xlsx", filepath="/tmp/rot.xlsx"))
+    _db.session.add(Modello(cod_modello="M1", cod_modello_norm="m1", marca="OLD"))
+    _db.session.add(Componente(cod_componente="C1", cod_componente_norm="c1"))
+    _db.session.add(UtenteRottura(cod_utente_rottura="U1", pv_utente_rottura="XX"))
+    _db.session.commit()
+
+    # Una riga con modello sconosciuto: nessuna scrittura, solo la riga KO in trace
+    ko, errori = valida_rotture(df.assign(cod_modello=['M1', 'M9', 'M1']))
+    assert errori.empty
+    trace = Dettagli()
+    assert carica_rotture(ko, 7, 1, _db.session, models_dict, trace) == (0, 1)
+    assert trace == [{'record_pos': 3, 'record_data': {'key': '2'},
+                      'stato': 'KO', 'messaggio': 'Modello M9 non trovato in anagrafica'}]
+    assert Rottura.query.count() == 0
+
+    # Modello, utente e rivenditore obbligatori: la riga resta KO in validazione
+    _, errori = valida_rotture(df.assign(cod_modello=['M1', None, 'M1']))
+    assert errori['messaggio'].tolist() == ['Modello mancante']
+
+    righe, _ = valida_rotture(df)
+    trace = Dettagli()
+    num_rotture, num_errori = carica_rotture(righe, 7, 1, _db.session, models_dict, trace)
+    _db.session.commit()
+
+    assert (num_rotture, num_errori) == (3, 0)
+    assert Rottura.query.count() == 3
+    assert _db.session.get(Rottura, "7|2").data_acquisto.isoformat() == "2023-06-01"
+    assert _db.session.get(Rottura, "7|3").qta == 2
+    assert _db.session.get(Modello, "M1").marca == "HOMA"  # Ultimo valore valorizzato
+    assert _db.session.get(UtenteRottura, "U1").pv_utente_rottura == "TO"  # Ultima riga del codice
+    assert _db.session.get(Componente, "C NEW").cod_componente_norm == "cnew"
+    assert sorted(c.cod_componente for c in RotturaComponente.query) == ["C NEW", "C1"]
+    assert [t['record_data']['tipo'] for t in trace if t['record_pos'] == 4] == [
+        'UPDATE_MODELLO', 'UPDATE_UTENTE', 'UPDATE_RIVENDITORE',
+        'CREATE_COMPONENTE', 'CREATE_ROTTURA', 'CREATE_ROTTURA_COMPONENTE']
+
+    # Rielaborazione dello stesso file: rotture già presenti
+    assert carica_rotture(righe, 7, 1, _db.session, models_dict, Dettagli()) == (0, 3)
@@ -139,3 +139,222 @@ def test_production_config_requires_secret_key():
         # Ripristina SECRET_KEY
         if original_key:
             os.environ['SECRET_KEY'] = original_key
+
+
+# ============================================================================
+# Test Frame Store (store colonnare previsioni)
+# ============================================================================
+
+@pytest.mark.unit
+def test_frame_store_roundtrip(tmp_path):
+    """Test salvataggio/caricamento DataFrame con validazione signature."""
+    import numpy as np
+    import pandas as pd
+    from utils.frame_store import save_frames, load_frames, source_signature
+
+    sorgente = tmp_path / "rotture.xlsx"
+    sorgente.write_text("dati")
+    df = pd.DataFrame({
+        "Modello": ["M1", "M1", "M2"],
+        "Tempo di Vita": [10.0, 200.5, 30.0],
+        "Censura": [0, 1, 1],
+        "Data Acquisto": pd.to_datetime(["2022-01-01", "2022-02-01", None]),
+        "stat": ["S1", None, "S2"],
+    })
+    store_dir = str(tmp_path / "store")
+    signature = source_signature([str(sorgente)], top_n=2)
+
+    save_frames(store_dir, {"df_affid": df}, signature, extra={"modelli": ["M1", "M2"]})
+    frames, extra = load_frames(store_dir, signature)
+
+    loaded = frames["df_affid"]
+    assert extra == {"modelli": ["M1", "M2"]}
+    assert list(loaded.columns) == list(df.columns)
+    assert loaded["Modello"].astype(object).tolist() == ["M1", "M1", "M2"]
+    assert np.array_equal(loaded["Tempo di Vita"].to_numpy(), df["Tempo di Vita"].to_numpy())
+    assert loaded["Data Acquisto"].isna().tolist() == [False, False, True]
+    assert pd.isna(loaded["stat"].iloc[1])
+
+    # Signature diversa (sorgente modificato) -> store obsoleto
+    assert load_frames(store_dir, source_signature([str(sorgente)], top_n=3)) is None
+
+
+# ============================================================================
+# Test Chart Cache (grafici previsioni su richiesta)
+# ============================================================================
+
+@pytest.mark.unit
+def test_chart_cache_renders_once_and_evicts_lru(tmp_path):
+    """Il grafico è generato una sola volta; oltre il limite si eliminano i meno usati."""
+    import os
+    from matplotlib.figure import Figure
+    from utils.chart_cache import get_or_render
+
+    chiamate = []
+
+    def make_figure():
+        chiamate.append(1)
+        fig = Figure(figsize=(2, 2))
+        fig.subplots().plot([0, 1], [1, 0])
+        return fig
+
+    path_a = get_or_render(str(tmp_path), "a", "png", make_figure)
+    assert get_or_render(str(tmp_path), "a", "png", make_figure) == path_a
+    assert len(chiamate) == 1
+    assert os.path.basename(path_a) == "a.png"
+
+    # "a" è il meno usato di recente: con un limite pari a un solo file viene eliminato
+    os.utime(path_a, (1, 1))
+    path_b = get_or_render(str(tmp_path), "b", "svg", make_figure, max_bytes=os.path.getsize(path_a) + 1)
+    assert not os.path.exists(path_a)
+    assert os.path.exists(path_b)
+    assert len(chiamate) == 2
+
+
+# ============================================================================
+# Test Table Export (export streaming previsioni)
+# ============================================================================
+
+@pytest.mark.unit
+def test_table_export_xlsx_and_csv(tmp_path):
+    """Export write-only: un foglio per modello, valori arrotondati, CSV riallineato alle colonne."""
+    import io
+    import pandas as pd
+    from utils.table_export import write_xlsx, iter_csv
+
+    tabelle = {
+        "M/1": pd.DataFrame({"Codice": ["C1", "C2"], "prob": [0.12345, float("nan")], "n": [1, 2]}),
+        "M2": pd.DataFrame({"Codice": ["C3"], "n": [3]}),
+    }
+
+    path = tmp_path / "export.xlsx"
+    assert write_xlsx(tabelle.items(), path) == 2
+    fogli = pd.read_excel(path, sheet_name=None)
+    assert list(fogli) == ["M_1", "M2"]
+    assert fogli["M_1"]["prob"].iloc[0] == 0.12
+    assert pd.isna(fogli["M_1"]["prob"].iloc[1])
+
+    testo = b"".join(iter_csv(tabelle.items(), ["Codice", "prob", "n"])).decode("utf-8-sig")
+    df = pd.read_csv(io.StringIO(testo), sep=";")
+    assert list(df.columns) == ["Modello", "Codice", "prob", "n"]
+    assert df["Modello"].tolist() == ["M/1", "M/1", "M2"]
+    assert pd.isna(df["prob"].iloc[2])
+
+
+# ============================================================================
+# Test BOM Matrix (distinta base per modello)
+# ============================================================================
+
+@pytest.mark.unit
+def test_bom_matrix_tabella_modello():
+    """Voci BOM nell'ordine del JSON, anagrafica costruita una volta, costi vettoriali."""
+    import numpy as np
+    import pandas as pd
+    import routes.previsioni as previsioni
+    from utils.bom_matrix import build_anagrafica_index, build_bom_index, con_previsioni
+
+    df_anagrafica = pd.DataFrame({
+        "codice": ["C1", "C2", "C1"],
+        "descrizione": ["uno", "due", "duplicato"],
+        "descrizione_en": ["one", "two", "dup"],
+        "price": [10.0, 4.0, 99.0],
+        "stat": ["S1", None, "S9"],
+    })
+    json_modelli = {
+        "M1": {"componenti": {"C2": 1, "C1": 2, "CX": 3}},
+        "M2": {"componenti": {"C1": 1}},
+    }
+    hist_index = {
+        "Componente": {("M1", "C1"): {'total': 100, 'broken': 5}},
+        "STAT": {("M1", "S1"): {'total': 300, 'broken': 9}},
+    }
+    anagrafica = build_anagrafica_index(df_anagrafica)
+    bom = build_bom_index(json_modelli, anagrafica, hist_index)
+    assert bom['matrice'].shape == (2, 3)
+    assert bom['matrice'].toarray().tolist() == [[1, 2, 3], [0, 1, 0]]
+
+    nuova = con_previsioni(bom, {"M1": {"C1": {"prev12": 0.1, "prev12_lower": 0.05, "prev12_upper": 0.2}}},
+                           {"M1": {"S1": {"prev12": 0.3}}})
+    assert np.isnan(bom['pred_comp']).all()  # BOM originale non modificata
+    cache = dict(previsioni._nuovo_snapshot(), bom=nuova)
+    tabella = previsioni.tabella_componenti_con_previsioni(["M1", "M9"], 5, cache)
+
+    assert list(tabella) == ["M1"]
+    df = tabella["M1"]
+    assert df["Codice componente"].tolist() == ["C2", "C1", "CX"]
+    assert df["Quantità totale"].tolist() == [5, 10, 15]
+    assert df["Prezzo"].tolist() == [4.0, 10.0, 0.0]  # Prima occorrenza; 0 se assente
+    assert df["stat"].tolist() == [None, "S1", None]
+    assert df["total_comp"].tolist() == [0, 100, 0]
+    assert df["total_stat"].iloc[1] == 300 and np.isnan(df["total_stat"].iloc[0])
+    assert df["costo_comp_12_mesi"].iloc[1] == pytest.approx(0.1 * 10 * 10.0)
+    assert df["costo_stat_12_mesi"].iloc[1] == pytest.approx(0.3 * 10 * 10.0)
+    assert np.isnan(df["rottura_comp_12_mesi"].iloc[0])
+
+    righe = previsioni.righe_tabella(df)
+    assert righe[0]["rottura_comp_12_mesi"] is None
+    assert righe[1]["Quantità per modello"] == 2
+
+
+# ============================================================================
+# Test Bulk DB (upsert set-based)
+# ============================================================================
+
+@pytest.mark.unit
+def test_upsert_rows_chiave_composta(monkeypatch, sqlite_app):
+    """Upsert senza ON CONFLICT: nuove ed esistenti separate con IN su tuple della chiave composta."""
+    from models import db as _db, RotturaComponente
+    from utils import bulk_db
+
+    _db.session.add(RotturaComponente(cod_rottura="7|1", cod_componente="C1", created_by=1, updated_by=1))
+    _db.session.commit()
+
+    monkeypatch.setattr(bulk_db, '_dialect_insert', lambda session, model: None)
+    righe = [
+        {'cod_rottura': "7|1", 'cod_componente': "C1", 'updated_by': 5},
+        {'cod_rottura': "7|1", 'cod_componente': "C2", 'updated_by': 5},
+        {'cod_rottura': "7|2", 'cod_componente': "C1", 'updated_by': 5},
+    ]
+    assert bulk_db.upsert_rows(_db.session, RotturaComponente, righe,
+                               ['cod_rottura', 'cod_componente'], ['updated_by']) == 3
+    _db.session.commit()
+
+    assert sorted((r.cod_rottura, r.cod_componente, r.created_by, r.updated_by)
+                  for r in RotturaComponente.query) == [
+        ("7|1", "C1", 1, 5), ("7|1", "C2", 0, 5), ("7|2", "C1", 0, 5)]
+
+
+# ============================================================================
+# Test Trace Writer (dettagli trace a blocchi)
+# ============================================================================
+
+@pytest.mark.unit
+def test_trace_writer_batch_e_verbosita(sqlite_app):
+    """Dettagli trace scritti a blocchi, filtrati per livello e campionati."""
+    from models import db as _db, TraceElab, TraceElabDett
+    from utils.trace_writer import TraceWriter
+
+    start = TraceElab(id_elab=1, id_file=1, tipo_file='ROT', step='START', stato='OK')
+    _db.session.add(start)
+    _db.session.commit()
+
+    trace = TraceWriter(_db.session, TraceElabDett, start.id_trace, batch_size=4, intervallo=3600)
+    for pos in range(1, 7):
+        trace.aggiungi(pos, {'tipo': 'CREATE_ROTTURA'}, 'OK', f'riga {pos}')
+    assert TraceElabDett.query.count() == 4  # Un blocco pieno già scritto
+    trace.estendi([{'record_pos': 7, 'record_data': {'key': '7'}, 'stato': 'KO', 'messaggio': 'errore'}])
+    assert trace.chiudi() == 7
+    assert TraceElabDett.query.filter_by(stato='KO').one().record_data == {'key': '7'}
+
+    # Solo WARN/KO
+    solo_warn = TraceWriter(_db.session, TraceElabDett, start.id_trace, livello='WARN')
+    solo_warn.aggiungi(1, {}, 'OK')
+    solo_warn.aggiungi(2, {}, 'WARN')
+    assert (solo_warn.chiudi(), solo_warn.filtrati) == (1, 1)
+
+    # Campione OK: una riga ogni 3, WARN sempre
+    campione = TraceWriter(_db.session, TraceElabDett, start.id_trace, campione_ok=3)
+    for pos in range(1, 10):
+        campione.aggiungi(pos, {}, 'OK')
+    campione.aggiungi(10, {}, 'WARN')
+    assert campione.chiudi() == 4
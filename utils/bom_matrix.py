@@ -0,0 +1,178 @@
+"""
+Matrice BOM sparsa modelli x componenti e array allineati per le tabelle previsioni.
+
+Costruiti una volta per snapshot dati:
+- anagrafica: una riga per codice componente (prima occorrenza), colonne come
+  array NumPy e mappa codice -> posizione
+- BOM: matrice CSR (modelli x componenti, valore = pezzi per modello) con le
+  colonne di ogni riga nell'ordine del JSON modelli; ogni voce (elemento non
+  nullo) ha accanto prezzo, stat, storico e previsioni allineati
+
+La tabella di un modello è quindi la fetta [indptr[i]:indptr[i+1]] di questi
+array più qualche operazione vettoriale, senza cicli per componente.
+
+Uso:
+    from utils.bom_matrix import build_anagrafica_index, build_bom_index, con_previsioni
+
+    anagrafica = build_anagrafica_index(df_anagrafica)
+    bom = build_bom_index(json_modelli, anagrafica, hist_index)
+    bom = con_previsioni(bom, {modello: pred_comp[modello]}, {modello: pred_stat[modello]})
+    voci = voci_modello(bom, modello)
+"""
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+MESI = [12, 24, 36]
+
+# Colonne della matrice previsioni: per ogni orizzonte stima, limite inferiore e superiore
+CHIAVI_PREVISIONE = [f"prev{m}{suffisso}" for m in MESI for suffisso in ("", "_lower", "_upper")]
+
+
+def _colonna(df, nome, default):
+    if nome not in df.columns:
+        return np.full(len(df), default, dtype=object)
+    return df[nome].to_numpy(dtype=object)
+
+
+def build_anagrafica_index(df_anagrafica):
+    """
+    Anagrafica componenti come array allineati: descrizione, descrizione_en,
+    price (float, NaN se non valorizzato), stat (None se assente).
+    """
+    df = df_anagrafica.drop_duplicates(subset="codice")
+    stat = _colonna(df, "stat", None)
+    return {
+        'pos': {codice: i for i, codice in enumerate(df["codice"].tolist())},
+        'descrizione': _colonna(df, "descrizione", None),
+        'descrizione_en': _colonna(df, "descrizione_en", None),
+        'price': pd.to_numeric(pd.Series(_colonna(df, "price", np.nan)), errors="coerce").to_numpy(dtype=float),
+        'stat': np.where(pd.isna(stat), None, stat),
+    }
+
+
+def righe_anagrafica(anagrafica, codici):
+    """Posizioni in anagrafica dei codici indicati (-1 se assenti)."""
+    pos = anagrafica['pos']
+    return np.fromiter((pos.get(c, -1) for c in codici), dtype=np.int64, count=len(codici))
+
+
+def valori_anagrafica(anagrafica, campo, righe, default=None):
+    """Valori del campo per le righe date (righe_anagrafica); default per i codici assenti."""
+    valori = anagrafica[campo]
+    trovati = righe >= 0
+    risultato = np.full(len(righe), default, dtype=valori.dtype if default is not None else object)
+    risultato[trovati] = valori[righe[trovati]]
+    return risultato
+
+
+def build_bom_index(json_modelli, anagrafica, hist_index):
+    """
+    Matrice BOM sparsa dai componenti del JSON modelli, con gli array per voce:
+    codice, pezzi, prezzo (0 se il codice non è in anagrafica), descrizioni,
+    stat, storico per componente e per STAT (da build_historical_index) e
+    previsioni (NaN finché il modello non è calcolato, vedi allinea_previsioni).
+    """
+    modelli = list(json_modelli or {})
+    colonne = {}
+    indptr, indices, pezzi = [0], [], []
+    for modello in modelli:
+        for codice, qta in json_modelli[modello].get("componenti", {}).items():
+            indices.append(colonne.setdefault(codice, len(colonne)))
+            pezzi.append(qta)
+        indptr.append(len(indices))
+
+    matrice = sparse.csr_matrix(
+        (np.asarray(pezzi, dtype=float), np.asarray(indices, dtype=np.int64), np.asarray(indptr, dtype=np.int64)),
+        shape=(len(modelli), len(colonne))
+    )
+
+    componenti = np.array(list(colonne), dtype=object)
+    righe = righe_anagrafica(anagrafica, componenti)[matrice.indices]
+    codici = componenti[matrice.indices]
+    stat = valori_anagrafica(anagrafica, 'stat', righe)
+    modello_voce = np.repeat(np.array(modelli, dtype=object), np.diff(matrice.indptr))
+
+    def _storico(group_type, codici_voce):
+        indice = hist_index[group_type]
+        vuoto = {'total': 0, 'broken': 0}
+        coppie = [indice.get((m, c), vuoto) for m, c in zip(modello_voce, codici_voce)]
+        return (np.array([s['total'] for s in coppie], dtype=np.int64),
+                np.array([s['broken'] for s in coppie], dtype=np.int64))
+
+    # Storico STAT: NaN per i componenti senza gruppo STAT
+    total_comp, broken_comp = _storico("Componente", codici)
+    total_stat, broken_stat = (a.astype(float) for a in _storico("STAT", stat))
+    senza_stat = np.array([s is None for s in stat], dtype=bool)
+    total_stat[senza_stat] = np.nan
+    broken_stat[senza_stat] = np.nan
+
+    n_voci = matrice.nnz
+    return {
+        'pos_modello': {m: i for i, m in enumerate(modelli)},
+        'componenti': componenti,
+        'matrice': matrice,
+        'codice': codici,
+        'price': np.where(righe >= 0, valori_anagrafica(anagrafica, 'price', righe, np.nan), 0.0),
+        'descrizione': valori_anagrafica(anagrafica, 'descrizione', righe, ""),
+        'descrizione_en': valori_anagrafica(anagrafica, 'descrizione_en', righe, ""),
+        'stat': stat,
+        'total_comp': total_comp,
+        'broken_comp': broken_comp,
+        'total_stat': total_stat,
+        'broken_stat': broken_stat,
+        'pred_comp': np.full((n_voci, len(CHIAVI_PREVISIONE)), np.nan),
+        'pred_stat': np.full((n_voci, len(CHIAVI_PREVISIONE)), np.nan),
+    }
+
+
+def _voci(bom, modello):
+    riga = bom['pos_modello'].get(modello)
+    if riga is None:
+        return slice(0, 0)
+    return slice(bom['matrice'].indptr[riga], bom['matrice'].indptr[riga + 1])
+
+
+def _matrice_previsioni(previsioni, codici):
+    valori = np.full((len(codici), len(CHIAVI_PREVISIONE)), np.nan)
+    for i, codice in enumerate(codici):
+        pred = previsioni.get(codice) if codice is not None else None
+        if pred:
+            valori[i] = [np.nan if pred.get(k) is None else pred[k] for k in CHIAVI_PREVISIONE]
+    return valori
+
+
+def allinea_previsioni(bom, modello, pred_comp, pred_stat):
+    """Copia le previsioni calcolate del modello ({codice: {...}}) sulle sue voci BOM."""
+    voci = _voci(bom, modello)
+    bom['pred_comp'][voci] = _matrice_previsioni(pred_comp or {}, bom['codice'][voci])
+    bom['pred_stat'][voci] = _matrice_previsioni(pred_stat or {}, bom['stat'][voci])
+
+
+def con_previsioni(bom, pred_comp, pred_stat):
+    """
+    Nuova BOM con le previsioni dei modelli indicati ({modello: {codice: {...}}})
+    allineate sulle loro voci. bom non viene modificata: le matrici previsioni
+    sono copiate, gli altri array condivisi.
+    """
+    nuova = {**bom, 'pred_comp': bom['pred_comp'].copy(), 'pred_stat': bom['pred_stat'].copy()}
+    for modello in dict.fromkeys([*pred_comp, *pred_stat]):
+        allinea_previsioni(nuova, modello, pred_comp.get(modello), pred_stat.get(modello))
+    return nuova
+
+
+def voci_modello(bom, modello):
+    """
+    Fetta delle voci BOM del modello: dict di array (vedi build_bom_index)
+    più 'pezzi' (pezzi per modello), nell'ordine dei componenti del JSON.
+    """
+    voci = _voci(bom, modello)
+    risultato = {chiave: bom[chiave][voci] for chiave in (
+        'codice', 'price', 'descrizione', 'descrizione_en', 'stat',
+        'total_comp', 'broken_comp', 'total_stat', 'broken_stat', 'pred_comp', 'pred_stat'
+    )}
+    pezzi = bom['matrice'].data[voci]
+    # Pezzi interi come nel JSON modelli
+    risultato['pezzi'] = pezzi.astype(np.int64) if np.array_equal(pezzi, np.round(pezzi)) else pezzi
+    return risultato
@@ -0,0 +1,116 @@
+"""
+Operazioni massive sul database per le pipeline di elaborazione file.
+
+Invece di una query per riga:
+- fetch_by_keys: legge le righe referenziate con poche query IN (a blocchi)
+- insert_rows: INSERT a blocchi (executemany: SQLAlchemy 2 compone
+  INSERT multi-VALUES, una istruzione per blocco)
+- upsert_rows: INSERT ... ON CONFLICT DO UPDATE / DO NOTHING su PostgreSQL
+  e SQLite; sugli altri database lettura delle chiavi esistenti + INSERT/UPDATE
+- update_rows: UPDATE per chiave primaria a blocchi
+
+Tutte le funzioni lavorano nella sessione passata e non fanno commit: la
+transazione (e quindi il tutto-o-niente) resta al chiamante.
+
+Uso:
+    from utils.bulk_db import fetch_by_keys, insert_rows, upsert_rows
+
+    esistenti = fetch_by_keys(db.session, [Modello.cod_modello, Modello.marca], Modello.cod_modello, codici)
+    upsert_rows(db.session, Rivenditore, righe, ['cod_rivenditore'], ['pv_rivenditore', 'updated_by'])
+    insert_rows(db.session, Rottura, righe)
+"""
+
+from sqlalchemy import insert, update, inspect, tuple_
+
+# Righe per singola istruzione INSERT/UPDATE
+BATCH_SIZE = 1000
+
+# Parametri per singola clausola IN (limite SQLite: 999 variabili)
+IN_CHUNK = 500
+
+
+def chunks(seq, size):
+    """Divide una sequenza in blocchi di al più size elementi."""
+    seq = list(seq)
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+
+def fetch_by_keys(session, colonne, colonna_chiave, chiavi, chunk_size=IN_CHUNK):
+    """
+    Righe (tuple di colonne) con colonna_chiave tra le chiavi indicate,
+    lette con una query IN per blocco di chiavi distinte.
+    """
+    righe = []
+    distinte = [k for k in dict.fromkeys(chiavi) if k is not None]
+    for blocco in chunks(distinte, chunk_size):
+        righe.extend(session.query(*colonne).filter(colonna_chiave.in_(blocco)).all())
+    return righe
+
+
+def insert_rows(session, model, righe, batch_size=BATCH_SIZE):
+    """INSERT di una lista di dict (attributi del modello ORM) a blocchi."""
+    for blocco in chunks(righe, batch_size):
+        session.execute(insert(model), blocco)
+    return len(righe)
+
+
+def update_rows(session, model, righe, batch_size=BATCH_SIZE):
+    """UPDATE per chiave primaria: ogni dict contiene la chiave e i campi da aggiornare."""
+    for blocco in chunks(righe, batch_size):
+        session.execute(update(model), blocco)
+    return len(righe)
+
+
+def _dialect_insert(session, model):
+    nome = session.get_bind().dialect.name
+    if nome == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    elif nome == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    else:
+        return None
+    return dialect_insert(model)
+
+
+def upsert_rows(session, model, righe, chiavi, aggiorna, batch_size=BATCH_SIZE):
+    """
+    Inserisce le righe o, se la chiave esiste già, aggiorna i campi in aggiorna
+    (nessun campo = ON CONFLICT DO NOTHING). Le righe devono avere chiavi distinte.
+
+    Args:
+        chiavi: attributi della chiave di conflitto (chiave primaria o UNIQUE)
+        aggiorna: attributi aggiornati sulle righe esistenti
+    """
+    if not righe:
+        return 0
+    stmt = _dialect_insert(session, model)
+    if stmt is not None:
+        colonne = inspect(model).columns
+        if aggiorna:
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[colonne[k] for k in chiavi],
+                set_={colonne[c].name: stmt.excluded[colonne[c].name] for c in aggiorna}
+            )
+        else:
+            stmt = stmt.on_conflict_do_nothing(index_elements=[colonne[k] for k in chiavi])
+        for blocco in chunks(righe, batch_size):
+            session.execute(stmt, blocco)
+        return len(righe)
+
+    # Database senza ON CONFLICT: separa nuove ed esistenti con una lettura IN
+    # (chiave composta: IN su tuple di colonne)
+    attributi = [getattr(model, k) for k in chiavi]
+    valori = [tuple(r[k] for k in chiavi) for r in righe]
+    if len(chiavi) == 1:
+        letti = fetch_by_keys(session, attributi, attributi[0], [v[0] for v in valori])
+    else:
+        letti = fetch_by_keys(session, attributi, tuple_(*attributi), valori, max(1, IN_CHUNK // len(chiavi)))
+    esistenti = {tuple(r) for r in letti}
+    insert_rows(session, model, [r for r, v in zip(righe, valori) if v not in esistenti], batch_size)
+    if aggiorna:
+        update_rows(session, model, [
+            {**{k: r[k] for k in chiavi}, **{c: r[c] for c in aggiorna}}
+            for r, v in zip(righe, valori) if v in esistenti
+        ], batch_size)
+    return len(righe)
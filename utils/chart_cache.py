@@ -0,0 +1,107 @@
+"""
+Cache su disco dei grafici delle previsioni, con politica LRU e limite di dimensione.
+
+I grafici non sono più generati durante il precalcolo: vengono disegnati alla
+prima richiesta e salvati con un nome deterministico (chiave + formato), per
+cui richieste successive dello stesso grafico servono il file già pronto.
+
+- Ogni accesso aggiorna l'mtime del file: i file meno usati di recente sono
+  i primi a essere eliminati quando la cartella supera max_bytes.
+- La scrittura è atomica (file temporaneo + os.replace), quindi più worker
+  possono generare lo stesso grafico senza servire file parziali.
+
+Uso:
+    from utils.chart_cache import get_or_render
+
+    path = get_or_render(CHART_DIR, "componente_<fingerprint>", "png",
+                         lambda: chart_figure(curve, titolo, ultimo_mese),
+                         max_bytes=200 * 1024 * 1024)
+"""
+
+import os
+import uuid
+
+# Formati supportati -> mimetype
+CHART_FORMATS = {
+    "png": "image/png",
+    "svg": "image/svg+xml",
+}
+
+
+def chart_path(cache_dir, key, fmt):
+    """Path deterministico del grafico per chiave e formato."""
+    if fmt not in CHART_FORMATS:
+        raise ValueError(f"Formato grafico non supportato: {fmt}")
+    return os.path.join(cache_dir, f"{key}.{fmt}")
+
+
+def enforce_size_cap(cache_dir, max_bytes, keep=None):
+    """
+    Elimina i file meno usati di recente (mtime più vecchio) finché la
+    cartella non scende sotto max_bytes. Il file keep non viene mai eliminato.
+
+    Returns:
+        int: numero di file eliminati
+    """
+    if not max_bytes or not os.path.isdir(cache_dir):
+        return 0
+
+    files = []
+    total = 0
+    with os.scandir(cache_dir) as it:
+        for entry in it:
+            if not entry.is_file() or entry.name.startswith("."):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue  # Eliminato nel frattempo da un altro processo
+            files.append((stat.st_mtime, entry.path, stat.st_size))
+            total += stat.st_size
+
+    removed = 0
+    for _, path, size in sorted(files):
+        if total <= max_bytes:
+            break
+        if keep and os.path.abspath(path) == os.path.abspath(keep):
+            continue
+        try:
+            os.remove(path)
+            removed += 1
+        except OSError:
+            pass
+        total -= size
+    return removed
+
+
+def get_or_render(cache_dir, key, fmt, make_figure, max_bytes=None):
+    """
+    Ritorna il path del grafico, generandolo con make_figure() se non è in cache.
+
+    Args:
+        cache_dir: cartella della cache
+        key: chiave univoca del grafico (es. tipo + fingerprint del gruppo)
+        fmt: 'png' o 'svg'
+        make_figure: callable che ritorna una matplotlib Figure
+        max_bytes: dimensione massima della cartella (None = illimitata)
+    """
+    path = chart_path(cache_dir, key, fmt)
+    if os.path.exists(path):
+        try:
+            os.utime(path)  # Segna come usato di recente
+            return path
+        except OSError:
+            pass  # Eliminato nel frattempo: lo rigeneriamo
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = os.path.join(cache_dir, f".{key}.{uuid.uuid4().hex}.{fmt}")
+    fig = make_figure()
+    try:
+        fig.savefig(tmp_path, format=fmt, bbox_inches="tight")
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    enforce_size_cap(cache_dir, max_bytes, keep=path)
+    return path
@@ -0,0 +1,93 @@
+"""
+Cache in memoria delle dimensioni (modelli, componenti, controparti,
+rivenditori, utenti rotture) per una singola elaborazione file.
+
+Le pipeline rotture, ordini e anagrafiche cercano le stesse chiavi riga per
+riga: con la cache ogni chiave arriva al database al più una volta per run.
+
+- precarica: legge con query IN (a blocchi) tutte le chiavi distinte del file;
+  le chiavi non trovate restano in cache come assenti
+- get: entità dalla cache; una chiave mai vista viene letta una sola volta
+- aggiungi: registra un'entità creata durante l'elaborazione, così le righe
+  successive la trovano senza query (e senza dipendere dall'autoflush)
+
+Le entità sono indicizzate per (modello ORM, attributo chiave): lo stesso
+Modello può essere cercato per cod_modello o per cod_modello_norm e
+aggiungi aggiorna tutti gli indici già aperti per quel modello ORM.
+La cache vale per una sola transazione: va creata all'inizio del run e
+scartata alla fine (dopo commit o rollback).
+
+Uso:
+    from utils.dim_cache import DimensionCache
+
+    cache = DimensionCache(db.session)
+    cache.precarica(Modello, 'cod_modello_norm', codici_norm)
+    modello = cache.get(Modello, 'cod_modello_norm', cod_norm)
+    if modello is None:
+        modello = Modello(...)
+        db.session.add(modello)
+        cache.aggiungi(modello)
+"""
+
+from sqlalchemy import inspect
+
+from utils.bulk_db import IN_CHUNK, chunks
+
+
+class DimensionCache:
+    """Entità dimensione per chiave, lette al più una volta per elaborazione."""
+
+    def __init__(self, session):
+        self.session = session
+        # (modello ORM, attributo) -> {chiave: entità o None se assente nel DB}
+        self._indici = {}
+        self.query_eseguite = 0
+
+    def _indice(self, model, attributo):
+        return self._indici.setdefault((model, attributo), {})
+
+    def precarica(self, model, attributo, chiavi, chunk_size=IN_CHUNK):
+        """Legge con query IN le chiavi non ancora in cache; restituisce l'indice."""
+        indice = self._indice(model, attributo)
+        mancanti = [k for k in dict.fromkeys(chiavi) if k is not None and k not in indice]
+        colonna = getattr(model, attributo)
+        for blocco in chunks(mancanti, chunk_size):
+            self.query_eseguite += 1
+            for entita in self.session.query(model).filter(colonna.in_(blocco)).all():
+                self._registra(entita)
+            for chiave in blocco:
+                indice.setdefault(chiave, None)
+        return indice
+
+    def get(self, model, attributo, chiave):
+        """Entità con attributo == chiave (None se non esiste)."""
+        if chiave is None:
+            return None
+        indice = self._indice(model, attributo)
+        if chiave in indice:
+            entita = indice[chiave]
+            if entita is None:
+                return None
+            # Entità creata in un savepoint poi annullato: non è più nella sessione
+            stato = inspect(entita)
+            if stato.persistent or stato.pending:
+                return entita
+            del indice[chiave]
+        self.precarica(model, attributo, [chiave])
+        return indice[chiave]
+
+    def esistenti(self, model, attributo):
+        """Chiavi presenti (nel DB o create nel run) tra quelle già in cache."""
+        return {k for k, entita in self._indice(model, attributo).items() if entita is not None}
+
+    def aggiungi(self, entita):
+        """Registra un'entità nuova in tutti gli indici aperti del suo modello ORM."""
+        self._registra(entita)
+        return entita
+
+    def _registra(self, entita):
+        for (model, attributo), indice in self._indici.items():
+            if isinstance(entita, model):
+                chiave = getattr(entita, attributo)
+                if chiave is not None:
+                    indice[chiave] = entita
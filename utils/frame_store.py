@@ -0,0 +1,146 @@
+"""
+Store colonnare su disco per DataFrame pandas (NumPy .npy memory-mapped).
+
+Ogni DataFrame è salvato in una sottocartella con un file .npy per colonna:
+- colonne numeriche / booleane / datetime64: array salvato così com'è
+- colonne testuali / object: codici categorici + file con le categorie
+
+Il caricamento usa mmap_mode='r': i processi (es. worker gunicorn) che leggono
+lo stesso store condividono le pagine tramite la page cache del sistema
+operativo e l'apertura costa millisecondi invece di un parse Excel.
+
+La validità dello store è legata a una "signature" (es. mtime/size dei file
+sorgente): se non coincide, load_frames ritorna None e lo store va ricostruito.
+
+Uso:
+    from utils.frame_store import save_frames, load_frames, source_signature
+
+    signature = source_signature([ROTTURE_PATH, ANAGRAFICA_PATH])
+    loaded = load_frames(STORE_DIR, signature)
+    if loaded is None:
+        ...  # costruisci i DataFrame
+        save_frames(STORE_DIR, {'df_affid': df_affid}, signature, extra={'modelli': modelli})
+"""
+
+import json
+import os
+import shutil
+import uuid
+
+import numpy as np
+import pandas as pd
+
+# Incrementare se cambia il formato su disco o lo schema dei DataFrame salvati
+STORE_FORMAT_VERSION = 2
+
+META_FILENAME = "meta.json"
+
+
+def source_signature(paths, **params):
+    """
+    Signature dei file sorgente: (mtime_ns, size) per ogni path più eventuali
+    parametri di costruzione (es. numero di modelli selezionati).
+    """
+    files = {}
+    for path in paths:
+        stat = os.stat(path)
+        files[os.path.abspath(path)] = [stat.st_mtime_ns, stat.st_size]
+    return {
+        "format_version": STORE_FORMAT_VERSION,
+        "files": files,
+        "params": params,
+    }
+
+
+def _save_frame(frame_dir, df):
+    """Salva un DataFrame colonna per colonna, ritorna la descrizione per meta.json."""
+    os.makedirs(frame_dir)
+    columns = []
+    for i, col in enumerate(df.columns):
+        serie = df[col]
+        base = os.path.join(frame_dir, f"c{i}")
+        if isinstance(serie.dtype, pd.CategoricalDtype) or serie.dtype == object or pd.api.types.is_string_dtype(serie.dtype):
+            cat = pd.Categorical(serie)
+            # I codici hanno già il dtype minimo scelto da pandas: from_codes non li copia
+            np.save(base + ".codes.npy", cat.codes)
+            np.save(base + ".categories.npy", np.asarray(cat.categories, dtype=object), allow_pickle=True)
+            kind = "category"
+        else:
+            np.save(base + ".npy", np.ascontiguousarray(serie.to_numpy()))
+            kind = "array"
+        columns.append({"name": col, "file": f"c{i}", "kind": kind})
+    return {"columns": columns, "n_rows": len(df)}
+
+
+def _load_frame(frame_dir, info):
+    """Ricostruisce un DataFrame con array memory-mapped (sola lettura)."""
+    data = {}
+    for col in info["columns"]:
+        base = os.path.join(frame_dir, col["file"])
+        if col["kind"] == "category":
+            codes = np.load(base + ".codes.npy", mmap_mode="r")
+            categories = np.load(base + ".categories.npy", allow_pickle=True)
+            data[col["name"]] = pd.Categorical.from_codes(codes, categories=pd.Index(categories, dtype=object))
+        else:
+            data[col["name"]] = np.load(base + ".npy", mmap_mode="r")
+    return pd.DataFrame(data, copy=False)
+
+
+def save_frames(store_dir, frames, signature, extra=None):
+    """
+    Salva i DataFrame in store_dir in modo atomico: scrive in una cartella
+    temporanea e la sostituisce a quella esistente solo a scrittura completata.
+
+    Args:
+        store_dir: cartella dello store
+        frames: dict {nome: DataFrame}
+        signature: signature dei sorgenti (vedi source_signature)
+        extra: dati JSON-serializzabili aggiuntivi (es. lista modelli)
+    """
+    parent = os.path.dirname(os.path.abspath(store_dir))
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = os.path.join(parent, f".{os.path.basename(store_dir)}.{uuid.uuid4().hex}.tmp")
+    os.makedirs(tmp_dir)
+    try:
+        meta = {"signature": signature, "frames": {}, "extra": extra or {}}
+        for name, df in frames.items():
+            meta["frames"][name] = _save_frame(os.path.join(tmp_dir, name), df)
+        with open(os.path.join(tmp_dir, META_FILENAME), "w") as f:
+            json.dump(meta, f, indent=2, default=str)
+
+        old_dir = None
+        if os.path.exists(store_dir):
+            old_dir = f"{tmp_dir}.old"
+            os.replace(store_dir, old_dir)
+        os.replace(tmp_dir, store_dir)
+        if old_dir:
+            shutil.rmtree(old_dir, ignore_errors=True)
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+
+def load_frames(store_dir, signature=None):
+    """
+    Carica i DataFrame dallo store se esiste ed è valido per la signature.
+
+    Returns:
+        tuple (frames: dict, extra: dict) oppure None se lo store manca o è obsoleto
+    """
+    meta_path = os.path.join(store_dir, META_FILENAME)
+    if not os.path.exists(meta_path):
+        return None
+    try:
+        with open(meta_path, "r") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if signature is not None and meta.get("signature") != json.loads(json.dumps(signature, default=str)):
+        return None
+
+    frames = {
+        name: _load_frame(os.path.join(store_dir, name), info)
+        for name, info in meta["frames"].items()
+    }
+    return frames, meta.get("extra", {})
@@ -0,0 +1,164 @@
+"""
+Esportazione streaming delle tabelle previsioni (XLSX, CSV, Parquet).
+
+Le tabelle arrivano da un iterabile di coppie (modello, DataFrame) generate
+una alla volta: in memoria c'è al più la tabella di un modello, qualunque sia
+il numero di modelli esportati.
+
+- XLSX: workbook openpyxl write-only (righe scritte subito su file temporanei),
+  salvato su disco e inviato a blocchi
+- CSV: un unico file con colonna "Modello", generato riga per riga
+- Parquet: un row group per modello (richiede pyarrow, dipendenza opzionale)
+
+Uso:
+    from utils.table_export import write_xlsx, iter_file_chunks
+
+    write_xlsx(((m, crea_tabella(m)) for m in modelli), path)
+    return Response(iter_file_chunks(path, delete=True), mimetype=...)
+"""
+
+import csv
+import io
+import math
+import os
+
+import numpy as np
+
+# Formato -> (mimetype, estensione)
+EXPORT_FORMATS = {
+    "xlsx": ("application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", "xlsx"),
+    "csv": ("text/csv; charset=utf-8", "csv"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+CHUNK_SIZE = 64 * 1024
+
+
+def sheet_name(modello):
+    """Nome foglio Excel valido (max 31 caratteri, senza caratteri speciali)."""
+    return str(modello)[:31].replace('/', '_').replace('\\', '_').replace('*', '_')
+
+
+def _valore(v):
+    """Valore di cella: NaN/None diventano cella vuota, numerici arrotondati a 2 decimali."""
+    if v is None:
+        return None
+    if isinstance(v, (float, np.floating)):
+        return None if math.isnan(v) else round(float(v), 2)
+    if isinstance(v, np.integer):
+        return int(v)
+    return v
+
+
+def iter_righe(df):
+    """Righe della tabella come liste di valori pronti per la scrittura."""
+    for riga in df.itertuples(index=False, name=None):
+        yield [_valore(v) for v in riga]
+
+
+def write_xlsx(tabelle, path):
+    """
+    Scrive un foglio per modello con un workbook write-only (memoria costante).
+
+    Args:
+        tabelle: iterabile di (modello, DataFrame)
+        path: file .xlsx di destinazione
+
+    Returns:
+        int: numero di fogli scritti
+    """
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Alignment, Border, Font, Side
+
+    # Stile intestazione come pandas.to_excel
+    lato = Side(style="thin")
+    bordo = Border(left=lato, right=lato, top=lato, bottom=lato)
+    grassetto = Font(bold=True)
+    allineamento = Alignment(horizontal="center", vertical="top")
+
+    wb = Workbook(write_only=True)
+    n_fogli = 0
+    for modello, df in tabelle:
+        ws = wb.create_sheet(title=sheet_name(modello))
+        intestazione = []
+        for col in df.columns:
+            cella = WriteOnlyCell(ws, value=str(col))
+            cella.font, cella.border, cella.alignment = grassetto, bordo, allineamento
+            intestazione.append(cella)
+        ws.append(intestazione)
+        for riga in iter_righe(df):
+            ws.append(riga)
+        n_fogli += 1
+    if n_fogli == 0:
+        wb.create_sheet(title="Previsioni")  # Un workbook deve avere almeno un foglio
+    wb.save(path)
+    return n_fogli
+
+
+def iter_csv(tabelle, colonne, delimiter=";"):
+    """
+    Genera il CSV a blocchi: intestazione "Modello" + colonne, poi le righe
+    di tutte le tabelle (riallineate a colonne; mancanti = vuoto).
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=delimiter)
+
+    def _svuota():
+        testo = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+        return testo.encode("utf-8")
+
+    buffer.write("\ufeff")  # BOM: Excel riconosce l'UTF-8
+    writer.writerow(["Modello", *colonne])
+    for modello, df in tabelle:
+        for riga in iter_righe(df.reindex(columns=colonne)):
+            writer.writerow([modello, *riga])
+            if buffer.tell() >= CHUNK_SIZE:
+                yield _svuota()
+    yield _svuota()
+
+
+def write_parquet(tabelle, colonne, colonne_testo, path):
+    """
+    Scrive un file Parquet con un row group per modello.
+    Le colonne in colonne_testo sono stringhe, le altre float64.
+
+    Raises:
+        ImportError: se pyarrow non è installato
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema(
+        [pa.field("Modello", pa.string())]
+        + [pa.field(c, pa.string() if c in colonne_testo else pa.float64()) for c in colonne]
+    )
+    with pq.ParquetWriter(path, schema) as writer:
+        for modello, df in tabelle:
+            df = df.reindex(columns=colonne)
+            dati = {"Modello": [str(modello)] * len(df)}
+            for c in colonne:
+                if c in colonne_testo:
+                    dati[c] = [None if v is None or v != v else str(v) for v in df[c]]
+                else:
+                    dati[c] = df[c].astype("float64").round(2)
+            writer.write_table(pa.table(dati, schema=schema))
+
+
+def iter_file_chunks(path, delete=False, chunk_size=CHUNK_SIZE):
+    """Legge il file a blocchi (risposta HTTP chunked); con delete=True lo elimina alla fine."""
+    try:
+        with open(path, "rb") as f:
+            while True:
+                blocco = f.read(chunk_size)
+                if not blocco:
+                    break
+                yield blocco
+    finally:
+        if delete:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
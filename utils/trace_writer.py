@@ -0,0 +1,123 @@
+"""
+Scrittura bufferizzata dei dettagli di elaborazione (TraceElabDett).
+
+Invece di un oggetto ORM per dettaglio aggiunto alla log_session, i dettagli
+sono accumulati come dict e scritti con INSERT a blocchi (utils.bulk_db):
+- flush ogni TRACE_DETT_BATCH dettagli o ogni TRACE_DETT_INTERVALLO secondi
+- flush finale con chiudi() prima del record END (anche in caso di errore)
+- ogni flush fa commit della sessione log (AUTONOMOUS TRANSACTION)
+
+Verbosità configurabile da ambiente:
+- TRACE_DETT_LIVELLO=OK   tutti i dettagli (default)
+- TRACE_DETT_LIVELLO=WARN solo dettagli WARN e KO
+- TRACE_DETT_CAMPIONE_OK=N con livello OK scrive i dettagli OK solo per una
+  riga ogni N (record_pos multiplo di N); WARN e KO sono sempre scritti
+
+Un errore di scrittura dei log non interrompe l'elaborazione: il blocco viene
+scartato e segnalato nel log applicativo.
+
+Uso:
+    from utils.trace_writer import TraceWriter
+
+    trace = TraceWriter(log_session, TraceElabDett, trace_start.id_trace)
+    trace.aggiungi(idx, {'tipo': 'CREATE_COMPONENTE', ...}, 'OK', 'Creato componente ...')
+    trace.estendi(dettagli)  # dict con record_pos, record_data, stato, messaggio
+    trace.chiudi()
+    log_session.add(trace_end)
+    log_session.commit()
+"""
+
+import logging
+import os
+import time
+
+from utils.bulk_db import insert_rows
+
+logger = logging.getLogger(__name__)
+
+TRACE_DETT_BATCH = int(os.environ.get('TRACE_DETT_BATCH', '1000'))
+TRACE_DETT_INTERVALLO = float(os.environ.get('TRACE_DETT_INTERVALLO', '5'))
+TRACE_DETT_LIVELLO = os.environ.get('TRACE_DETT_LIVELLO', 'OK').upper()
+TRACE_DETT_CAMPIONE_OK = int(os.environ.get('TRACE_DETT_CAMPIONE_OK', '1'))
+
+# Stati scritti per livello di verbosità
+STATI_PER_LIVELLO = {
+    'OK': {'OK', 'WARN', 'KO'},
+    'WARN': {'WARN', 'KO'},
+}
+
+
+class TraceWriter:
+    """Buffer dei dettagli trace di una elaborazione, scritti a blocchi."""
+
+    def __init__(self, session, model, id_trace, batch_size=None, intervallo=None,
+                 livello=None, campione_ok=None):
+        self.session = session
+        self.model = model
+        self.id_trace = id_trace
+        self.batch_size = batch_size or TRACE_DETT_BATCH
+        self.intervallo = TRACE_DETT_INTERVALLO if intervallo is None else intervallo
+        livello = (livello or TRACE_DETT_LIVELLO).upper()
+        if livello not in STATI_PER_LIVELLO:
+            raise ValueError(f"Livello trace non valido: {livello}")
+        self.stati = STATI_PER_LIVELLO[livello]
+        self.campione_ok = max(1, campione_ok or TRACE_DETT_CAMPIONE_OK)
+        self._buffer = []
+        self._ultimo_flush = time.monotonic()
+        self.scritti = 0
+        self.filtrati = 0
+        self.persi = 0
+
+    def da_scrivere(self, stato, record_pos):
+        """True se il dettaglio passa il filtro di verbosità."""
+        if stato not in self.stati:
+            return False
+        if stato == 'OK' and self.campione_ok > 1 and record_pos:
+            return record_pos % self.campione_ok == 0
+        return True
+
+    def aggiungi(self, record_pos, record_data, stato='OK', messaggio=None):
+        """Accoda un dettaglio; flush se il buffer è pieno o è passato l'intervallo."""
+        if not self.da_scrivere(stato, record_pos):
+            self.filtrati += 1
+            return
+        self._buffer.append({
+            'id_trace': self.id_trace,
+            'record_pos': record_pos,
+            'record_data': record_data,
+            'stato': stato,
+            'messaggio': messaggio,
+        })
+        if (len(self._buffer) >= self.batch_size
+                or time.monotonic() - self._ultimo_flush >= self.intervallo):
+            self.flush()
+
+    def estendi(self, dettagli):
+        """Accoda dettagli già in forma di dict (chiavi come aggiungi)."""
+        for d in dettagli:
+            self.aggiungi(d.get('record_pos'), d.get('record_data'), d.get('stato', 'OK'), d.get('messaggio'))
+
+    def flush(self):
+        """INSERT a blocchi dei dettagli accodati e commit della sessione log."""
+        self._ultimo_flush = time.monotonic()
+        if not self._buffer:
+            return 0
+        blocco, self._buffer = self._buffer, []
+        try:
+            insert_rows(self.session, self.model, blocco, self.batch_size)
+            self.session.commit()  # ← AUTONOMOUS: dettagli persistiti
+        except Exception as e:
+            self.session.rollback()
+            self.persi += len(blocco)
+            logger.error(f"⚠️ Scrittura trace fallita ({len(blocco)} dettagli scartati): {e}")
+            return 0
+        self.scritti += len(blocco)
+        return len(blocco)
+
+    def chiudi(self):
+        """Flush finale: da chiamare prima di scrivere il record END."""
+        self.flush()
+        if self.filtrati or self.persi:
+            logger.info(f"📝 Trace {self.id_trace}: {self.scritti} dettagli scritti, "
+                        f"{self.filtrati} filtrati, {self.persi} persi")
+        return self.scritti
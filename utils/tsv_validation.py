@@ -0,0 +1,81 @@
+"""
+Stadio di validazione dei TSV prima delle scritture su database.
+
+Le pipeline (rotture, ordini) validano l'intero file con operazioni pandas per
+colonna e ottengono due frame: le righe pulite già tipizzate e le righe in
+errore con il messaggio. Il caricamento parte solo dopo, quindi gli errori di
+formato sono noti prima di aprire qualunque transazione.
+
+Per file molto grandi la validazione per riga può essere divisa in blocchi
+su un ProcessPoolExecutor (VALIDAZIONE_WORKERS > 1): la funzione di blocco
+deve essere a livello di modulo (picklable) e lavorare solo sulle proprie
+righe; i controlli tra righe (es. duplicati) vanno fatti dopo la riunione.
+
+Uso:
+    from utils.tsv_validation import valida_a_blocchi, segnala, frame_errori
+
+    righe, errori = valida_a_blocchi(df, _valida_blocco)  # errori per riga
+    segnala(errori, righe['prot'].duplicated(), "Protocollo duplicato nel file")
+    pulito = righe[errori.isna()]
+    errori = frame_errori(righe, errori, 'prot')
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+# Processi per la validazione (1 = seriale) e righe per blocco
+VALIDAZIONE_WORKERS = int(os.environ.get('VALIDAZIONE_WORKERS', '1'))
+VALIDAZIONE_CHUNK = int(os.environ.get('VALIDAZIONE_CHUNK', '50000'))
+
+COLONNE_ERRORI = ['riga_file', 'chiave', 'messaggio']
+
+
+def frame_errori(righe, errori, chiave=None):
+    """
+    Frame errori (riga_file, chiave, messaggio) dalle righe con errore
+    valorizzato; errori è una Series allineata a righe (NaN = riga valida).
+    """
+    ko = errori.notna()
+    return pd.DataFrame({
+        'riga_file': righe.loc[ko, 'riga_file'].astype(int),
+        'chiave': righe.loc[ko, chiave] if chiave else None,
+        'messaggio': errori[ko],
+    }, columns=COLONNE_ERRORI)
+
+
+def serie_errori(index):
+    """Series degli errori per riga: NaN = riga valida."""
+    return pd.Series(np.nan, index=index, dtype=object)
+
+
+def segnala(errori, maschera, messaggio):
+    """
+    Registra messaggio (stringa o Series allineata) sulle righe della maschera
+    che non hanno già un errore: ogni riga conserva il primo errore trovato.
+    """
+    nuove = maschera & errori.isna()
+    errori[nuove] = messaggio[nuove] if isinstance(messaggio, pd.Series) else messaggio
+
+
+def valida_a_blocchi(df, funzione, workers=None, chunk_size=None):
+    """
+    Applica funzione(blocco) -> (righe, errori) a blocchi di righe di df e
+    riunisce i risultati nell'ordine del file. Seriale con un solo worker o
+    un solo blocco; altrimenti su un ProcessPoolExecutor.
+    """
+    workers = VALIDAZIONE_WORKERS if workers is None else workers
+    chunk_size = chunk_size or VALIDAZIONE_CHUNK
+    blocchi = [df.iloc[i:i + chunk_size] for i in range(0, len(df), chunk_size)] or [df]
+
+    if workers <= 1 or len(blocchi) == 1:
+        risultati = [funzione(b) for b in blocchi]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(blocchi))) as executor:
+            risultati = list(executor.map(funzione, blocchi))
+
+    righe = pd.concat([r for r, _ in risultati])
+    errori = pd.concat([e for _, e in risultati])
+    return righe, errori
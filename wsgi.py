@@ -0,0 +1,26 @@
+"""
+Entry point WSGI per l'avvio in produzione.
+
+Uso:
+    gunicorn --preload -w 4 -b 0.0.0.0:5010 wsgi:app
+
+Con PREVISIONI_PRELOAD=1 i dati delle previsioni sono caricati qui, nel
+processo master, prima del fork: i worker li ereditano già pronti
+(pagine condivise copy-on-write) e nessuna richiesta attende il caricamento.
+Nel master non parte nessun thread: watcher e coda previsioni sono avviati
+in ogni worker dall'hook post_fork (gunicorn.conf.py).
+"""
+
+import os
+
+from app import create_app
+from config import DevelopmentConfig, ProductionConfig
+
+_config = ProductionConfig if os.environ.get('FLASK_ENV') == 'production' else DevelopmentConfig
+app = create_app(_config)
+
+if os.environ.get('PREVISIONI_PRELOAD', '').lower() in ('1', 'true', 'yes'):
+    from routes.previsioni import warm_up
+
+    with app.app_context():
+        warm_up()